@@ -9,7 +9,7 @@ from calibre.customize import InterfaceActionBase
 
 PLUGIN_NAME = 'TTS to MP3'
 PLUGIN_VERSION_TUPLE = (0, 6, 0)
-PLUGIN_DESCRIPTION = 'Create MP3 audiobook using MSWindows Text-to-Speech\n[EPUB, AZW3, KEPUB]'
+PLUGIN_DESCRIPTION = 'Create MP3 audiobook using Text-to-Speech (Windows SAPI5, eSpeak NG)\n[EPUB, AZW3, KEPUB]'
 PLUGIN_CAPTION = '%s [v%s]'%(PLUGIN_NAME, '.'.join([str(x) for x in PLUGIN_VERSION_TUPLE]))
 
 
@@ -25,7 +25,7 @@ class TTSMP3ActionBase(InterfaceActionBase):
     '''
     name                = PLUGIN_NAME
     description         = PLUGIN_DESCRIPTION
-    supported_platforms = ['windows']
+    supported_platforms = ['windows', 'linux', 'osx']
     author              = 'jackie_w'
     version             = PLUGIN_VERSION_TUPLE
     minimum_calibre_version = (5, 4, 0)
@@ -76,3 +76,11 @@ class TTSMP3ActionBase(InterfaceActionBase):
         ac = self.actual_plugin_
         if ac is not None:
             ac.apply_settings()
+
+    def cli_main(self, argv):
+        '''
+        Record books without the GUI, run with calibre-debug -r "TTS to MP3" -- args
+        :param argv: the plugin name followed by the command line args
+        '''
+        from calibre_plugins.tts_to_mp3_plugin.cli import main
+        raise SystemExit(main(argv[1:]))
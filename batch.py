@@ -0,0 +1,232 @@
+import os
+import shutil
+import time
+
+from calibre.constants import iswindows
+from calibre.devices.usbms.driver import debug_print
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+
+# lame.exe is shipped in the plugin zip for Windows, elsewhere lame must be installed
+PROG_FILENAME = 'lame.exe' if iswindows else 'lame'
+TEXT_STORE_FILENAME = 'booktext.store'
+OK_FORMATS = ('EPUB', 'AZW3', 'KEPUB')
+
+# prefs a batch is prepared with, read once when the batch starts
+BATCH_PREFS = ('tts_engine', 'voice_name', 'voice_rate', 'img_alt_show', 'img_alt_prefix',
+               'parallel_extract', 'text_cache_mb', 'embed_cover_thumbnail')
+
+
+class BatchError(Exception):
+    # a book which can't be recorded, the message is shown to the user
+    pass
+
+
+class BookJob(object):
+    ''' A book prepared for recording without the main dialog
+        Has the same attributes as EbookTTStoMP3 after it is accepted, so
+        create_djobmeta() works for both
+    '''
+
+    def __init__(self, path_to_ebook, book_id=None):
+        self.pathtoebook = path_to_ebook
+        self.book_id = book_id
+        self.container = None
+        self.dest_dir = None
+        self.mp3_dir = None
+        self.mp3_in_place = False
+        self.cover_file = None
+        self.lame_path = None
+        self.engine_name = None
+        self.vid = None
+        self.voice_name = None
+        self.voice_rate = 0
+        self.book_label = ''
+        self.book_tags = {}
+        self.text_store_path = None
+        self.payload = []
+        self.extract_span = None
+
+
+def find_lame(tempdir):
+    # lame.exe is extracted from the plugin zip on Windows, elsewhere it must be on the PATH
+    from calibre_plugins.tts_to_mp3_plugin.common_utils import extract_executable
+    if iswindows:
+        return extract_executable(tempdir, PROG_FILENAME, plugin=PLUGIN_NAME)
+    return shutil.which(PROG_FILENAME)
+
+def book_format_path(db, book_id):
+    # a copy of the book in the first of OK_FORMATS it has, or None
+    avail_fmts = db.formats(book_id, verify_formats=True)
+    for fmt in OK_FORMATS:
+        if fmt in avail_fmts:
+            return db.format(book_id, fmt, as_path=True, preserve_filename=True)
+    return None
+
+def prepare_book(path_to_ebook, mp3_root, settings, db=None, book_id=None, lame_path=None,
+                 cpus=None, abort=None, temp_dirs=None):
+    ''' Everything the main dialog does before a job is queued, with no questions asked
+        The saved voice and rate are used, MP3 tags are the dialog's defaults from the
+        book's metadata and every spine file which contains text is recorded (the "All"
+        button). The MP3s go in a subdir of mp3_root named after the album
+        The cover is left out if calibre's Qt image support can't be imported
+        Run in a background thread, the library db is only read
+        :settings: dict of the BATCH_PREFS
+        :abort: optional callable, returns True to stop early
+        :temp_dirs: optional list, each temp dir made for the book is appended as it is
+                    made, so the caller can remove them if the book fails or isn't queued
+        returns a BookJob, raises BatchError if the book can't be recorded
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.common_utils import get_toc_dict_list
+    from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog, default_engine_name
+    from calibre_plugins.tts_to_mp3_plugin.extract import get_text_cache, load_spine_text
+    from calibre_plugins.tts_to_mp3_plugin.journal import create_job_dir
+    from calibre_plugins.tts_to_mp3_plugin.textstore import TextStoreWriter
+    from calibre_plugins.tts_to_mp3_plugin.utils import (extract_book_meta, create_spine_record,
+        album_dir_name, default_mp3_tags, voice_comment, same_device, place_file)
+    from calibre_plugins.tts_to_mp3_plugin.zipcontainer import get_spine_container
+
+    if temp_dirs is None:
+        temp_dirs = []
+    book = BookJob(path_to_ebook, book_id)
+    try:
+        book.container = get_spine_container(path_to_ebook)
+        temp_dirs.append(book.container.root)
+        book_type = book.container.book_type
+    except:
+        book_type = None
+    if book_type not in ('epub', 'azw3', 'kepub'):
+        raise BatchError('Unsupported book format. Must be EPUB, AZW3, KEPUB.')
+
+    book.engine_name = default_engine_name(settings['tts_engine'])
+    catalog = voice_catalog(book.engine_name)
+    if not catalog.voices:
+        raise BatchError('No voices found for %s' % book.engine_name)
+    book.voice_name = settings['voice_name']
+    if book.voice_name not in catalog.by_desc:
+        # same as the main dialog, the first voice in the combo
+        book.voice_name = catalog.sorted_descs[0]
+    book.vid = catalog.voice_id(book.voice_name)
+    book.voice_rate = settings['voice_rate']
+
+    book_meta = extract_book_meta(book.container, db, book_id)
+    book.book_label = book_meta.get('path_to_ebook')
+    if book_id:
+        book.book_label = '%s - %s (%s)' % (book_meta.get('author0'), book_meta.get('title'), book_id)
+    book_tags = default_mp3_tags(book_meta)
+    book_tags['tc'] = voice_comment(catalog.voice_name(book.vid), book.voice_rate)
+
+    toc_name_title_map = {d['name']: '{0}{1}'.format(3*'\xa0'*(d['level']-1), d['title'])
+                          for d in reversed(get_toc_dict_list(book.container))}
+    spine_list = [name for name, x in book.container.spine_names]
+    padding = len(str(len(spine_list)))
+    name_record_map = {name: create_spine_record(name, padding, toc_name_title_map) for name in spine_list}
+
+    # names arrive in spine sequence so track numbers are assigned in order
+    tracks = []
+    def name_loaded(name, data):
+        record = name_record_map[name]
+        record.set_text_data(data)
+        if record.booktext:
+            record.track = len(tracks) + 1
+            tracks.append(record)
+    start = time.time()
+    finished = load_spine_text(book.container, spine_list, book_meta.get('language'),
+                    settings['img_alt_show'], settings['img_alt_prefix'], name_loaded,
+                    parallel=settings['parallel_extract'], cpus=cpus,
+                    cache=get_text_cache(settings['text_cache_mb']), abort=abort)
+    if not finished:
+        raise BatchError('Text was not extracted')
+    if not tracks:
+        raise BatchError('Nothing to record to MP3. None of the files contain text.')
+    book.extract_span = (start, time.time(), sum(record.wordcount for record in tracks))
+
+    book.mp3_dir = mp3_root
+    album = (book_tags.get('tl') or '').strip()
+    if album:
+        book.mp3_dir = os.path.join(mp3_root, album_dir_name(album))
+        if not os.path.exists(book.mp3_dir):
+            os.mkdir(book.mp3_dir)
+
+    # the job works in a dir which survives restarting calibre, so it can be resumed
+    book.dest_dir = create_job_dir()
+    temp_dirs.append(book.dest_dir)
+    book.lame_path = lame_path
+    if iswindows and lame_path:
+        book.lame_path = shutil.copy2(lame_path, book.dest_dir)
+    book.mp3_in_place = same_device(book.dest_dir, book.mp3_dir)
+
+    cover_data = book_meta.get('cover_data', None)
+    try:
+        # Qt image functions, which a headless machine may not have
+        from calibre.utils.img import save_cover_data_to
+    except ImportError:
+        if cover_data is not None:
+            debug_print('{0}: no image support, cover not saved for {1}'.format(PLUGIN_NAME, book.book_label))
+        cover_data = None
+    if cover_data is not None:
+        thumbnail = 'embed.jpg' if settings['embed_cover_thumbnail'] else 'cover.jpg'
+        thumb_path = os.path.join(book.dest_dir, thumbnail)
+        save_cover_data_to(cover_data, path=thumb_path, minify_to=(300, 300))
+        if settings['embed_cover_thumbnail']:
+            book_tags['ti'] = thumb_path
+        elif book.mp3_in_place:
+            place_file(thumb_path, os.path.join(book.mp3_dir, thumbnail), move=True)
+        else:
+            book.cover_file = thumb_path
+    book.book_tags = book_tags
+
+    book.text_store_path = os.path.join(book.dest_dir, TEXT_STORE_FILENAME)
+    with TextStoreWriter(book.text_store_path) as store:
+        for record in tracks:
+            record.text_offset, record.text_length = store.add(record.name, record.booktext)
+            book.payload.append(record)
+    debug_print('{0}: batch prepared {1}: {2} files'.format(PLUGIN_NAME, book.book_label, len(book.payload)))
+    return book
+
+def remove_temp_dirs(temp_dirs):
+    for temp_dir in temp_dirs:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def create_djobmeta(book, prefs):
+    ''' Job settings of a prepared book, the djobmeta of each of its tracks
+        :book: an accepted EbookTTStoMP3 or a BookJob
+        :prefs: the plugin prefs, or a dict of the same keys
+    '''
+    return {'lame_path': book.lame_path
+            , 'tts_engine': book.engine_name
+            , 'voice_name': book.voice_name
+            , 'voice_rate': book.voice_rate
+            , 'voice_id': book.vid
+            , 'book_label': book.book_label
+            , 'container_root': book.container.root
+            , 'dest_dir': book.dest_dir
+            , 'text_store': book.text_store_path
+            , 'book_id': book.book_id
+            , 'mp3_dir': book.mp3_dir
+            , 'mp3_in_place': book.mp3_in_place
+            , 'cover_file': book.cover_file
+            , 'book_tags': book.book_tags
+            , 'chunk_words': prefs['chunk_words']
+            , 'audio_cache_mb': prefs['audio_cache_mb']
+            , 'stream_audio': prefs['stream_audio']
+            , 'parallel_encode': prefs['parallel_encode']
+            , 'mp3_encoder': prefs['mp3_encoder']
+            , 'spool_mb': prefs['spool_mb']
+            , 'write_trace': prefs['write_trace']
+            , 'extract_span': book.extract_span
+            }
+
+def interleave_files(book_files):
+    ''' One job queue for several books: (state, djobmeta) items taken from each
+        book in turn, so the pool is shared between them. The job starts the longest
+        tracks first, tracks of the same length are taken in this order
+        :book_files: list of files_to_proc lists, one per book
+    '''
+    files_to_proc = []
+    for i in range(max(len(files) for files in book_files) if book_files else 0):
+        for files in book_files:
+            if i < len(files):
+                files_to_proc.append(files[i])
+    return files_to_proc
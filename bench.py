@@ -0,0 +1,318 @@
+'''
+Benchmarks for the TTS to MP3 plugin. The plugin must be installed in calibre.
+Run using calibre-debug, e.g.
+
+    calibre-debug -e bench.py -- extract book1.epub book2.azw3 book3.kepub
+    calibre-debug -e bench.py -- memory --files 5000
+    calibre-debug -e bench.py -- synth --engine stub --words 20000
+    calibre-debug -e bench.py -- encode --tracks 200 --words 300
+    calibre-debug -e bench.py -- imports
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+
+def timed(func, repeat):
+    # best-of-repeat wall clock time and the last result
+    best, result = None, None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_extract(paths, repeat=3, img_alt=True, alt_prefix='Image'):
+    ''' Compare the legacy extraction path (pretty_all + XPath get_page_text + ICU count_words)
+        with the single-pass SpokenTextExtractor, on the spine files of each book
+        Each run uses a freshly opened container so both paths include parsing
+    '''
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.ebooks.oeb.polish.pretty import pretty_all
+    from calibre.spell.break_iterator import count_words
+    from calibre_plugins.tts_to_mp3_plugin.extract import SpokenTextExtractor
+    from calibre_plugins.tts_to_mp3_plugin.utils import get_page_text
+
+    def legacy(path):
+        container = get_container(path)
+        language = container.mi.language
+        def run():
+            pretty_all(container)
+            words = 0
+            for name, x in container.spine_names:
+                text = get_page_text(container, name, img_alt=img_alt, alt_prefix=alt_prefix)
+                words += count_words(text.replace('.', '. '), language)
+            return words
+        return run
+
+    def single_pass(path):
+        container = get_container(path)
+        extractor = SpokenTextExtractor(container.mi.language, img_alt, alt_prefix)
+        def run():
+            words = 0
+            for name, x in container.spine_names:
+                text, wordcount = extractor(container.parsed(name))
+                words += wordcount
+            return words
+        return run
+
+    def run_fresh(factory, path):
+        # container opening is excluded from the timing
+        runs = [factory(path) for i in range(repeat)]
+        return timed(lambda: runs.pop()(), repeat)
+
+    print('{0:40} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10}'.format(
+        'book', 'legacy s', 'single s', 'speedup', 'legacy w', 'single w'))
+    for path in paths:
+        t_old, w_old = run_fresh(legacy, path)
+        t_new, w_new = run_fresh(single_pass, path)
+        speedup = t_old / t_new if t_new else 0.0
+        print('{0:40} {1:10.3f} {2:10.3f} {3:7.1f}x {4:10d} {5:10d}'.format(
+            os.path.basename(path)[:40], t_old, t_new, speedup, w_old, w_new))
+
+def bench_memory(nfiles=5000, words=2000):
+    ''' Compare the memory used by the per-spine data structures of the dialog and job payload:
+        the old name_data_map + spinelistdict + payload dicts vs one SpineRecord per file
+        The text and sample strings are created beforehand and shared by both layouts,
+        so only the per-file structures themselves are measured
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+
+    padding = len(str(nfiles))
+    dest_dir, mp3_dir = '/tmp/dest_ttsmp3', '/tmp/mp3/Book Title'
+    book_tags = {'ta': 'Author Name', 'tl': 'Book Title', 'ty': '2020', 'tg': 'Speech',
+                 'tc': 'calibre: Voice (0)', 'ti': '/tmp/dest_ttsmp3/embed.jpg'}
+    names = ['OEBPS/Text/chapter%05d.xhtml' % i for i in range(nfiles)]
+    titles = ['Chapter %d' % (i + 1) for i in range(nfiles)]
+    texts = [('word%d ' % i) * words for i in range(nfiles)]
+    samples = [t[:1000] + '...' for t in texts]
+
+    def legacy():
+        name_data_map, spinelistdict, payload = {}, [], []
+        for i, name in enumerate(names):
+            d = {'tt': titles[i], 'short_toctitle': titles[i], 'safe_title': titles[i],
+                 'sample': samples[i], 'booktext': texts[i], 'wordcount': words,
+                 'padding': padding, 'tn': str(i + 1), 'pad_track': str(i + 1).zfill(padding)}
+            d['safe_filename'] = '%s_%s' % (d['pad_track'], titles[i])
+            name_data_map[name] = d
+            spinelistdict.append({'name': name, 'toc': d['short_toctitle'],
+                                  'sample': d['sample'], 'wordcount': d['wordcount']})
+        for name in names:
+            d = name_data_map[name]
+            dmp3meta = {'name': name, 'book_id': 1, 'booktext': d['booktext'],
+                        'safe_filename': d['safe_filename'],
+                        'wav_file_name': os.path.join(dest_dir, d['safe_filename'] + '.wav'),
+                        'mp3_file_name': os.path.join(dest_dir, d['safe_filename'] + '.mp3'),
+                        'pad_track': d['pad_track'], 'wordcount': d['wordcount'], 'mp3_dir': mp3_dir,
+                        'tt': d['tt'], 'tn': d['tn']}
+            dmp3meta.update(book_tags)
+            payload.append(dmp3meta)
+        return name_data_map, spinelistdict, payload
+
+    def records():
+        spine_records = []
+        for i, name in enumerate(names):
+            r = SpineRecord(name, titles[i], True, titles[i], padding)
+            r.set_text_data({'sample': samples[i], 'booktext': texts[i], 'wordcount': words})
+            r.track = i + 1
+            spine_records.append(r)
+        name_record_map = {r.name: r for r in spine_records}
+        payload = [name_record_map[name] for name in names]
+        return spine_records, name_record_map, payload, dict(book_tags)
+
+    def measure(build):
+        tracemalloc.start()
+        result = build()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        return current
+
+    old, new = measure(legacy), measure(records)
+    text_bytes = sum(sys.getsizeof(t) for t in texts) + sum(sys.getsizeof(s) for s in samples)
+    print('Synthetic book: {0} spine files, {1} words each, {2:.1f} MB of shared text'.format(
+        nfiles, words, text_bytes / 1e6))
+    print('{0:40} {1:>12.0f} KB  {2:>8.0f} bytes/file'.format('name_data_map + spinelistdict + payload', old / 1024.0, float(old) / nfiles))
+    print('{0:40} {1:>12.0f} KB  {2:>8.0f} bytes/file'.format('SpineRecord', new / 1024.0, float(new) / nfiles))
+    print('{0:40} {1:>11.1f}x'.format('reduction', float(old) / new if new else 0.0))
+
+def bench_synth(engine_name=None, words=20000, chunk_words=1500, rate=0):
+    ''' Speech synthesis speed of a TTS engine, on synthetic text split by the chunker
+        Reports the real time factor (audio seconds per wall clock second)
+        The stub engine needs no speech software, so it runs on any platform
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.engines import get_engine, default_engine_name
+    from calibre_plugins.tts_to_mp3_plugin.chunker import split_text
+
+    engine = get_engine(default_engine_name(engine_name))
+    engine.set_current_rate(rate)
+    sentence = 'The quick brown fox jumps over the lazy dog near the riverbank. '
+    text = '\n\n'.join(sentence * 10 for i in range(words // 120 + 1))
+    chunks = split_text(text, chunk_words)
+
+    start = time.perf_counter()
+    audio_seconds, pcm_bytes = 0.0, 0
+    for chunk in chunks:
+        params, blocks = engine.stream(chunk)
+        size = sum(len(b) for b in blocks)
+        pcm_bytes += size
+        audio_seconds += float(size) / (params[0] * params[1] * params[2])
+    elapsed = time.perf_counter() - start
+
+    print('Engine: {0}, {1} words in {2} chunks'.format(engine.description, len(text.split()), len(chunks)))
+    print('{0:30} {1:10.2f} s'.format('wall clock', elapsed))
+    print('{0:30} {1:10.2f} s'.format('audio', audio_seconds))
+    print('{0:30} {1:10.1f} MB'.format('PCM', pcm_bytes / 1e6))
+    print('{0:30} {1:10.1f}x'.format('real time factor', audio_seconds / elapsed if elapsed else 0.0))
+
+def bench_encode(tracks=200, words=300, lame_path=None):
+    ''' MP3 encoding of many short tracks, as in a book with hundreds of small spine files
+        per-file lame.exe: the WAV is written, lame.exe is started on it and the WAV deleted
+        piped lame.exe: lame.exe is started per track, reading PCM from its stdin
+        in-process: libmp3lame via lameenc, no process started, if lameenc is installed
+        PCM comes from the stub engine and is made before timing starts
+    '''
+    import shutil
+    import tempfile
+    import wave
+    from calibre_plugins.tts_to_mp3_plugin.engines import get_engine, ENGINE_STUB, iter_blocks
+    from calibre_plugins.tts_to_mp3_plugin.encoders import LameencEncoder, LameExeEncoder
+    from calibre_plugins.tts_to_mp3_plugin.utils import run_prog_py3
+
+    lame_path = lame_path or shutil.which('lame')
+    engine = get_engine(ENGINE_STUB)
+    sentence = 'The quick brown fox jumps over the lazy dog near the riverbank. '
+    params, pcm = engine.synthesize_pcm(sentence * (words // 12 + 1))
+    tags = {'ta': 'Author', 'tl': 'Album', 'tt': 'Title', 'tn': '1'}
+    tmpdir = tempfile.mkdtemp()
+
+    def per_file():
+        for i in range(tracks):
+            wav_path = os.path.join(tmpdir, '%d.wav' % i)
+            with wave.open(wav_path, 'wb') as w:
+                w.setnchannels(params[0])
+                w.setsampwidth(params[1])
+                w.setframerate(params[2])
+                w.writeframes(pcm)
+            args = [lame_path, '--quiet']
+            for k, v in sorted(tags.items()):
+                args.extend(('--%s' % k, v))
+            run_prog_py3(args + [wav_path, os.path.join(tmpdir, '%d.mp3' % i)])
+            os.remove(wav_path)
+
+    def streamed(encoder):
+        def run():
+            for i in range(tracks):
+                encoder.encode(params, iter_blocks(pcm), os.path.join(tmpdir, '%d.mp3' % i), tags)
+        return run
+
+    runs = []
+    if lame_path:
+        runs.append(('per-file lame.exe', per_file))
+        runs.append(('piped lame.exe', streamed(LameExeEncoder(lame_path))))
+    else:
+        print('lame not found, use --lame. Only the in-process encoder is measured')
+    if LameencEncoder.is_available():
+        runs.append(('in-process (lameenc)', streamed(LameencEncoder(lame_path))))
+    else:
+        print('lameenc is not installed, the in-process encoder is not measured')
+
+    audio_seconds = tracks * float(len(pcm)) / (params[0] * params[1] * params[2])
+    print('{0} tracks of {1:.1f} s audio'.format(tracks, audio_seconds / tracks))
+    try:
+        for label, func in runs:
+            elapsed, x = timed(func, 1)
+            print('{0:30} {1:10.2f} s {2:8.1f} ms/track {3:8.0f}x real time'.format(
+                label, elapsed, 1000.0 * elapsed / tracks, audio_seconds / elapsed if elapsed else 0.0))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+# modules the plugin should not load while calibre starts
+HEAVY_MODULES = ('calibre.ebooks.oeb.polish.container', 'calibre.ebooks.oeb.polish.pretty',
+                 'calibre.spell.break_iterator', 'calibre.utils.img', 'calibre.utils.ipc.server',
+                 'calibre_extensions.winsapi')
+
+def bench_imports():
+    ''' Cost of the plugin at calibre startup, when calibre imports the action module,
+        and the cost moved to the first use of the action (the modules uiaction used
+        to import at module level: config, tts_to_mp3, jobs, other_dlgs)
+        Run in a fresh calibre-debug process, the GUI modules calibre has loaded anyway
+        by the time plugins are imported are imported first and not counted
+    '''
+    import importlib
+    for name in ('qt.core', 'calibre.gui2', 'calibre.gui2.actions', 'calibre.gui2.proceed',
+                 'calibre.gui2.dialogs.message_box', 'calibre.utils.config'):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+    def load(names):
+        before = set(sys.modules)
+        start = time.perf_counter()
+        for name in names:
+            importlib.import_module('calibre_plugins.tts_to_mp3_plugin.' + name)
+        elapsed = time.perf_counter() - start
+        return elapsed, set(sys.modules) - before
+
+    steps = (('startup (uiaction)', ('uiaction',)),
+             ('first use of the action', ('config', 'tts_to_mp3', 'jobs', 'other_dlgs')))
+    total = 0.0
+    for label, names in steps:
+        elapsed, loaded = load(names)
+        total += elapsed
+        heavy = [m for m in HEAVY_MODULES if m in loaded]
+        print('{0:30} {1:8.1f} ms {2:5d} modules'.format(label, 1000 * elapsed, len(loaded)))
+        for m in heavy:
+            print('{0:30} {1}'.format('', m))
+    print('{0:30} {1:8.1f} ms'.format('all at startup (eager)', 1000 * total))
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench.py', description='TTS to MP3 plugin benchmarks')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('extract', help='Spine text extraction: legacy vs single-pass')
+    p.add_argument('books', nargs='+', help='EPUB, AZW3 or KEPUB files')
+    p.add_argument('--repeat', type=int, default=3)
+
+    p = sub.add_parser('memory', help='Per-spine data structures: dicts vs SpineRecord')
+    p.add_argument('--files', type=int, default=5000)
+    p.add_argument('--words', type=int, default=2000)
+
+    p = sub.add_parser('synth', help='TTS engine synthesis speed')
+    p.add_argument('--engine', default=None, help='sapi, espeak or stub. Default: platform default')
+    p.add_argument('--words', type=int, default=20000)
+    p.add_argument('--chunk-words', type=int, default=1500)
+    p.add_argument('--rate', type=int, default=0)
+
+    p = sub.add_parser('encode', help='MP3 encoding: per-file lame.exe vs piped vs in-process')
+    p.add_argument('--tracks', type=int, default=200)
+    p.add_argument('--words', type=int, default=300)
+    p.add_argument('--lame', default=None, help='path to lame.exe. Default: lame on the PATH')
+
+    sub.add_parser('imports', help='Plugin import time at calibre startup vs first use')
+
+    opts = parser.parse_args(argv)
+
+    # Initialize the plugin loader so calibre_plugins imports work
+    from calibre.customize.ui import find_plugin
+    find_plugin
+
+    if opts.command == 'extract':
+        bench_extract(opts.books, repeat=opts.repeat)
+    elif opts.command == 'memory':
+        bench_memory(nfiles=opts.files, words=opts.words)
+    elif opts.command == 'synth':
+        bench_synth(opts.engine, words=opts.words, chunk_words=opts.chunk_words, rate=opts.rate)
+    elif opts.command == 'encode':
+        bench_encode(tracks=opts.tracks, words=opts.words, lame_path=opts.lame)
+    elif opts.command == 'imports':
+        bench_imports()
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
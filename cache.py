@@ -0,0 +1,202 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from threading import RLock
+
+from calibre.constants import cache_dir
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+
+
+def plugin_cache_dir(*parts):
+    # all plugin caches live under calibre's cache dir
+    path = os.path.join(cache_dir(), 'plugins', 'ebook2audiobook', *parts)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+def hash_key(*parts):
+    # stable key from any mix of str/bytes/numbers
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+_file_hashes = {}
+
+def hash_file(path, chunk_size=1024*1024):
+    ''' sha1 of a file's contents
+        remembered per process for as long as the file size and mtime are unchanged
+    '''
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    digest = _file_hashes.get(memo_key)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                h.update(chunk)
+        digest = _file_hashes[memo_key] = h.hexdigest()
+    return digest
+
+
+class DiskCache(object):
+    ''' Size-capped key/value store on disk with least-recently-used eviction
+        Each value is stored as a file, the index (size, last access) is kept in SQLite
+        so several threads or worker processes can share the same cache
+        :cache_dir: directory for this cache
+        :max_size: byte limit. 0 disables the cache
+    '''
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = RLock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'),
+                        timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(key TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)')
+            self._conn = conn
+        return self._conn
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        ''' return the cached bytes for key, or None '''
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except EnvironmentError:
+            return None
+
+    def get_path(self, key):
+        ''' return the path of the cached file for key, or None
+            the entry is marked as most recently used
+        '''
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM entries WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            path = self.path_for(key)
+            if not os.path.exists(path):
+                self.conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                return None
+            self.conn.execute('UPDATE entries SET atime=? WHERE key=?', (time.time(), key))
+            return path
+
+    def put(self, key, data):
+        ''' store bytes for key, evicting least recently used entries if over the size limit '''
+        if not self.enabled or len(data) > self.max_size:
+            return
+        path = self.path_for(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except EnvironmentError as err:
+            print('{0}:DiskCache: could not write {1}: {2}'.format(PLUGIN_NAME, path, err))
+            return
+        self.add(key, len(data))
+
+    def put_file(self, key, src_path):
+        ''' move an already written file into the cache '''
+        if not self.enabled:
+            return
+        size = os.path.getsize(src_path)
+        if size > self.max_size:
+            return
+        path = self.path_for(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.replace(src_path, path)
+        self.add(key, size)
+
+    def put_copy(self, key, src_path):
+        ''' store a copy of a file, leaving the original in place '''
+        if not self.enabled:
+            return
+        size = os.path.getsize(src_path)
+        if size > self.max_size:
+            return
+        path = self.path_for(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copyfile(src_path, tmp)
+            os.replace(tmp, path)
+        except EnvironmentError as err:
+            print('{0}:DiskCache: could not write {1}: {2}'.format(PLUGIN_NAME, path, err))
+            return
+        self.add(key, size)
+
+    def add(self, key, size):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries (key, size, atime) VALUES (?, ?, ?)',
+                            (key, size, time.time()))
+            self.evict()
+
+    def total_size(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        # drop least recently used entries until back under the size limit
+        with self.lock:
+            excess = self.total_size() - self.max_size
+            if excess <= 0:
+                return
+            for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY atime').fetchall():
+                if excess <= 0:
+                    break
+                self.conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                try:
+                    os.remove(self.path_for(key))
+                except EnvironmentError:
+                    pass
+                excess -= size
+
+    def clear(self):
+        with self.lock:
+            for (key,) in self.conn.execute('SELECT key FROM entries').fetchall():
+                try:
+                    os.remove(self.path_for(key))
+                except EnvironmentError:
+                    pass
+            self.conn.execute('DELETE FROM entries')
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,97 @@
+import re
+import zlib
+
+# default upper bound on words in one chunk of text sent to the TTS engine
+CHUNK_WORDS = 1500
+
+PARAGRAPH_RE = re.compile(r'(\n\s*\n)')
+# split after sentence end punctuation, plus any closing quotes/brackets
+SENTENCE_RE = re.compile(r'''(?<=[.!?…。！？])["'”’)\]]*\s+''')
+WORD_RE = re.compile(r'\S+\s*')
+# once a chunk is half full, about 1 in ANCHOR_MOD paragraphs/sentences ends it
+ANCHOR_MOD = 4
+
+
+def count_chunk_words(text):
+    return len(text.split())
+
+def split_text(text, max_words=CHUNK_WORDS):
+    ''' Split text into pieces of at most max_words words, preferring paragraph
+        boundaries, then sentence boundaries, and only splitting between words
+        when a single sentence is too long.
+        ''.join(pieces) == text, so pieces can be mapped straight back onto
+        the text's position in the text store
+        Chunks end at content-defined points where possible, so an edit early
+        in a chapter doesn't move every later chunk boundary (and miss the audio cache)
+    '''
+    if count_chunk_words(text) <= max_words:
+        return [text] if text else []
+
+    pieces, current, current_words = [], [], 0
+
+    def flush():
+        if current:
+            pieces.append(''.join(current))
+            del current[:]
+
+    for unit in iter_units(text, max_words):
+        words = count_chunk_words(unit)
+        if current and current_words + words > max_words:
+            flush()
+            current_words = 0
+        current.append(unit)
+        current_words += words
+        if current_words >= max_words // 2 and is_anchor(unit):
+            flush()
+            current_words = 0
+    flush()
+    return pieces
+
+def is_anchor(unit):
+    # depends only on the unit's own text
+    return zlib.crc32(unit.strip().encode('utf-8')) % ANCHOR_MOD == 0
+
+def iter_units(text, max_words):
+    # paragraphs (with their trailing blank lines), broken down further
+    # if a paragraph on its own is longer than max_words
+    parts = PARAGRAPH_RE.split(text)
+    # re-attach each separator to the paragraph before it
+    paragraphs = [''.join(parts[i:i+2]) for i in range(0, len(parts), 2)]
+    for para in paragraphs:
+        if not para:
+            continue
+        if count_chunk_words(para) <= max_words:
+            yield para
+            continue
+        for sentence in split_keep(SENTENCE_RE, para):
+            if count_chunk_words(sentence) <= max_words:
+                yield sentence
+                continue
+            # a run-on sentence, split between words
+            words = WORD_RE.findall(sentence)
+            lead = sentence[:len(sentence) - len(sentence.lstrip())]
+            if lead:
+                yield lead
+            for i in range(0, len(words), max_words):
+                yield ''.join(words[i:i+max_words])
+
+def split_keep(regex, text):
+    # like regex.split but separators stay attached to the preceding piece
+    pieces, start = [], 0
+    for m in regex.finditer(text):
+        pieces.append(text[start:m.end()])
+        start = m.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+def chunk_byte_ranges(text, offset, max_words=CHUNK_WORDS):
+    ''' Split a text which starts at byte offset in a utf-8 text store
+        returns list of (offset, length) in bytes, one per chunk
+    '''
+    ranges = []
+    for piece in split_text(text, max_words):
+        length = len(piece.encode('utf-8'))
+        ranges.append((offset, length))
+        offset += length
+    return ranges
@@ -0,0 +1,133 @@
+'''
+Record audiobook MP3s without the calibre GUI, e.g. overnight on a headless machine.
+Run using calibre-debug:
+
+    calibre-debug -r "TTS to MP3" -- --output /srv/audiobooks book1.epub book2.azw3
+    calibre-debug -r "TTS to MP3" -- --library "~/Calibre Library" --output /srv/audiobooks 12 13 14
+
+Settings not given on the command line are the plugin's saved settings
+'''
+import argparse
+import os
+import shutil
+import sys
+import time
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='calibre-debug -r "TTS to MP3" --',
+                description='Record EPUB, AZW3 or KEPUB books to audiobook MP3s')
+    parser.add_argument('books', nargs='+', help='book files, or book ids if --library is given')
+    parser.add_argument('--library', default=None, help='calibre library the book ids are in')
+    parser.add_argument('--output', required=True, help='MP3 directory, each book gets a subdir')
+    parser.add_argument('--engine', default=None, help='sapi, espeak or stub')
+    parser.add_argument('--voice', default=None, help='voice description, as shown in the plugin')
+    parser.add_argument('--rate', type=int, default=None, help='speech rate -10 to 10')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes. Default: number of CPUs')
+    parser.add_argument('--chunk-words', type=int, default=None, help='words spoken by one worker job')
+    parser.add_argument('--encoder', default=None, help='auto, lameenc or lame')
+    parser.add_argument('--lame', default=None, help='path to lame.exe. Default: lame on the PATH')
+    parser.add_argument('--trace', action='store_true', help='save a timing trace of each book in its MP3 dir')
+    parser.add_argument('--list-voices', action='store_true', help='print the voices of the engine and exit')
+    return parser.parse_args(argv)
+
+def notify(fraction, msg):
+    print('{0:5.1f}% {1}'.format(100.0 * fraction, msg))
+    sys.stdout.flush()
+
+def main(argv):
+    ''' returns the exit status: 0 if every MP3 was created '''
+    from calibre import detect_ncpus
+    from calibre.ptempfile import PersistentTemporaryDirectory
+    from calibre_plugins.tts_to_mp3_plugin.prefs import prefs
+    from calibre_plugins.tts_to_mp3_plugin.batch import (BATCH_PREFS, PROG_FILENAME, OK_FORMATS,
+        BatchError, find_lame, book_format_path, prepare_book, create_djobmeta, interleave_files,
+        remove_temp_dirs)
+    from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog, default_engine_name
+    from calibre_plugins.tts_to_mp3_plugin.encoders import get_encoder, ENCODER_LAME
+    from calibre_plugins.tts_to_mp3_plugin.jobs import do_book_action_worker
+
+    opts = parse_args(argv)
+
+    # saved settings, overridden by the command line
+    settings = {key: prefs[key] for key in BATCH_PREFS + ('chunk_words', 'audio_cache_mb',
+                'stream_audio', 'parallel_encode', 'mp3_encoder', 'spool_mb', 'write_trace')}
+    for key, val in (('tts_engine', opts.engine), ('voice_name', opts.voice), ('voice_rate', opts.rate),
+                     ('chunk_words', opts.chunk_words), ('mp3_encoder', opts.encoder)):
+        if val is not None:
+            settings[key] = val
+    if opts.trace:
+        settings['write_trace'] = True
+
+    catalog = voice_catalog(default_engine_name(settings['tts_engine']))
+    if opts.list_voices:
+        for desc in catalog.sorted_descs:
+            print(desc)
+        return 0
+    if opts.voice is not None:
+        # any part of a description will do, as long as it finds a voice
+        vid = catalog.voice_id(opts.voice)
+        if vid is None:
+            print('No voice matches "%s", see --list-voices' % opts.voice)
+            return 1
+        settings['voice_name'] = catalog.by_id[vid]['description']
+
+    lame_path = opts.lame or find_lame(PersistentTemporaryDirectory('_ttsmp3'))
+    if not lame_path and get_encoder(settings['mp3_encoder']).name == ENCODER_LAME:
+        print('Could not find %s' % PROG_FILENAME)
+        return 1
+    cpus = opts.jobs or detect_ncpus()
+    output = os.path.abspath(opts.output)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    db = None
+    if opts.library:
+        from calibre.library import db as library_db
+        db = library_db(os.path.expanduser(opts.library)).new_api
+
+    start = time.time()
+    books, failed = [], 0
+    for arg in opts.books:
+        book_id, book_dirs = None, []
+        try:
+            if db is not None:
+                book_id = int(arg)
+                path_to_ebook = book_format_path(db, book_id)
+                if not path_to_ebook:
+                    raise BatchError('No %s available for this book' % ', '.join(OK_FORMATS))
+            else:
+                path_to_ebook = os.path.abspath(arg)
+            book = prepare_book(path_to_ebook, output, settings, db=db, book_id=book_id,
+                                lame_path=lame_path, cpus=cpus, temp_dirs=book_dirs)
+        except (BatchError, ValueError) as err:
+            remove_temp_dirs(book_dirs)
+            print('{0}: {1}'.format(arg, err))
+            failed += 1
+            continue
+        print('Prepared {0}: {1} files -> {2}'.format(book.book_label, len(book.payload), book.mp3_dir))
+        books.append(book)
+    if not books:
+        return 1
+
+    book_files = []
+    for book in books:
+        djobmeta = create_djobmeta(book, settings)
+        book_files.append([(record.job_state(), djobmeta) for record in book.payload])
+    files_to_proc = interleave_files(book_files)
+    good_files, bad_files = do_book_action_worker(files_to_proc, [], cpus, notification=notify)
+
+    for pad_track, name, errmsg, book_label in bad_files:
+        print('Failed: {0} {1} {2}: {3}'.format(book_label, pad_track, name, errmsg))
+    elapsed = time.time() - start
+    total_words = sum(good_file[3] for good_file in good_files)
+    print('Created {0} of {1} MP3s, {2} words in {3:.0f} s @ {4:.0f} wpm'.format(
+        len(good_files), len(files_to_proc), total_words, elapsed, 60.0 * total_words / elapsed if elapsed else 0.0))
+    if bad_files:
+        print('To try the failed MP3s again use "Resume interrupted jobs..." in the plugin menu')
+    else:
+        # as the GUI does when a job finishes, an unfinished job is kept for resuming
+        for book in books:
+            shutil.rmtree(book.container.root, ignore_errors=True)
+            shutil.rmtree(book.dest_dir, ignore_errors=True)
+    return 1 if bad_files or failed else 0
@@ -9,31 +9,16 @@ except ImportError:
         QHBoxLayout, QVBoxLayout, QRadioButton, QSpinBox, QGroupBox, QLineEdit,
         QPushButton)
         
-# This is where all preferences for this plugin will be stored
-# Remember that this plugin name is also
-# in a global namespace, so make it as unique as possible.
-# You should always prefix your config file name with plugins/,
-# so as to ensure you dont accidentally clobber a calibre config file
-# Set defaults
-
-from calibre.utils.config import JSONConfig
-from calibre_extensions.winsapi import ISpVoice
-
-from calibre_plugins.tts_to_mp3_plugin.utils import get_sorted_voicedescs
-
-prefs = JSONConfig('plugins/ebook2audiobook')
-
-#sapi = ISpVoice()
-prefs.defaults['voice_name'] = None
-prefs.defaults['voice_rate'] = 0
-prefs.defaults['img_alt_show'] = False
-prefs.defaults['img_alt_prefix'] = 'Image'
-prefs.defaults['embed_cover_thumbnail'] = True
+# the prefs are defined without Qt, so the command line can read them on a headless machine
+from calibre_plugins.tts_to_mp3_plugin.prefs import prefs
 
 class ConfigWidget(QWidget):
 
     def __init__(self):
         QWidget.__init__(self)
+        # imported here, prefs are read while calibre starts but the widget is only built when shown
+        from calibre_plugins.tts_to_mp3_plugin.engines import available_engines, default_engine_name
+        from calibre_plugins.tts_to_mp3_plugin.encoders import available_encoders, ENCODER_AUTO
         
         self.l = QVBoxLayout()
         self.setLayout(self.l)
@@ -97,6 +82,21 @@ class ConfigWidget(QWidget):
         layvoice = QGridLayout()
         gpvoice.setLayout(layvoice)
         
+        self.engineCombo = QComboBox()
+        self.engineCombo.setMinimumWidth(350)
+        self.engineCombo.setMaximumWidth(350)
+        for name, desc in available_engines():
+            self.engineCombo.addItem(desc, name)
+        engine_name = default_engine_name(prefs['tts_engine'])
+        idx = self.engineCombo.findData(engine_name)
+        self.engineCombo.setCurrentIndex(max(idx, 0))
+        
+        engineLabel = QLabel('TTS &Engine:')
+        engineLabel.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        engineLabel.setBuddy(self.engineCombo)
+        engineLabel.setMinimumWidth(200)
+        engineLabel.setMaximumWidth(200)
+        
         self.voiceCombo = QComboBox()
         self.voiceCombo.setMinimumWidth(350)
         self.voiceCombo.setMaximumWidth(350)
@@ -107,15 +107,8 @@ class ConfigWidget(QWidget):
         voiceLabel.setMinimumWidth(200)
         voiceLabel.setMaximumWidth(200)
         
-        # search Windows for available Voices
-        self.spVoice = ISpVoice()
-        all_descs = get_sorted_voicedescs(self.spVoice)
-        self.voiceCombo.addItems(all_descs)
-        
-        if prefs['voice_name'] in all_descs:
-            self.voiceCombo.setCurrentText(prefs['voice_name'])
-        else:
-            self.voiceCombo.setCurrentIndex(0)
+        # search the selected engine for available Voices
+        self.engineCombo_changed()
         
         self.rateSpin = QSpinBox()
         self.rateSpin.setRange(-10, 10)
@@ -130,24 +123,177 @@ class ConfigWidget(QWidget):
         
         self.rateSpin.setValue(prefs['voice_rate'])
         
-        layvoice.addWidget(voiceLabel, 0, 0)
-        layvoice.addWidget(self.voiceCombo, 0, 1, 1, 3)
-        layvoice.addWidget(rateLabel, 1, 0)
-        layvoice.addWidget(self.rateSpin, 1, 1)
+        layvoice.addWidget(engineLabel, 0, 0)
+        layvoice.addWidget(self.engineCombo, 0, 1, 1, 3)
+        layvoice.addWidget(voiceLabel, 1, 0)
+        layvoice.addWidget(self.voiceCombo, 1, 1, 1, 3)
+        layvoice.addWidget(rateLabel, 2, 0)
+        layvoice.addWidget(self.rateSpin, 2, 1)
+        
+        gpperf = QGroupBox('Performance:')
+        layperf = QGridLayout()
+        gpperf.setLayout(layperf)
+        
+        self.parallelextractCheckbox = QCheckBox('Parallel text extraction?')
+        self.parallelextractCheckbox.setChecked(prefs['parallel_extract'])
+        self.parallelextractCheckbox.setMinimumWidth(200)
+        self.parallelextractCheckbox.setMaximumWidth(200)
+        
+        helpparallelextractLabel = QLabel('If CHECKED the text of large books is extracted using all CPU cores.')
+        helpparallelextractLabel.setWordWrap(True)
+        helpparallelextractLabel.setMinimumWidth(350)
+        helpparallelextractLabel.setMaximumWidth(350)
+        
+        self.textcacheSpin = QSpinBox()
+        self.textcacheSpin.setRange(0, 10000)
+        self.textcacheSpin.setSuffix(' MB')
+        self.textcacheSpin.setMinimumWidth(200)
+        self.textcacheSpin.setMaximumWidth(200)
+        self.textcacheSpin.setValue(prefs['text_cache_mb'])
+        
+        helptextcacheLabel = QLabel('Disk space for remembering the extracted text of books already opened. 0 disables the cache.')
+        helptextcacheLabel.setWordWrap(True)
+        helptextcacheLabel.setMinimumWidth(350)
+        helptextcacheLabel.setMaximumWidth(350)
+        
+        self.chunkwordsSpin = QSpinBox()
+        self.chunkwordsSpin.setRange(0, 100000)
+        self.chunkwordsSpin.setSingleStep(500)
+        self.chunkwordsSpin.setSuffix(' words')
+        self.chunkwordsSpin.setMinimumWidth(200)
+        self.chunkwordsSpin.setMaximumWidth(200)
+        self.chunkwordsSpin.setValue(prefs['chunk_words'])
+        
+        helpchunkwordsLabel = QLabel('Long chapters are split at sentence boundaries into pieces of this size, which are recorded in parallel. 0 records each chapter in one piece.')
+        helpchunkwordsLabel.setWordWrap(True)
+        helpchunkwordsLabel.setMinimumWidth(350)
+        helpchunkwordsLabel.setMaximumWidth(350)
+        
+        self.audiocacheSpin = QSpinBox()
+        self.audiocacheSpin.setRange(0, 1000000)
+        self.audiocacheSpin.setSingleStep(500)
+        self.audiocacheSpin.setSuffix(' MB')
+        self.audiocacheSpin.setMinimumWidth(200)
+        self.audiocacheSpin.setMaximumWidth(200)
+        self.audiocacheSpin.setValue(prefs['audio_cache_mb'])
+        
+        helpaudiocacheLabel = QLabel('Disk space for remembering spoken text, so unchanged text is not spoken again when a book is re-recorded. 0 disables the cache.')
+        helpaudiocacheLabel.setWordWrap(True)
+        helpaudiocacheLabel.setMinimumWidth(350)
+        helpaudiocacheLabel.setMaximumWidth(350)
+        
+        self.streamaudioCheckbox = QCheckBox('Stream audio to encoder?')
+        self.streamaudioCheckbox.setChecked(prefs['stream_audio'])
+        self.streamaudioCheckbox.setMinimumWidth(200)
+        self.streamaudioCheckbox.setMaximumWidth(200)
+        
+        helpstreamaudioLabel = QLabel('If CHECKED spoken audio goes straight into the MP3 encoder. If UNCHECKED a WAV is written for each chapter first, which needs much more disk space.')
+        helpstreamaudioLabel.setWordWrap(True)
+        helpstreamaudioLabel.setMinimumWidth(350)
+        helpstreamaudioLabel.setMaximumWidth(350)
+        
+        self.parallelencodeCheckbox = QCheckBox('Parallel encoding?')
+        self.parallelencodeCheckbox.setChecked(prefs['parallel_encode'])
+        self.parallelencodeCheckbox.setMinimumWidth(200)
+        self.parallelencodeCheckbox.setMaximumWidth(200)
+        
+        helpparallelencodeLabel = QLabel('If CHECKED and audio is not streamed, long chapters are split at pauses and encoded to MP3 using all CPU cores.')
+        helpparallelencodeLabel.setWordWrap(True)
+        helpparallelencodeLabel.setMinimumWidth(350)
+        helpparallelencodeLabel.setMaximumWidth(350)
+        
+        self.encoderCombo = QComboBox()
+        self.encoderCombo.addItem('Automatic', ENCODER_AUTO)
+        for name, desc in available_encoders():
+            self.encoderCombo.addItem(desc, name)
+        idx = self.encoderCombo.findData(prefs['mp3_encoder'])
+        self.encoderCombo.setCurrentIndex(idx if idx >= 0 else 0)
+        self.encoderCombo.setMinimumWidth(200)
+        self.encoderCombo.setMaximumWidth(200)
+        
+        helpencoderLabel = QLabel('MP3 encoder. The LAME library encodes inside calibre without starting lame.exe for every chapter, it is used automatically if the lameenc Python module is installed.')
+        helpencoderLabel.setWordWrap(True)
+        helpencoderLabel.setMinimumWidth(350)
+        helpencoderLabel.setMaximumWidth(350)
+        
+        self.spoolSpin = QSpinBox()
+        self.spoolSpin.setRange(0, 1000000)
+        self.spoolSpin.setSingleStep(500)
+        self.spoolSpin.setSuffix(' MB')
+        self.spoolSpin.setMinimumWidth(200)
+        self.spoolSpin.setMaximumWidth(200)
+        self.spoolSpin.setValue(prefs['spool_mb'])
+        
+        helpspoolLabel = QLabel('Working disk space for WAVs and MP3s while they are created, shared by all running jobs. Recording pauses when it is used up until encoding catches up. 0 for no limit.')
+        helpspoolLabel.setWordWrap(True)
+        helpspoolLabel.setMinimumWidth(350)
+        helpspoolLabel.setMaximumWidth(350)
+        
+        self.writetraceCheckbox = QCheckBox('Save timing trace?')
+        self.writetraceCheckbox.setChecked(prefs['write_trace'])
+        self.writetraceCheckbox.setMinimumWidth(200)
+        self.writetraceCheckbox.setMaximumWidth(200)
+        
+        helpwritetraceLabel = QLabel('If CHECKED the time taken to extract, speak, encode and copy each chapter is saved in the MP3 directory as tts_to_mp3_trace.json, which can be opened in chrome://tracing or ui.perfetto.dev.')
+        helpwritetraceLabel.setWordWrap(True)
+        helpwritetraceLabel.setMinimumWidth(350)
+        helpwritetraceLabel.setMaximumWidth(350)
+        
+        layperf.addWidget(self.parallelextractCheckbox, 0, 0)
+        layperf.addWidget(helpparallelextractLabel, 0, 1)
+        layperf.addWidget(self.textcacheSpin, 1, 0)
+        layperf.addWidget(helptextcacheLabel, 1, 1)
+        layperf.addWidget(self.chunkwordsSpin, 2, 0)
+        layperf.addWidget(helpchunkwordsLabel, 2, 1)
+        layperf.addWidget(self.audiocacheSpin, 3, 0)
+        layperf.addWidget(helpaudiocacheLabel, 3, 1)
+        layperf.addWidget(self.streamaudioCheckbox, 4, 0)
+        layperf.addWidget(helpstreamaudioLabel, 4, 1)
+        layperf.addWidget(self.parallelencodeCheckbox, 5, 0)
+        layperf.addWidget(helpparallelencodeLabel, 5, 1)
+        layperf.addWidget(self.encoderCombo, 6, 0)
+        layperf.addWidget(helpencoderLabel, 6, 1)
+        layperf.addWidget(self.spoolSpin, 7, 0)
+        layperf.addWidget(helpspoolLabel, 7, 1)
+        layperf.addWidget(self.writetraceCheckbox, 8, 0)
+        layperf.addWidget(helpwritetraceLabel, 8, 1)
         
         self.l.addWidget(gpvoice)
         self.l.addWidget(gpcover)
         self.l.addWidget(gpimgalt)
+        self.l.addWidget(gpperf)
         
         self.imgaltshowCheckbox.toggled.connect(self.imgaltshowCheckbox_toggled)
+        self.engineCombo.currentIndexChanged.connect(self.engineCombo_changed)
         
         self.imgaltshowCheckbox_toggled(self.imgaltshowCheckbox.isChecked())
         
+    def engineCombo_changed(self, *args):
+        # each engine has its own set of Voices
+        from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog
+        all_descs = list(voice_catalog(self.engineCombo.currentData()).sorted_descs)
+        self.voiceCombo.clear()
+        self.voiceCombo.addItems(all_descs)
+        
+        if prefs['voice_name'] in all_descs:
+            self.voiceCombo.setCurrentText(prefs['voice_name'])
+        else:
+            self.voiceCombo.setCurrentIndex(0)
+        
     def imgaltshowCheckbox_toggled(self, bool):    
         self.imgaltprefixCombo.setEnabled(bool)
         
     def save_settings(self):
         prefs['embed_cover_thumbnail'] = self.embedcoverCheckbox.isChecked()
+        prefs['parallel_extract'] = self.parallelextractCheckbox.isChecked()
+        prefs['text_cache_mb'] = self.textcacheSpin.value()
+        prefs['chunk_words'] = self.chunkwordsSpin.value()
+        prefs['audio_cache_mb'] = self.audiocacheSpin.value()
+        prefs['stream_audio'] = self.streamaudioCheckbox.isChecked()
+        prefs['parallel_encode'] = self.parallelencodeCheckbox.isChecked()
+        prefs['mp3_encoder'] = self.encoderCombo.currentData()
+        prefs['spool_mb'] = self.spoolSpin.value()
+        prefs['write_trace'] = self.writetraceCheckbox.isChecked()
         prefs['img_alt_show'] = self.imgaltshowCheckbox.isChecked()
         prefix = self.imgaltprefixCombo.currentText().strip()
         if not prefix or '<none>' in prefix:
@@ -157,6 +303,7 @@ class ConfigWidget(QWidget):
         else:
             prefs['img_alt_prefix'] = prefix
             
+        prefs['tts_engine'] = self.engineCombo.currentData()
         prefs['voice_name'] = self.voiceCombo.currentText()
         prefs['voice_rate'] = self.rateSpin.value()
                           
@@ -0,0 +1,149 @@
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin.id3 import id3v2_tag
+
+ENCODER_AUTO = 'auto'
+ENCODER_LAMEENC = 'lameenc'
+ENCODER_LAME = 'lame'
+
+# lame.exe's defaults, so both encoders make the same MP3s
+BITRATE = 128
+QUALITY = 3
+
+
+class MP3Encoder(object):
+    ''' Encodes a stream of PCM blocks to an MP3 file
+        ID3 tags are given as a dict of lame tag options, see SpineRecord.lame_tags()
+    '''
+    name = None
+    description = None
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def encode(self, params, blocks, mp3_file_name, tags=None):
+        ''' :params: (nchannels, sampwidth, framerate) of the PCM
+            :blocks: iterator over blocks of PCM bytes
+            :tags: ID3 tags, or None for an untagged piece of a track with no Info frame,
+                   see utils.join_mp3s()
+            returns True if the MP3 was created
+        '''
+        raise NotImplementedError()
+
+
+class LameencEncoder(MP3Encoder):
+    ''' libmp3lame in this process, via the optional lameenc module
+        No program is started and no file is read back, blocks are encoded as they arrive
+    '''
+    name = ENCODER_LAMEENC
+    description = 'LAME library (in-process)'
+
+    def __init__(self, lame_path=None):
+        # lame.exe isn't needed, taken so get_encoder() makes every encoder the same way
+        self.lame_path = lame_path
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import lameenc
+            lameenc
+            return True
+        except ImportError:
+            return False
+
+    def encode(self, params, blocks, mp3_file_name, tags=None):
+        import lameenc
+        nchannels, sampwidth, framerate = params
+        if sampwidth != 2:
+            # lameenc only takes 16 bit samples
+            blocks = pcm16_blocks(blocks, sampwidth)
+        enc = lameenc.Encoder()
+        enc.set_bit_rate(BITRATE)
+        enc.set_in_sample_rate(framerate)
+        enc.set_channels(nchannels)
+        enc.set_quality(QUALITY)
+        with open(mp3_file_name, 'wb') as f:
+            if tags:
+                f.write(id3v2_tag(tags))
+            for block in blocks:
+                f.write(enc.encode(block))
+            f.write(enc.flush())
+        return True
+
+
+class LameExeEncoder(MP3Encoder):
+    ''' lame.exe started for each file, reading raw PCM from its stdin '''
+    name = ENCODER_LAME
+    description = 'LAME program'
+
+    def __init__(self, lame_path=None):
+        self.lame_path = lame_path
+
+    def encode(self, params, blocks, mp3_file_name, tags=None):
+        from calibre_plugins.tts_to_mp3_plugin.utils import run_prog_stdin
+        if not self.lame_path:
+            raise ValueError('No lame.exe to encode MP3s, set its path or install lameenc')
+        args = [self.lame_path]
+        args.extend(lame_tag_args(tags) if tags is not None else ['-t'])
+        args.extend(lame_raw_args(params))
+        args.append('-')
+        args.append(mp3_file_name)
+        return run_prog_stdin(args, blocks) == 0
+
+
+ENCODER_CLASSES = (LameencEncoder, LameExeEncoder)
+
+def lame_tag_args(tags):
+    # ID3 tag options for lame.exe
+    args = []
+    for tagopt, val in sorted(tags.items()):
+        if val is not None:
+            args.append('--%s' % tagopt)
+            args.append(val)
+    return args
+
+def lame_raw_args(params):
+    # lame.exe options to read raw PCM of the given (nchannels, sampwidth, framerate) from stdin
+    nchannels, sampwidth, framerate = params
+    return ['-r', '-s', '%g' % (framerate / 1000.0), '--bitwidth', str(sampwidth * 8),
+            '--unsigned' if sampwidth == 1 else '--signed', '--little-endian',
+            '-m', 'm' if nchannels == 1 else 'j']
+
+# 8 bit WAV samples are unsigned, flipping the top bit makes them signed
+_SIGN_8BIT = bytes(b ^ 0x80 for b in range(256))
+
+def pcm16_blocks(blocks, sampwidth):
+    ''' Convert blocks of 8, 24 or 32 bit little-endian PCM to 16 bit
+        Wider samples keep their top two bytes, 8 bit samples become the high byte
+        A sample split between blocks is carried over to the next block
+    '''
+    if sampwidth not in (1, 3, 4):
+        raise ValueError('Unsupported PCM sample width: %d bytes' % sampwidth)
+    rest = b''
+    for block in blocks:
+        if rest:
+            block = rest + block
+        usable = len(block) - len(block) % sampwidth
+        rest = block[usable:]
+        nsamples = usable // sampwidth
+        out = bytearray(nsamples * 2)
+        if sampwidth == 1:
+            out[1::2] = block[:usable].translate(_SIGN_8BIT)
+        else:
+            out[0::2] = block[sampwidth-2:usable:sampwidth]
+            out[1::2] = block[sampwidth-1:usable:sampwidth]
+        yield bytes(out)
+
+def available_encoders():
+    # list of (name, description) for the encoders that can run on this computer
+    return [(cls.name, cls.description) for cls in ENCODER_CLASSES if cls.is_available()]
+
+def get_encoder(name=None, lame_path=None):
+    ''' Create an encoder
+        :name: ENCODER_LAMEENC, ENCODER_LAME, or ENCODER_AUTO/None for the
+               in-process encoder if lameenc is installed, else lame.exe
+        :lame_path: lame.exe, needed by ENCODER_LAME
+    '''
+    if name in (None, ENCODER_AUTO, ENCODER_LAMEENC) and LameencEncoder.is_available():
+        return LameencEncoder(lame_path)
+    return LameExeEncoder(lame_path)
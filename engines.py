@@ -0,0 +1,512 @@
+import math, os, shutil, struct, subprocess, tempfile, wave, zlib
+from threading import Lock, Thread
+
+from calibre.constants import iswindows
+
+# names used in prefs['tts_engine'] and djobmeta['tts_engine']
+ENGINE_SAPI = 'sapi'
+ENGINE_ESPEAK = 'espeak'
+ENGINE_STUB = 'stub'
+
+# PCM block size used when streaming audio
+STREAM_BLOCK = 64 * 1024
+
+# idle engine instances kept by each VoiceCatalog
+ENGINE_POOL_SIZE = 2
+
+
+class SpeakFlags():
+    SVSFDefault                   =0          # from enum SpeechVoiceSpeakFlags
+    SVSFIsFilename                =4          # from enum SpeechVoiceSpeakFlags
+    SVSFIsNotXML                  =16         # from enum SpeechVoiceSpeakFlags
+    SVSFIsXML                     =8          # from enum SpeechVoiceSpeakFlags
+    SVSFNLPMask                   =64         # from enum SpeechVoiceSpeakFlags
+    SVSFNLPSpeakPunc              =64         # from enum SpeechVoiceSpeakFlags
+    SVSFParseAutodetect           =0          # from enum SpeechVoiceSpeakFlags
+    SVSFParseMask                 =384        # from enum SpeechVoiceSpeakFlags
+    SVSFParseSapi                 =128        # from enum SpeechVoiceSpeakFlags
+    SVSFParseSsml                 =256        # from enum SpeechVoiceSpeakFlags
+    SVSFPersistXML                =32         # from enum SpeechVoiceSpeakFlags
+    SVSFPurgeBeforeSpeak          =2          # from enum SpeechVoiceSpeakFlags
+    SVSFUnusedFlags               =-512       # from enum SpeechVoiceSpeakFlags
+    SVSFVoiceMask                 =511        # from enum SpeechVoiceSpeakFlags
+    SVSFlagsAsync                 =1          # from enum SpeechVoiceSpeakFlags
+
+
+class TTSEngine(object):
+    ''' Interface for a text-to-speech engine
+        Method names follow calibre's ISpVoice so an engine can be used wherever
+        the plugin used to create an ISpVoice()
+        Voices are dicts with keys id, name, description, language, gender
+        Rate is the SAPI scale -10 (slowest) to 10 (fastest), 0 is normal
+        Audio params are (nchannels, sampwidth, framerate), as used by the wave module
+        Subclasses implement get_all_voices() and stream(); the rest have defaults
+    '''
+    name = ''
+    description = ''
+    # part of the audio cache key, bump when output for the same input changes
+    version = '1'
+    # True if stream() records to a temp WAV in temp_dir before the first block
+    records_to_file = False
+
+    def __init__(self):
+        self.voice_id = None
+        self.rate = 0
+        # dir for temp files, None for the system temp dir. Jobs use their own dir
+        self.temp_dir = None
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def get_all_voices(self):
+        raise NotImplementedError()
+
+    def get_current_voice(self):
+        if self.voice_id is None:
+            voices = self.get_all_voices()
+            return voices[0]['id'] if voices else None
+        return self.voice_id
+
+    def set_current_voice(self, voice_id):
+        self.voice_id = voice_id
+
+    def get_current_rate(self):
+        return self.rate
+
+    def set_current_rate(self, rate):
+        self.rate = max(-10, min(10, int(rate or 0)))
+
+    def stream(self, text):
+        ''' Speak text with the current voice and rate
+            returns (params, iterator over blocks of PCM bytes)
+        '''
+        raise NotImplementedError()
+
+    def synthesize_pcm(self, text):
+        # returns (params, PCM bytes) for all of text
+        params, blocks = self.stream(text)
+        return params, b''.join(blocks)
+
+    def create_recording_wav(self, wav_file_name, text):
+        params, blocks = self.stream(text)
+        with wave.open(wav_file_name, 'wb') as out:
+            out.setnchannels(params[0])
+            out.setsampwidth(params[1])
+            out.setframerate(params[2])
+            for block in blocks:
+                out.writeframes(block)
+
+    # Voice tester. Engines which can't play aloud finish immediately
+    def speak(self, text):
+        pass
+
+    def wait_until_done(self, msecs):
+        return True
+
+    def stop(self):
+        pass
+
+
+class SapiEngine(TTSEngine):
+    ''' Windows SAPI5 voices via calibre's winsapi extension '''
+    name = ENGINE_SAPI
+    description = 'Windows SAPI5'
+    records_to_file = True
+
+    def __init__(self):
+        TTSEngine.__init__(self)
+        from calibre_extensions.winsapi import ISpVoice
+        self.voice = ISpVoice()
+        self.paused = False
+
+    @classmethod
+    def is_available(cls):
+        return iswindows
+
+    def get_all_voices(self):
+        return self.voice.get_all_voices()
+
+    def get_current_voice(self):
+        return self.voice.get_current_voice()
+
+    def set_current_voice(self, voice_id):
+        TTSEngine.set_current_voice(self, voice_id)
+        self.voice.set_current_voice(voice_id)
+
+    def set_current_rate(self, rate):
+        TTSEngine.set_current_rate(self, rate)
+        self.voice.set_current_rate(self.rate)
+
+    def create_recording_wav(self, wav_file_name, text):
+        # SAPI writes the WAV itself
+        self.voice.create_recording_wav(wav_file_name, text)
+
+    def stream(self, text):
+        # SAPI can only record to a file, so record to a temp WAV and read it back
+        # as it is used. The WAV is deleted once read, or when the blocks are dropped
+        fd, path = tempfile.mkstemp(suffix='.wav', dir=self.temp_dir)
+        os.close(fd)
+        try:
+            self.voice.create_recording_wav(path, text)
+            params, wav_blocks = iter_wav_file(path)
+        except:
+            os.remove(path)
+            raise
+
+        def blocks():
+            try:
+                for block in wav_blocks:
+                    yield block
+            finally:
+                wav_blocks.close()
+                os.remove(path)
+        return params, blocks()
+
+    def speak(self, text):
+        # a voice stopped by stop() is reused, so resume it and drop what it was saying
+        flags = SpeakFlags.SVSFlagsAsync
+        if self.paused:
+            self.voice.resume()
+            self.paused = False
+            flags |= SpeakFlags.SVSFPurgeBeforeSpeak
+        self.voice.speak(text, flags)
+
+    def wait_until_done(self, msecs):
+        return self.voice.wait_until_done(msecs)
+
+    def stop(self):
+        self.voice.pause()
+        self.paused = True
+
+
+class EspeakEngine(TTSEngine):
+    ''' Offline speech using the espeak-ng (or espeak) command line program '''
+    name = ENGINE_ESPEAK
+    description = 'eSpeak NG (offline)'
+    # espeak words per minute at rate 0, and the range it accepts
+    base_wpm = 175
+    min_wpm, max_wpm = 80, 450
+    _voices = None
+    _voices_lock = Lock()
+
+    def __init__(self):
+        TTSEngine.__init__(self)
+        self.prog = self.find_program()
+        self.player = None
+
+    @classmethod
+    def find_program(cls):
+        return shutil.which('espeak-ng') or shutil.which('espeak')
+
+    @classmethod
+    def is_available(cls):
+        return cls.find_program() is not None
+
+    def get_all_voices(self):
+        # the voice list doesn't change while calibre is running, so ask once
+        with EspeakEngine._voices_lock:
+            if EspeakEngine._voices is None:
+                EspeakEngine._voices = parse_espeak_voices(self.run_list_voices())
+        return EspeakEngine._voices
+
+    def run_list_voices(self):
+        if not self.prog:
+            return ''
+        cp = subprocess.run([self.prog, '--voices'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return cp.stdout.decode('utf-8', 'replace')
+
+    def wpm(self):
+        # SAPI rates are roughly 3x faster at +10 and 3x slower at -10
+        wpm = int(round(self.base_wpm * 3 ** (self.rate / 10.0)))
+        return max(self.min_wpm, min(self.max_wpm, wpm))
+
+    def command(self, *extra):
+        args = [self.prog, '-s', str(self.wpm())]
+        voice = self.get_current_voice()
+        if voice:
+            args += ['-v', voice]
+        return args + list(extra)
+
+    def stream(self, text):
+        proc = subprocess.Popen(self.command('--stdout'), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # write the text from a thread so a large text can't deadlock against stdout
+        def feed():
+            try:
+                proc.stdin.write(text.encode('utf-8'))
+            finally:
+                proc.stdin.close()
+        Thread(target=feed, daemon=True).start()
+        # the size fields of a WAV written to a pipe aren't reliable, only use the format
+        params = read_wav_stream_header(proc.stdout)
+
+        def blocks():
+            try:
+                while True:
+                    block = proc.stdout.read(STREAM_BLOCK)
+                    if not block:
+                        break
+                    yield block
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            # only reached if every block was read. A failed espeak (e.g. unknown voice)
+            # ends the audio early, so fail the chunk rather than encode or cache it short
+            if proc.returncode:
+                raise RuntimeError('%s exited with code %d' % (os.path.basename(self.prog), proc.returncode))
+        return params, blocks()
+
+    def speak(self, text):
+        self.stop()
+        self.player = subprocess.Popen(self.command(), stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.player.stdin.write(text.encode('utf-8'))
+        self.player.stdin.close()
+
+    def wait_until_done(self, msecs):
+        if self.player is None:
+            return True
+        try:
+            self.player.wait(msecs / 1000.0)
+        except subprocess.TimeoutExpired:
+            return False
+        self.player = None
+        return True
+
+    def stop(self):
+        if self.player is not None:
+            self.player.kill()
+            self.player.wait()
+            self.player = None
+
+
+class StubEngine(TTSEngine):
+    ''' Deterministic synthetic audio, no speech engine needed
+        Each word becomes a short tone whose pitch depends on the word and whose
+        length depends on the word length and the rate, followed by a gap.
+        The same text, voice and rate always give the same bytes, so the whole
+        pipeline can be run and benchmarked on any platform
+    '''
+    name = ENGINE_STUB
+    description = 'Synthetic test tones'
+    framerate = 16000
+    params = (1, 2, framerate)
+    base_wpm = 180
+    voices = (
+        {'id': 'stub-low', 'name': 'Stub Low', 'description': 'Stub Low - Synthetic tones', 'language': 'en', 'gender': 'Male'},
+        {'id': 'stub-high', 'name': 'Stub High', 'description': 'Stub High - Synthetic tones', 'language': 'en', 'gender': 'Female'},
+    )
+    _cycles = {}
+
+    def get_all_voices(self):
+        return [dict(v) for v in self.voices]
+
+    def word_pcm(self, word):
+        base = 200 if self.get_current_voice() != 'stub-high' else 400
+        freq = base + (zlib.crc32(word.encode('utf-8')) % 16) * 25
+        cycle = self._cycles.get(freq)
+        if cycle is None:
+            n = self.framerate // freq
+            cycle = b''.join(struct.pack('<h', int(8000 * math.sin(2 * math.pi * i / n))) for i in range(n))
+            self._cycles[freq] = cycle
+        # average word length of 5 letters lasts 60/wpm seconds, 1/3 of it is a gap
+        seconds = 60.0 / (self.base_wpm * 3 ** (self.rate / 10.0)) * min(len(word), 15) / 5.0
+        tone_frames = int(seconds * self.framerate * 2 / 3)
+        gap_frames = int(seconds * self.framerate / 3)
+        tone = cycle * (tone_frames // (len(cycle) // 2) + 1)
+        return tone[:tone_frames * 2] + b'\x00\x00' * gap_frames
+
+    def stream(self, text):
+        def blocks():
+            block = []
+            size = 0
+            for word in text.split():
+                pcm = self.word_pcm(word)
+                block.append(pcm)
+                size += len(pcm)
+                if size >= STREAM_BLOCK:
+                    yield b''.join(block)
+                    block, size = [], 0
+            if block:
+                yield b''.join(block)
+        return self.params, blocks()
+
+
+ENGINE_CLASSES = (SapiEngine, EspeakEngine, StubEngine)
+
+def get_audio_cache(max_mb):
+    # cache of spoken WAVs, one entry per chunk of text
+    from calibre_plugins.tts_to_mp3_plugin.cache import DiskCache, plugin_cache_dir
+    return DiskCache(plugin_cache_dir('audio'), max_mb * 1024 * 1024)
+
+def normalize_chunk_text(text):
+    # differences which don't change the spoken audio don't change the cache key
+    import unicodedata
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+def audio_cache_key(engine, text):
+    # anything which changes the spoken audio must be part of the key
+    from calibre_plugins.tts_to_mp3_plugin.cache import hash_key
+    return hash_key('audio', engine.name, engine.version, engine.get_current_voice(),
+                    engine.get_current_rate(), normalize_chunk_text(text))
+
+def engine_class(name):
+    for cls in ENGINE_CLASSES:
+        if cls.name == name:
+            return cls
+    raise KeyError('Unknown TTS engine: %s' % name)
+
+def default_engine_name(preferred=None):
+    # preferred if it can run here (prefs may be shared between computers),
+    # else SAPI on Windows, otherwise espeak-ng if installed, otherwise the stub
+    for cls in ENGINE_CLASSES:
+        if cls.name == preferred and cls.is_available():
+            return preferred
+    for cls in ENGINE_CLASSES:
+        if cls.is_available():
+            return cls.name
+    return ENGINE_STUB
+
+def available_engines():
+    # list of (name, description) for the engines that can run on this computer
+    return [(cls.name, cls.description) for cls in ENGINE_CLASSES if cls.is_available()]
+
+def get_engine(name=None):
+    ''' Create an engine instance
+        :name: one of ENGINE_SAPI, ENGINE_ESPEAK, ENGINE_STUB. None for the platform default
+    '''
+    return engine_class(name or default_engine_name())()
+
+class VoiceCatalog(object):
+    ''' The voices of one engine, asked for once per process
+        Voices are indexed by id, description and language, and sorted_descs is the
+        list shown in the voice combo boxes
+        Engine instances are handed out by acquire() and given back by release(), so
+        dialogs and voice previews reuse an instance (an ISpVoice for SAPI) instead of
+        creating a new one each time
+    '''
+
+    def __init__(self, engine_name):
+        self.engine_name = engine_name
+        self.idle = []
+        self.lock = Lock()
+        engine = self.acquire()
+        try:
+            self.voices = list(engine.get_all_voices())
+        finally:
+            self.release(engine)
+        self.by_id = {}
+        self.by_desc = {}
+        self.by_language = {}
+        for voice in self.voices:
+            self.by_id.setdefault(voice['id'], voice)
+            self.by_desc.setdefault(voice['description'], voice)
+            self.by_language.setdefault(voice['language'], []).append(voice)
+        # by Language/Gender
+        self.sorted_descs = [desc for (lang, gen, desc) in
+                             sorted((v['language'], v['gender'], v['description']) for v in self.voices)]
+
+    def voice_id(self, desc):
+        # id of the voice with this description, or the first whose description contains it
+        voice = self.by_desc.get(desc)
+        if voice is None and desc:
+            voice = next((v for v in self.voices if desc in v['description']), None)
+        return voice['id'] if voice else None
+
+    def voice_name(self, voice_id):
+        voice = self.by_id.get(voice_id)
+        return voice['name'] if voice else None
+
+    def acquire(self):
+        # an engine instance for the caller's use until release()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return get_engine(self.engine_name)
+
+    def release(self, engine):
+        engine.stop()
+        with self.lock:
+            if len(self.idle) < ENGINE_POOL_SIZE:
+                self.idle.append(engine)
+
+_catalogs = {}
+_catalogs_lock = Lock()
+
+def voice_catalog(name=None):
+    ''' The process's VoiceCatalog of an engine
+        :name: one of ENGINE_SAPI, ENGINE_ESPEAK, ENGINE_STUB. None for the platform default
+    '''
+    name = name or default_engine_name()
+    with _catalogs_lock:
+        catalog = _catalogs.get(name)
+        if catalog is None:
+            catalog = _catalogs[name] = VoiceCatalog(name)
+    return catalog
+
+def parse_espeak_voices(output):
+    ''' Parse the table printed by espeak-ng --voices
+        Pty Language       Age/Gender VoiceName          File                 Other Languages
+         5  af              --/M      Afrikaans          gmw/af
+    '''
+    voices = []
+    for line in output.splitlines()[1:]:
+        cols = line.split()
+        if len(cols) < 5:
+            continue
+        language, age_gender, voice_name, vfile = cols[1], cols[2], cols[3], cols[4]
+        gender = {'M': 'Male', 'F': 'Female'}.get(age_gender.rpartition('/')[2], '')
+        voice_name = voice_name.replace('_', ' ')
+        voices.append({'id': language, 'name': voice_name,
+                       'description': '%s - %s (espeak)' % (voice_name, language),
+                       'language': language, 'gender': gender})
+    return voices
+
+def read_wav_stream_header(f):
+    # read a RIFF/WAVE header up to the start of the data chunk
+    # returns (nchannels, sampwidth, framerate)
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError('TTS engine did not produce a WAV')
+    params = None
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            raise ValueError('TTS engine WAV has no data')
+        chunk_id, size = head[:4], struct.unpack('<I', head[4:])[0]
+        if chunk_id == b'data':
+            if params is None:
+                raise ValueError('TTS engine WAV has no format')
+            return params
+        body = f.read(size + (size & 1))
+        if chunk_id == b'fmt ':
+            nchannels, framerate = struct.unpack('<H', body[2:4])[0], struct.unpack('<I', body[4:8])[0]
+            bits = struct.unpack('<H', body[14:16])[0]
+            params = (nchannels, bits // 8, framerate)
+
+def iter_wav_file(path, size=STREAM_BLOCK, start=0, nframes=None):
+    ''' returns (params, iterator over blocks of PCM bytes) of a WAV file, read as it is used
+        :start, nframes: only this range of audio frames, default all
+    '''
+    w = wave.open(path, 'rb')
+    params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+    frames = max(1, size // (params[0] * params[1]))
+    w.setpos(start)
+    total = w.getnframes() - start if nframes is None else nframes
+    def blocks():
+        remaining = total
+        try:
+            while remaining > 0:
+                block = w.readframes(min(frames, remaining))
+                remaining -= frames
+                if not block:
+                    break
+                yield block
+        finally:
+            w.close()
+    return params, blocks()
+
+def iter_blocks(data, size=STREAM_BLOCK):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
@@ -0,0 +1,320 @@
+import json
+import re
+import traceback
+import zlib
+
+from calibre import detect_ncpus
+from calibre.spell.break_iterator import count_words
+from calibre.utils.localization import canonicalize_lang
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin.cache import DiskCache, plugin_cache_dir, hash_key, hash_file
+
+# bump when a change to the extractor changes its output, to invalidate the text cache
+EXTRACT_VERSION = 1
+# below this many spine files it is quicker to extract in-process
+# than to pay the cost of starting worker processes
+PARALLEL_MIN_FILES = 40
+# number of spine files handed to a worker in one job
+BATCH_MIN_FILES = 10
+
+# elements which start a new paragraph of spoken text
+BLOCK_TAGS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'body', 'caption', 'center',
+    'dd', 'div', 'dl', 'dt', 'figcaption', 'figure', 'footer', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p',
+    'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'])
+# elements whose content is never spoken
+SKIP_TAGS = frozenset(['head', 'script', 'style', 'template'])
+# languages not written with spaces between words need ICU word counting
+ICU_WORDCOUNT_LANGS = frozenset(['zho', 'jpn', 'tha', 'lao', 'khm', 'mya', 'bod'])
+
+WORD_RE = re.compile(r"\w+(?:['\u2019-]\w+)*")
+BR = '\x00'
+
+
+class SpokenTextExtractor(object):
+    ''' Build the spoken text of a parsed (X)HTML file in a single walk of its tree
+        Paragraphs are separated by blank lines, <br/> becomes a line break and
+        optionally <img> alt text is spoken with a prefix. The word count is
+        accumulated as each paragraph is finished. The tree is not modified.
+    '''
+
+    def __init__(self, language=None, img_alt=False, alt_prefix=''):
+        self.language = language
+        lang = canonicalize_lang(language) if language else None
+        self.use_icu = lang in ICU_WORDCOUNT_LANGS
+        self.img_alt = img_alt
+        self.alt_prefix = alt_prefix
+
+    def __call__(self, root):
+        ''' return (text, wordcount) for the <body> of root '''
+        self.blocks, self.parts, self.wordcount = [], [], 0
+        body = None
+        if hasattr(root, 'iterchildren'):
+            for child in root.iterchildren():
+                if local_name(child) == 'body':
+                    body = child
+                    break
+        if body is None:
+            return '', 0
+        
+        # iterative walk so deeply nested files can't hit the recursion limit
+        # each stack entry is (element, closing)
+        stack = [(body, False)]
+        while stack:
+            elem, closing = stack.pop()
+            tag = local_name(elem)
+            if closing:
+                if tag in BLOCK_TAGS:
+                    self.end_block()
+                if elem is not body and elem.tail:
+                    self.parts.append(elem.tail)
+                continue
+                
+            if tag is None or tag in SKIP_TAGS:
+                # comment, processing instruction or unspoken element
+                if elem.tail:
+                    self.parts.append(elem.tail)
+                continue
+                
+            if tag in BLOCK_TAGS:
+                self.end_block()
+            elif tag == 'br':
+                self.parts.append(BR)
+            elif tag == 'img' and self.img_alt:
+                self.parts.append(self.alt_text(elem))
+                
+            if elem.text:
+                self.parts.append(elem.text)
+            stack.append((elem, True))
+            stack.extend((child, False) for child in reversed(elem))
+            
+        self.end_block()
+        return '\n\n'.join(self.blocks), self.wordcount
+
+    def alt_text(self, img):
+        alt = img.get('alt', '').strip()
+        if not alt:
+            return ''
+        # only add prefix if alt text doesn't start with same text
+        if self.alt_prefix and not alt.lower().startswith(self.alt_prefix.lower()):
+            return ' [%s: %s] ' % (self.alt_prefix, alt)
+        return ' [%s] ' % alt
+
+    def end_block(self):
+        if not self.parts:
+            return
+        lines = ''.join(self.parts).split(BR)
+        self.parts = []
+        text = '\n'.join(l for l in (' '.join(line.split()) for line in lines) if l)
+        if text:
+            self.blocks.append(text)
+            if self.use_icu:
+                self.wordcount += count_words(text.replace('.', '. '), self.language)
+            else:
+                self.wordcount += len(WORD_RE.findall(text))
+
+
+def local_name(elem):
+    # None for comments and processing instructions
+    tag = elem.tag
+    if not isinstance(tag, str):
+        return None
+    return tag.rpartition('}')[2].lower()
+
+
+def get_name_text_data(container, name, language, img_alt_show, img_alt_prefix, extractor=None):
+    # extract the text-related fields for a single spine file
+    # these are the slow parts of building each SpineRecord
+    if extractor is None:
+        extractor = SpokenTextExtractor(language, img_alt_show, img_alt_prefix)
+    dict = {}
+    raw_data = container.raw_data(name)
+    dict['sample'] = raw_data[:1000] + '...'
+
+    booktext, wordcount = extractor(container.parsed(name))
+    dict['booktext'] = booktext
+    dict['wordcount'] = wordcount
+    return dict
+
+def get_text_cache(max_mb):
+    # cache of extracted text, word counts and samples, one entry per book
+    return DiskCache(plugin_cache_dir('text'), max_mb * 1024 * 1024)
+
+def text_cache_key(path_to_ebook, language, img_alt_show, img_alt_prefix):
+    # anything which changes the extracted text must be part of the key
+    return hash_key('text', EXTRACT_VERSION, hash_file(path_to_ebook),
+                    language, img_alt_show, img_alt_prefix)
+
+def load_cached_text(cache, key):
+    ''' return {name: data} for a previously extracted book, or None '''
+    raw = cache.get(key)
+    if raw is None:
+        return None
+    return json.loads(zlib.decompress(raw).decode('utf-8'))
+
+def save_cached_text(cache, key, name_data):
+    raw = json.dumps(name_data, ensure_ascii=False).encode('utf-8')
+    cache.put(key, zlib.compress(raw, 6))
+
+def empty_name_text_data(failed=False):
+    # failed marks the placeholder for a name whose text couldn't be extracted
+    data = {'sample': '', 'booktext': '', 'wordcount': 0}
+    if failed:
+        data['failed'] = True
+    return data
+
+def load_spine_text(container, names, language, img_alt_show, img_alt_prefix, callback,
+                    parallel=False, cpus=None, cache=None, abort=None):
+    ''' Text data for each spine name, from the text cache if the book was loaded before
+        :callback: called with (name, data) for every name, in spine sequence
+        :parallel: large books are extracted by a pool of worker processes
+        :abort: optional callable, returns True to stop early
+        If the worker pool fails, the names it hasn't delivered are extracted in this process
+        returns True if every name was delivered, False only if aborted
+    '''
+    aborted = abort if abort is not None else (lambda: False)
+    cache_key = None
+    if cache is not None and cache.enabled:
+        try:
+            cache_key = text_cache_key(container.path_to_ebook, language, img_alt_show, img_alt_prefix)
+            cached = load_cached_text(cache, cache_key)
+        except:
+            traceback.print_exc()
+            cached = None
+        if cached is not None and all(name in cached for name in names):
+            for name in names:
+                callback(name, cached[name])
+            return True
+
+    # placeholders for names which failed are delivered, but never cached
+    results, failed, delivered = {}, [], set()
+    def deliver(name, data):
+        delivered.add(name)
+        if data.get('failed'):
+            failed.append(name)
+        else:
+            results[name] = data
+        callback(name, data)
+
+    if parallel and len(names) >= PARALLEL_MIN_FILES:
+        try:
+            extract_names_parallel(container, names, language, img_alt_show, img_alt_prefix,
+                                   deliver, cpus=cpus, abort=aborted)
+        except:
+            # the names not delivered yet are extracted here instead
+            traceback.print_exc()
+    extractor = None
+    for name in names:
+        if aborted():
+            break
+        if name in delivered:
+            continue
+        if extractor is None:
+            extractor = SpokenTextExtractor(language, img_alt_show, img_alt_prefix)
+        try:
+            data = get_name_text_data(container, name, language, img_alt_show, img_alt_prefix, extractor)
+        except:
+            traceback.print_exc()
+            data = empty_name_text_data(failed=True)
+        deliver(name, data)
+
+    if aborted() or len(results) + len(failed) < len(names):
+        return False
+    if failed:
+        print('Text not extracted, not cached: %s' % ', '.join(failed))
+    elif cache_key is not None:
+        try:
+            save_cached_text(cache, cache_key, results)
+        except:
+            traceback.print_exc()
+    return True
+
+def extract_names_worker(root, opf_path, names, language, img_alt_show, img_alt_prefix):
+    ''' Run in a calibre worker process. Re-open the already unpacked container
+        and extract the text data for a batch of spine names
+        :root: container.root of the unpacked book
+        :opf_path: absolute path to the book's OPF inside root
+        :names: list of spine names to extract
+        returns list of (name, data) in the same sequence as names
+    '''
+    from calibre.ebooks.oeb.polish.container import Container
+    from calibre.utils.logging import default_log
+
+    container = Container(root, opf_path, default_log)
+    extractor = SpokenTextExtractor(language, img_alt_show, img_alt_prefix)
+    results = []
+    for name in names:
+        try:
+            data = get_name_text_data(container, name, language, img_alt_show, img_alt_prefix, extractor)
+        except:
+            traceback.print_exc()
+            data = empty_name_text_data(failed=True)
+        results.append((name, data))
+    return results
+
+def split_batches(names, cpus):
+    # contiguous batches so each worker parses neighbouring files
+    # several batches per cpu so a slow batch doesn't hold up the rest
+    nbatches = max(1, min(cpus * 4, len(names) // BATCH_MIN_FILES))
+    size, extra = divmod(len(names), nbatches)
+    batches, start = [], 0
+    for i in range(nbatches):
+        end = start + size + (1 if i < extra else 0)
+        batches.append(names[start:end])
+        start = end
+    return [b for b in batches if b]
+
+def extract_names_parallel(container, names, language, img_alt_show, img_alt_prefix,
+                           callback, cpus=None, abort=None):
+    ''' Extract text data for names using a pool of calibre worker processes
+        :callback: called with (name, data) for every name, in the same sequence as names
+        :abort: optional callable, returns True to stop early
+        Results from batches that finish out of sequence are held back
+        until all earlier batches are done, so track numbering stays deterministic
+    '''
+    from queue import Empty
+    from calibre.utils.ipc.server import Server
+    from calibre.utils.ipc.job import ParallelJob
+
+    cpus = cpus or detect_ncpus()
+    root = container.root
+    opf_path = container.name_to_abspath(container.opf_name)
+    batches = split_batches(list(names), cpus)
+
+    server = Server(pool_size=cpus)
+    try:
+        for i, batch in enumerate(batches):
+            args = ['calibre_plugins.tts_to_mp3_plugin.extract', 'extract_names_worker',
+                    (root, opf_path, batch, language, img_alt_show, img_alt_prefix)]
+            job = ParallelJob('arbitrary', 'extract:%d' % i, done=None, args=args)
+            job._batch_index = i
+            server.add_job(job)
+
+        done = {}
+        next_batch = 0
+        while next_batch < len(batches):
+            if abort is not None and abort():
+                return
+            try:
+                job = server.changed_jobs_queue.get(True, 0.5)
+            except Empty:
+                continue
+            # A job can 'change' when it is not finished. Ignore these.
+            job.update(consume_notifications=False)
+            if not job.is_finished:
+                continue
+            i = job._batch_index
+            if job.failed or not job.result:
+                print(job.details)
+                done[i] = [(name, empty_name_text_data(failed=True)) for name in batches[i]]
+            else:
+                done[i] = job.result
+            # hand over any batches which are now in sequence
+            while next_batch in done:
+                for name, data in done.pop(next_batch):
+                    callback(name, data)
+                next_batch += 1
+    finally:
+        server.close()
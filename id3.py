@@ -0,0 +1,148 @@
+import os
+import shutil
+import struct
+
+# lame tag option -> ID3v2.3 frame
+TEXT_FRAMES = {
+    'ta': 'TPE1',   # artist
+    'tl': 'TALB',   # album
+    'ty': 'TYER',   # year
+    'tg': 'TCON',   # genre
+    'tt': 'TIT2',   # title
+    'tn': 'TRCK',   # track number
+    }
+
+
+def syncsafe(n):
+    # 4 bytes, 7 bits each
+    return bytes(bytearray(((n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f)))
+
+def unsyncsafe(b):
+    b = bytearray(b)
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+def frame(frame_id, data):
+    return frame_id.encode('ascii') + struct.pack('>I', len(data)) + b'\x00\x00' + data
+
+def text_frame(frame_id, text):
+    # encoding 1 = UTF-16 with BOM
+    return frame(frame_id, b'\x01' + text.encode('utf-16') + b'\x00\x00')
+
+def comment_frame(text):
+    return frame('COMM', b'\x01' + b'eng' + ''.encode('utf-16') + b'\x00\x00' + text.encode('utf-16'))
+
+def picture_frame(image_path):
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    mime = b'image/png' if data[:8] == b'\x89PNG\r\n\x1a\n' else b'image/jpeg'
+    # encoding 0, mime, picture type 3 = front cover, empty description
+    return frame('APIC', b'\x00' + mime + b'\x00' + b'\x03' + b'\x00' + data)
+
+def id3v2_tag(tags):
+    ''' ID3v2.3 tag with the same content lame writes for its tag options
+        :tags: dict of lame tag options, e.g. SpineRecord.lame_tags()
+               ta, tl, ty, tg, tt, tn text, tc comment, ti path to cover image
+    '''
+    frames = []
+    for opt, frame_id in sorted(TEXT_FRAMES.items()):
+        val = tags.get(opt)
+        if val:
+            frames.append(text_frame(frame_id, str(val)))
+    if tags.get('tc'):
+        frames.append(comment_frame(tags['tc']))
+    if tags.get('ti') and os.path.exists(tags['ti']):
+        frames.append(picture_frame(tags['ti']))
+    body = b''.join(frames)
+    return b'ID3\x03\x00\x00' + syncsafe(len(body)) + body
+
+def audio_span(data):
+    ''' (start, end) of the MP3 frames in data, without any ID3v2 tag at the
+        start or ID3v1 tag at the end
+    '''
+    start, end = 0, len(data)
+    if data[:3] == b'ID3' and len(data) >= 10:
+        start = 10 + unsyncsafe(data[6:10])
+        if bytearray(data[5:6])[0] & 0x10:
+            # footer present
+            start += 10
+    if end - start >= 128 and data[end-128:end-125] == b'TAG':
+        end -= 128
+    return start, end
+
+def read_frames(f):
+    ''' The frames of the ID3v2 tag at the start of an open MP3 file
+        Leaves f at the first byte after the tag
+        returns (major version, list of (frame id, raw frame)), (3, []) if there is no tag
+    '''
+    header = f.read(10)
+    if header[:3] != b'ID3' or len(header) < 10:
+        f.seek(0)
+        return 3, []
+    major, flags = bytearray(header[3:4])[0], bytearray(header[5:6])[0]
+    if major not in (3, 4) or flags & 0x80:
+        # unsynchronised tags are never written by lame or id3v2_tag()
+        raise ValueError('ID3v2.%d tag with flags %#x is not supported' % (major, flags))
+    body = f.read(unsyncsafe(header[6:10]))
+    if flags & 0x10:
+        # footer
+        f.read(10)
+    pos = 0
+    if flags & 0x40:
+        # extended header, its size includes itself in v2.4 only
+        pos = unsyncsafe(body[:4]) if major == 4 else 4 + struct.unpack('>I', body[:4])[0]
+    frames = []
+    while pos + 10 <= len(body) and body[pos:pos+1] != b'\x00':
+        size = unsyncsafe(body[pos+4:pos+8]) if major == 4 else struct.unpack('>I', body[pos+4:pos+8])[0]
+        frames.append((body[pos:pos+4].decode('ascii', 'replace'), body[pos:pos+10+size]))
+        pos += 10 + size
+    return major, frames
+
+def update_id3v1(f, tags, replace):
+    ''' Update the fields of an ID3v1 tag at the end of a file open for update
+        Only title (tt) and track number (tn) are replaced, as in replace_text_frames()
+    '''
+    f.seek(0, os.SEEK_END)
+    if f.tell() < 128:
+        return
+    f.seek(-128, os.SEEK_END)
+    tag = bytearray(f.read(128))
+    if tag[:3] != b'TAG':
+        return
+    if 'tt' in replace and tags.get('tt'):
+        # 30 bytes, latin-1 padded with NULs
+        tag[3:33] = str(tags['tt']).encode('latin-1', 'replace')[:30].ljust(30, b'\x00')
+    if 'tn' in replace and str(tags.get('tn', '')).isdigit() and int(tags['tn']) < 256:
+        # ID3v1.1: a NUL then the track number in the last two bytes of the comment
+        tag[125], tag[126] = 0, int(tags['tn'])
+    f.seek(-128, os.SEEK_END)
+    f.write(bytes(tag))
+
+def replace_text_frames(path, tags, replace=('tt', 'tn')):
+    ''' Rewrite the tags of an MP3 with some text frames replaced, e.g. after it is renumbered
+        The other frames of an ID3v2 tag (cover, comment, ...) and the audio are copied as they
+        are. A file with no ID3v2 tag gets one with all of tags. An ID3v1 tag (lame.exe adds
+        one) is updated too
+        :tags: dict of lame tag options of the track, e.g. SpineRecord.lame_tags()
+        :replace: the lame tag options to replace in an existing tag
+    '''
+    tmp = path + '.tmp'
+    with open(path, 'rb') as f:
+        major, frames = read_frames(f)
+        if frames:
+            texts = {TEXT_FRAMES[opt]: tags[opt] for opt in replace if tags.get(opt)}
+            new_frames = [raw for frame_id, raw in frames if frame_id not in texts]
+            for frame_id, text in sorted(texts.items()):
+                raw = text_frame(frame_id, str(text))
+                if major == 4:
+                    # v2.4 frame sizes are syncsafe
+                    raw = raw[:4] + syncsafe(len(raw) - 10) + raw[8:]
+                new_frames.append(raw)
+            body = b''.join(new_frames)
+            header = b'ID3' + bytes(bytearray((major, 0, 0))) + syncsafe(len(body)) + body
+        else:
+            header = id3v2_tag(tags)
+        with open(tmp, 'w+b') as out:
+            out.write(header)
+            shutil.copyfileobj(f, out)
+            update_id3v1(out, tags, replace)
+    os.replace(tmp, path)
@@ -0,0 +1,790 @@
+import os
+import time
+import traceback
+from queue import Queue, Empty
+
+from calibre.utils.ipc.server import Server
+from calibre.utils.ipc.job import ParallelJob
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+from calibre_plugins.tts_to_mp3_plugin.progress import (RenderProgress, audio_seconds, format_seconds,
+    TRACK_SPEAKING, TRACK_SPOKEN, TRACK_ENCODING, TRACK_ENCODED, TRACK_DONE, TRACK_FAILED)
+from calibre_plugins.tts_to_mp3_plugin.tracing import (JobTrace,
+    SPAN_EXTRACT, SPAN_SYNTH, SPAN_JOIN, SPAN_ENCODE, SPAN_COPY, SPAN_TRACK)
+
+
+class TrackState(object):
+    ''' master side bookkeeping for one track: its chunk files and which are done
+        Chunks are WAVs, or MP3 pieces when the audio is streamed to the encoder
+    '''
+    def __init__(self, record, djobmeta, ranges, text_hash):
+        from calibre_plugins.tts_to_mp3_plugin.utils import mp3_work_file_name
+        from calibre_plugins.tts_to_mp3_plugin.engines import engine_class, default_engine_name
+        self.record = record
+        self.djobmeta = djobmeta
+        self.ranges = ranges
+        self.text_hash = text_hash
+        self.stream = bool(djobmeta.get('stream_audio'))
+        # the engine speaks to a temp WAV before streaming it to the encoder, e.g. SAPI
+        self.records_to_file = engine_class(djobmeta.get('tts_engine') or default_engine_name()).records_to_file
+        # the finished track MP3, before it is moved or copied to the MP3 dir
+        self.mp3_file = mp3_work_file_name(record, djobmeta)
+        dest_dir = djobmeta['dest_dir']
+        if len(ranges) == 1:
+            # a single chunk is written straight to the track WAV or tagged MP3
+            self.chunk_files = [self.mp3_file if self.stream else record.wav_file_name(dest_dir)]
+        else:
+            ext = 'mp3' if self.stream else 'wav'
+            self.chunk_files = [os.path.join(dest_dir, '%s.part%03d.%s' % (record.safe_filename, i, ext))
+                                for i in range(len(ranges))]
+        # approximate words of each chunk, to estimate its size
+        self.chunk_words = [record.wordcount * length // max(1, record.text_length) for offset, length in ranges]
+        # the rounding goes to the last chunk, so the chunks add up to the track
+        self.chunk_words[-1] += max(0, record.wordcount - sum(self.chunk_words))
+        self.pending = len(ranges)
+        # a chunk has been let into the spool, see JobMaster.admit_chunk()
+        self.started = False
+        self.start_time = None
+        self.errmsg = None
+        # MP3 segments of the track WAV, when it is encoded in parallel
+        self.segment_files = []
+
+def track_chunk_ranges(text, record, chunk_words):
+    # (offset, length) in the text store of each chunk of this track's text
+    from calibre_plugins.tts_to_mp3_plugin.chunker import chunk_byte_ranges
+    if not chunk_words:
+        return [(record.text_offset, record.text_length)]
+    return chunk_byte_ranges(text, record.text_offset, chunk_words) or [(record.text_offset, record.text_length)]
+
+def copy_size(work):
+    # bytes the copier has to write for a work item
+    track, src, dst = work
+    try:
+        return os.path.getsize(src)
+    except EnvironmentError:
+        return 0
+
+# stage names of the job pipeline
+STAGE_SYNTH = 'synth'
+STAGE_ENCODE = 'encode'
+STAGE_COPY = 'copy'
+
+# how far copying to an MP3 dir on another device may fall behind encoding
+COPY_MAX_BYTES = 256 * 1024 * 1024
+
+# first guess at the size of a spoken chunk, until some have been measured:
+# 16 bit 22 kHz WAV, or 128 kbit/s MP3, at about 160 words a minute
+WAV_BYTES_PER_WORD = 17000
+MP3_BYTES_PER_WORD = 6000
+
+
+class JobMaster(object):
+    ''' Runs the stages of every track of a job as a pipeline:
+        chunk WAVs (child jobs) -> joined track WAV -> MP3 (child job) -> copy to MP3 dir (thread)
+        or, when djobmeta['stream_audio'] is set, with no WAVs at all:
+        chunk MP3s spoken straight into the encoder (child jobs) -> joined track MP3 -> copy
+        A long track WAV is encoded as segments split at pauses (child jobs), then joined
+        Every chunk is a unit of work queued longest track first; child jobs are started
+        by a StageScheduler as workers become free, so no more than cpus run at once,
+        encoding is preferred over synthesis, and synthesis pauses while cpus tracks
+        are waiting to be encoded. So track N is encoded and copied while track N+1
+        is being spoken
+        Each finished stage is written to the job's journal, so a job started again
+        with the same args (resumed) picks up from the last finished stage of each track
+        Every WAV and MP3 piece written in the job dir is accounted for in a Spool:
+        a track is only started when its first chunk's estimated size fits in the disk
+        budget shared by all running jobs, and each file is deleted as soon as its
+        readers are done
+    '''
+
+    def __init__(self, server, bad_files, notification, cpus, spool_bytes=0):
+        from calibre_plugins.tts_to_mp3_plugin.pipeline import StageScheduler, ThreadStage
+        from calibre_plugins.tts_to_mp3_plugin.spool import Spool
+
+        self.server = server
+        self.bad_files = bad_files
+        self.good_files = []
+        self.notification = notification
+        self.scheduler = StageScheduler(cpus)
+        self.scheduler.add_stage(STAGE_SYNTH, admit=self.admit_chunk)
+        self.scheduler.add_stage(STAGE_ENCODE, backlog_limit=self.scheduler.slots)
+        self.results = Queue()
+        # copying to an MP3 dir on another device runs behind encoding, up to COPY_MAX_BYTES
+        self.copier = ThreadStage(STAGE_COPY, self.copy_worker, self.results, maxsize=0,
+                                  max_bytes=COPY_MAX_BYTES, size=copy_size)
+        self.copier.start()
+        self.total = 0
+        self.count = 0
+        self.journals = {}
+        self.manifests = {}
+        self.spool = Spool('%d-%f' % (os.getpid(), time.time()), spool_bytes)
+        # measured (bytes, words) of spoken chunks, by stream mode
+        self.chunk_sizes = {True: [0, 0], False: [0, 0]}
+        self.progress = None
+        self.trace = JobTrace()
+
+    def journal(self, djobmeta):
+        # one journal per job dir (dest_dir)
+        from calibre_plugins.tts_to_mp3_plugin.journal import JobJournal
+        job_dir = djobmeta['dest_dir']
+        if job_dir not in self.journals:
+            self.journals[job_dir] = JobJournal(job_dir)
+        return self.journals[job_dir]
+
+    def manifest(self, mp3_dir):
+        from calibre_plugins.tts_to_mp3_plugin.manifest import load_manifest, new_manifest
+        if mp3_dir not in self.manifests:
+            self.manifests[mp3_dir] = load_manifest(mp3_dir) or new_manifest()
+        return self.manifests[mp3_dir]
+
+    def start(self, files_to_proc):
+        from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+        from calibre_plugins.tts_to_mp3_plugin.textstore import TextStore
+        from calibre_plugins.tts_to_mp3_plugin.manifest import text_hash
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_CHUNK
+
+        self.total = len(files_to_proc)
+        # longest tracks first, so the short ones fill the pool at the end instead of
+        # one long track being spoken alone. The sort is stable, so equal tracks keep
+        # their order and each track's chunks are queued together
+        records = [(SpineRecord.from_job_state(state), state, djobmeta) for state, djobmeta in files_to_proc]
+        records.sort(key=lambda item: item[0].wordcount, reverse=True)
+        self.progress = RenderProgress(sum(record.wordcount for record, state, djobmeta in records), self.total)
+        stores = {}
+        try:
+            for record, state, djobmeta in records:
+                store_path = djobmeta['text_store']
+                if store_path not in stores:
+                    stores[store_path] = TextStore(store_path)
+                    # once per book
+                    cover_file = djobmeta.get('cover_file')
+                    if cover_file and os.path.exists(cover_file):
+                        self.copy_file(cover_file, os.path.join(djobmeta['mp3_dir'], os.path.basename(cover_file)))
+                text = stores[store_path].text(record.text_offset, record.text_length)
+                ranges = track_chunk_ranges(text, record, djobmeta.get('chunk_words'))
+                track = TrackState(record, djobmeta, ranges, text_hash(text))
+                journal = self.journal(djobmeta)
+                if self.past_chunk_stage(track):
+                    # the chunk files are gone, but aren't needed any more
+                    track.pending = 0
+                    self.progress.skipped(record.wordcount)
+                for i, (offset, length) in enumerate(ranges):
+                    if not track.pending:
+                        break
+                    if journal.is_done(record.name, STAGE_CHUNK, i) and os.path.exists(track.chunk_files[i]):
+                        self.spool.force(track.chunk_files[i])
+                        self.progress.skipped(track.chunk_words[i])
+                        track.pending -= 1
+                        continue
+                    if track.stream:
+                        args = ['calibre_plugins.tts_to_mp3_plugin.jobs', 'do_chunk_mp3_worker',
+                                (state, djobmeta, offset, length, track.chunk_files[i], len(ranges) == 1)]
+                    else:
+                        args = ['calibre_plugins.tts_to_mp3_plugin.jobs', 'do_chunk_wav_worker',
+                                (state, djobmeta, offset, length, track.chunk_files[i])]
+                    self.scheduler.push(STAGE_SYNTH, (track, args, '%s.%d' % (record.pad_track, i), i))
+                if not track.pending:
+                    # every chunk was already done by an earlier run of this job
+                    self.chunks_finished(track)
+        finally:
+            for store in stores.values():
+                store.close()
+
+    def past_chunk_stage(self, track):
+        # True if an earlier run of this job already has the track WAV, its MP3 segments, MP3 or copied MP3
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_WAV, STAGE_MP3, STAGE_COPIED
+        record, djobmeta = track.record, track.djobmeta
+        journal = self.journal(djobmeta)
+        return (journal.is_done(record.name, STAGE_COPIED) and os.path.exists(record.mp3_file_name(djobmeta['mp3_dir']))) or \
+               (journal.is_done(record.name, STAGE_MP3) and os.path.exists(track.mp3_file)) or \
+               bool(self.encoded_segments(track)) or \
+               (journal.is_done(record.name, STAGE_WAV) and os.path.exists(record.wav_file_name(djobmeta['dest_dir'])))
+
+    def segment_file_names(self, track, nsegments):
+        record, djobmeta = track.record, track.djobmeta
+        return [os.path.join(djobmeta['dest_dir'], '%s.seg%03d.mp3' % (record.safe_filename, i))
+                for i in range(nsegments)]
+
+    def encoded_segments(self, track):
+        ''' The MP3 segment files of a track if an earlier run encoded every one of them, else None
+            The track WAV is deleted once the last segment is encoded, so a job stopped
+            before the segments were joined can only carry on from these
+        '''
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_SPLIT, STAGE_SEGMENT
+        journal = self.journal(track.djobmeta)
+        nsegments = journal.index(track.record.name, STAGE_SPLIT)
+        if not nsegments:
+            return None
+        segment_files = self.segment_file_names(track, nsegments)
+        for i, segment_file in enumerate(segment_files):
+            if not (journal.is_done(track.record.name, STAGE_SEGMENT, i) and os.path.exists(segment_file)):
+                return None
+        return segment_files
+
+    def admit_chunk(self, work):
+        # reserve spool space for a chunk before it is spoken
+        # No chunk is freed until every chunk of its track is spoken, so the budget only
+        # decides when a track may start; the rest of a started track is always admitted
+        track, args, desc, chunk = work
+        sizes = self.chunk_sizes[track.stream]
+        if sizes[1]:
+            per_word = float(sizes[0]) / sizes[1]
+        else:
+            per_word = MP3_BYTES_PER_WORD if track.stream else WAV_BYTES_PER_WORD
+        nbytes = int(per_word * track.chunk_words[chunk])
+        if track.stream and track.records_to_file:
+            # the engine's temp WAV is in the job dir until the chunk's MP3 is done
+            nbytes += int(WAV_BYTES_PER_WORD * track.chunk_words[chunk])
+        if track.started:
+            self.spool.force(track.chunk_files[chunk], nbytes)
+            return True
+        if not self.spool.try_reserve(track.chunk_files[chunk], nbytes):
+            return False
+        track.started = True
+        track.start_time = time.time()
+        self.track_stage(track, TRACK_SPEAKING)
+        return True
+
+    def track_stage(self, track, stage):
+        # log each stage a track reaches, with the job's progress so far
+        record = track.record
+        print('{0} Track {1} ({2}): {3}. {4}'.format(time.strftime('%H:%M:%S'), record.pad_track,
+                record.name, stage, self.progress.message()))
+
+    def trace_span(self, track, stage, name, start, path):
+        # a step the master (or copier thread) did for a track, which wrote path
+        from calibre_plugins.tts_to_mp3_plugin.spool import file_size
+        record = track.record
+        self.trace.add(track.djobmeta, stage, '%s %s' % (record.pad_track, name), start, time.time(),
+                       track=record.pad_track, file=record.name, bytes=file_size(path))
+
+    def trace_job(self, job, stage, name, path, **args):
+        # a child job: from when the server started it, else from when it was queued
+        from calibre_plugins.tts_to_mp3_plugin.spool import file_size
+        record = job._track.record
+        start = job.start_time or job._queued
+        end = start + job.duration if job.duration is not None else time.time()
+        args.update(track=record.pad_track, file=record.name, bytes=file_size(path),
+                    waited_ms=int(1000 * max(0, start - job._queued)), ok=not job.failed)
+        self.trace.add(job._track.djobmeta, stage, '%s %s' % (record.pad_track, name), start, end, **args)
+
+    def start_jobs(self):
+        # start as much queued work as the scheduler allows
+        while True:
+            work = self.scheduler.next_work()
+            if work is None:
+                break
+            stage, (track, args, desc, chunk) = work
+            job = ParallelJob('arbitrary', desc, done=None, args=args)
+            job._track = track
+            job._chunk = chunk
+            job._stage = stage
+            job._queued = time.time()
+            self.server.add_job(job)
+
+    def run(self):
+        try:
+            while not (self.scheduler.idle and not self.copier.outstanding):
+                self.spool.touch()
+                self.start_jobs()
+                self.progress.notify(self.notification)
+                # dequeue the job results as they arrive
+                # poll, so copies finished by the copier thread are seen too
+                try:
+                    job = self.server.changed_jobs_queue.get(timeout=0.1)
+                except Empty:
+                    job = None
+                if job is not None:
+                    # A job can 'change' when it is not finished, for example if it
+                    # produces a notification. Ignore these.
+                    job.update()
+                    if job.is_finished:
+                        self.scheduler.finished(job._stage)
+                        self.job_finished(job)
+                while True:
+                    try:
+                        stage, (track, src, dst), ok, result = self.results.get_nowait()
+                    except Empty:
+                        break
+                    self.copier.done()
+                    self.copy_finished(track, ok, result, dst)
+        finally:
+            self.copier.close()
+            for journal in self.journals.values():
+                journal.close()
+            print(self.spool.report())
+            self.spool.close()
+            self.trace.save()
+            if self.progress is not None:
+                print('Spoke {0} words in {1}: {2}'.format(self.progress.words_spoken,
+                      format_seconds(self.progress.elapsed()), self.progress.message()))
+        return self.good_files, self.bad_files
+
+    def job_finished(self, job):
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_CHUNK, STAGE_SEGMENT, STAGE_MP3
+
+        track = job._track
+        record = track.record
+        ok, restext = False, '%s:Unknown error' % PLUGIN_NAME
+        if not job.failed and job.result:
+            ok, restext = job.result
+
+        if job._stage == STAGE_SYNTH:
+            # Add this job's output to the current log
+            print('Logfile for track %s chunk %d of %d (%s)' % (record.pad_track, job._chunk + 1, len(track.ranges), record.name))
+            print(job.details)
+            chunk_file = track.chunk_files[job._chunk]
+            self.trace_job(job, SPAN_SYNTH, 'chunk %d/%d' % (job._chunk + 1, len(track.ranges)), chunk_file,
+                           words=track.chunk_words[job._chunk])
+            if ok:
+                self.journal(track.djobmeta).record(record.name, STAGE_CHUNK, job._chunk)
+                self.progress.spoken(track.chunk_words[job._chunk], audio_seconds(chunk_file, track.stream))
+                self.spool.resize(chunk_file)
+                sizes = self.chunk_sizes[track.stream]
+                sizes[0] += self.spool.sizes.get(chunk_file, 0)
+                sizes[1] += track.chunk_words[job._chunk]
+            else:
+                self.progress.skipped(track.chunk_words[job._chunk])
+                self.spool.consume(chunk_file)
+                if track.errmsg is None:
+                    track.errmsg = restext
+            track.pending -= 1
+            if not track.pending:
+                self.chunks_finished(track)
+        elif job._chunk is not None:
+            print('Logfile for track %s MP3 segment %d of %d (%s)' % (record.pad_track, job._chunk + 1, len(track.segment_files), record.name))
+            print(job.details)
+            self.trace_job(job, SPAN_ENCODE, 'segment %d/%d' % (job._chunk + 1, len(track.segment_files)),
+                           track.segment_files[job._chunk])
+            if ok:
+                self.journal(track.djobmeta).record(record.name, STAGE_SEGMENT, job._chunk)
+                self.spool.force(track.segment_files[job._chunk])
+                # each segment holds a reference to the track WAV
+                self.spool.consume(record.wav_file_name(track.djobmeta['dest_dir']))
+            elif track.errmsg is None:
+                track.errmsg = restext
+            track.pending -= 1
+            if not track.pending:
+                self.segments_finished(track)
+        else:
+            print('Logfile for track %s MP3 (%s)' % (record.pad_track, record.name))
+            print(job.details)
+            self.trace_job(job, SPAN_ENCODE, 'MP3', track.mp3_file)
+            if ok:
+                self.journal(track.djobmeta).record(record.name, STAGE_MP3)
+                self.spool.consume(record.wav_file_name(track.djobmeta['dest_dir']))
+                self.track_stage(track, TRACK_ENCODED)
+                self.spool_mp3(track)
+                self.copy_mp3(track)
+            else:
+                self.track_finished(track, False, restext)
+
+    def chunks_finished(self, track):
+        # all chunks of a track are done: join them and queue the MP3 encode, or copy the streamed MP3
+        from calibre_plugins.tts_to_mp3_plugin.utils import join_wavs
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_WAV, STAGE_MP3, STAGE_COPIED
+
+        if track.errmsg is not None:
+            return self.track_finished(track, False, track.errmsg)
+        record, djobmeta = track.record, track.djobmeta
+        if track.started:
+            self.track_stage(track, TRACK_SPOKEN)
+        journal = self.journal(djobmeta)
+        if journal.is_done(record.name, STAGE_COPIED) and \
+                os.path.exists(record.mp3_file_name(djobmeta['mp3_dir'])):
+            return self.track_finished(track, True, 'MP3 created (earlier run)', resumed=True)
+        if journal.is_done(record.name, STAGE_MP3) and os.path.exists(track.mp3_file):
+            return self.copy_mp3(track)
+        if track.stream:
+            return self.join_streamed_mp3(track)
+        segment_files = self.encoded_segments(track)
+        if segment_files:
+            track.segment_files = segment_files
+            track.pending = 0
+            for segment_file in segment_files:
+                self.spool.force(segment_file)
+            return self.segments_finished(track)
+
+        wav_file_name = record.wav_file_name(djobmeta['dest_dir'])
+        if not (journal.is_done(record.name, STAGE_WAV) and os.path.exists(wav_file_name)):
+            try:
+                if len(track.chunk_files) > 1:
+                    start = time.time()
+                    join_wavs(track.chunk_files, wav_file_name)
+                    self.trace_span(track, SPAN_JOIN, 'WAV', start, wav_file_name)
+                    for chunk_file in track.chunk_files:
+                        self.spool.consume(chunk_file)
+                    self.spool.force(wav_file_name)
+                journal.record(record.name, STAGE_WAV)
+            except:
+                traceback.print_exc()
+                return self.track_finished(track, False, 'WAV chunks not joined')
+        self.queue_encode(track)
+
+    def queue_encode(self, track):
+        ''' Queue the MP3 encode of a track WAV
+            A long track is split at pauses into segments which are encoded at the same
+            time, so one long chapter doesn't leave the other cpus idle
+        '''
+        import wave
+        from calibre_plugins.tts_to_mp3_plugin.silence import segment_ranges
+        from calibre_plugins.tts_to_mp3_plugin.mpeg import overlap_ranges
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_SEGMENT, STAGE_SPLIT
+
+        record, djobmeta = track.record, track.djobmeta
+        wav_file_name = record.wav_file_name(djobmeta['dest_dir'])
+        self.track_stage(track, TRACK_ENCODING)
+        journal = self.journal(djobmeta)
+        segments = None
+        # a resumed job splits the WAV as before, so the segments it encoded still fit
+        nsegments = journal.index(record.name, STAGE_SPLIT) or self.scheduler.slots
+        if djobmeta.get('parallel_encode') and nsegments > 1:
+            try:
+                segments = segment_ranges(wav_file_name, nsegments)
+                if len(segments) > 1:
+                    with wave.open(wav_file_name, 'rb') as w:
+                        framerate = w.getframerate()
+                    segments = overlap_ranges(segments, framerate)
+            except:
+                traceback.print_exc()
+                segments = None
+        if not segments or len(segments) < 2:
+            self.spool.force(wav_file_name)
+            args = ['calibre_plugins.tts_to_mp3_plugin.jobs', 'do_track_mp3_worker',
+                    (record.job_state(), djobmeta)]
+            self.scheduler.push(STAGE_ENCODE, (track, args, record.pad_track, None))
+            return
+
+        nsamples = segments[-1][0] + segments[-1][1]
+        split = journal.event(record.name, STAGE_SPLIT)
+        if split.get('index') != len(segments) or split.get('samples') != nsamples:
+            journal.record(record.name, STAGE_SPLIT, len(segments), samples=nsamples)
+        track.segment_files = self.segment_file_names(track, len(segments))
+        track.pending = len(segments)
+        for i, (start, nframes, keep) in enumerate(segments):
+            if journal.is_done(record.name, STAGE_SEGMENT, i) and os.path.exists(track.segment_files[i]):
+                self.spool.force(track.segment_files[i])
+                track.pending -= 1
+                continue
+            args = ['calibre_plugins.tts_to_mp3_plugin.jobs', 'do_segment_mp3_worker',
+                    (djobmeta, wav_file_name, start, nframes, track.segment_files[i], keep)]
+            self.scheduler.push(STAGE_ENCODE, (track, args, '%s.seg%d' % (record.pad_track, i), i))
+        if track.pending:
+            # deleted when the last segment has been encoded
+            self.spool.force(wav_file_name, refs=track.pending)
+        else:
+            # every segment was encoded by an earlier run of this job
+            self.spool.consume(wav_file_name)
+            self.segments_finished(track)
+
+    def segments_finished(self, track):
+        # all MP3 segments of a track WAV are done: join them into the track MP3
+        from calibre_plugins.tts_to_mp3_plugin.utils import join_mp3s, encode_tags
+        from calibre_plugins.tts_to_mp3_plugin.id3 import id3v2_tag
+        from calibre_plugins.tts_to_mp3_plugin.mpeg import PREROLL_FRAMES
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_MP3, STAGE_SPLIT
+
+        if track.errmsg is not None:
+            return self.track_finished(track, False, track.errmsg)
+        record, djobmeta = track.record, track.djobmeta
+        try:
+            start = time.time()
+            tag = id3v2_tag(encode_tags(record, djobmeta))
+            nsamples = self.journal(djobmeta).event(record.name, STAGE_SPLIT).get('samples')
+            join_mp3s(track.segment_files, track.mp3_file, tag, preroll=PREROLL_FRAMES, nsamples=nsamples)
+            self.trace_span(track, SPAN_JOIN, 'MP3 segments', start, track.mp3_file)
+        except:
+            traceback.print_exc()
+            return self.track_finished(track, False, 'MP3 segments not joined')
+        for segment_file in track.segment_files:
+            self.spool.consume(segment_file)
+        self.journal(djobmeta).record(record.name, STAGE_MP3)
+        self.track_stage(track, TRACK_ENCODED)
+        self.spool_mp3(track)
+        self.copy_mp3(track)
+
+    def join_streamed_mp3(self, track):
+        # join the MP3 pieces spoken by the chunk jobs, a single chunk is already the tagged track MP3
+        from calibre_plugins.tts_to_mp3_plugin.utils import join_mp3s, encode_tags
+        from calibre_plugins.tts_to_mp3_plugin.id3 import id3v2_tag
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_MP3
+
+        record, djobmeta = track.record, track.djobmeta
+        if len(track.chunk_files) > 1:
+            try:
+                start = time.time()
+                tag = id3v2_tag(encode_tags(record, djobmeta))
+                join_mp3s(track.chunk_files, track.mp3_file, tag)
+                self.trace_span(track, SPAN_JOIN, 'MP3 chunks', start, track.mp3_file)
+            except:
+                traceback.print_exc()
+                return self.track_finished(track, False, 'MP3 chunks not joined')
+            for chunk_file in track.chunk_files:
+                self.spool.consume(chunk_file)
+        self.journal(djobmeta).record(record.name, STAGE_MP3)
+        self.track_stage(track, TRACK_ENCODED)
+        self.spool_mp3(track)
+        self.copy_mp3(track)
+
+    def spool_mp3(self, track):
+        # a track MP3 in the job dir is spooled until it has been copied to the MP3 dir
+        if not track.djobmeta.get('mp3_in_place'):
+            self.spool.force(track.mp3_file)
+
+    def copy_mp3(self, track):
+        ''' Put the finished track MP3 in the MP3 dir
+            An MP3 encoded in place is renamed at once, else it is copied by the copier thread.
+            Blocks while the copier is more than COPY_MAX_BYTES behind
+        '''
+        from calibre_plugins.tts_to_mp3_plugin.utils import move_mp3_to_dir
+        record, djobmeta = track.record, track.djobmeta
+        if djobmeta.get('mp3_in_place'):
+            try:
+                move_mp3_to_dir(record, djobmeta, print)
+            except Exception as err:
+                traceback.print_exc()
+                return self.copy_finished(track, False, str(err))
+            return self.copy_finished(track, True, None)
+        self.copier.put((track, track.mp3_file, record.mp3_file_name(djobmeta['mp3_dir'])))
+
+    def copy_file(self, src, dst):
+        # a file for the MP3 dir which isn't a track, e.g. the cover
+        self.copier.put((None, src, dst))
+
+    def copy_worker(self, work):
+        # runs in the copier thread
+        from calibre_plugins.tts_to_mp3_plugin.utils import place_file
+        track, src, dst = work
+        start = time.time()
+        place_file(src, dst)
+        if track is not None:
+            self.trace_span(track, SPAN_COPY, 'copy', start, dst)
+        print('Copied %s to: %s' % (os.path.basename(dst), os.path.dirname(dst)))
+
+    def copy_finished(self, track, ok, result, dst=None):
+        from calibre_plugins.tts_to_mp3_plugin.journal import STAGE_COPIED
+        if track is None:
+            if not ok:
+                print('*** Not copied: %s: %s' % (dst, result))
+            return
+        if not ok:
+            return self.track_finished(track, False, 'MP3 not copied to %s: %s' % (track.djobmeta.get('mp3_dir'), result))
+        self.journal(track.djobmeta).record(track.record.name, STAGE_COPIED)
+        if not track.djobmeta.get('mp3_in_place'):
+            self.spool.consume(track.mp3_file)
+        self.track_finished(track, True, 'MP3 created')
+
+    def track_finished(self, track, ok, restext, resumed=False):
+        from calibre_plugins.tts_to_mp3_plugin.manifest import save_manifest, track_entry
+
+        record, djobmeta = track.record, track.djobmeta
+        pad_track, name = record.pad_track, record.name
+        book_label = djobmeta.get('book_label')
+        self.count += 1
+        if ok:
+            self.good_files.append((pad_track, name, restext, record.wordcount, book_label,
+                                    djobmeta.get('mp3_dir'), djobmeta.get('container_root'), djobmeta.get('dest_dir')))
+            if not resumed:
+                # save after every track, the manifest is correct even if the job is killed
+                mp3_dir = djobmeta.get('mp3_dir')
+                tracks = self.manifest(mp3_dir)['tracks']
+                old_entry = tracks.get(name)
+                tracks[name] = track_entry(record, djobmeta, track.text_hash)
+                try:
+                    remove_superseded_mp3(mp3_dir, tracks, old_entry)
+                    save_manifest(mp3_dir, self.manifests[mp3_dir])
+                except:
+                    traceback.print_exc()
+        else:
+            self.bad_files.append((pad_track, name, restext, book_label))
+        self.progress.track_done()
+        if track.start_time is not None:
+            self.trace.add(djobmeta, SPAN_TRACK, '%s %s' % (pad_track, name), track.start_time, time.time(),
+                           words=record.wordcount, ok=ok)
+        if not resumed:
+            self.track_stage(track, TRACK_DONE if ok else TRACK_FAILED)
+        self.progress.notify(self.notification, force=True)
+
+def do_book_action_worker(files_to_proc, bad_files, cpus, notification=lambda x, y: x):
+    ''' Master job, runs in the calibre jobs system via arbitrary_n
+        Each track's text is split into chunks at paragraph/sentence boundaries
+        and every chunk is spoken to a WAV by its own child job, so a long chapter
+        is recorded by several engine instances at once on a pool of cpus workers.
+        When all chunks of a track are done they are joined in order and a
+        child job encodes the track to MP3. With djobmeta['stream_audio'] set the
+        chunk jobs pipe their audio straight into lame and no WAV is written
+        Synthesis, encoding and copying overlap, see JobMaster
+        While it runs the job reports words per minute, real-time factor and ETA
+        to the job manager and logs each stage every track reaches
+        With djobmeta['write_trace'] set the time of each stage is saved in the MP3 dir, see tracing.JobTrace
+        Each MP3 created is recorded in the render manifest in its MP3 directory
+        The job args are saved in the job dir (dest_dir) and progress is journalled
+        there, so running this again for the same job dir resumes it
+        :files_to_proc: list of (SpineRecord.job_state(), djobmeta)
+        :bad_files: list of (pad_track, name, errmsg, book_label) already known to be bad
+        returns (good_files, bad_files)
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.journal import save_job
+
+    server = Server(pool_size=cpus)
+
+    # This server is an arbitrary_n job, so there is a notifier available.
+    # Set the % complete to a small number to avoid the 'unavailable' indicator
+    notification(0.01, 'Creating MP3s')
+
+    job_dirs = {}
+    for state, djobmeta in files_to_proc:
+        job_dirs.setdefault(djobmeta['dest_dir'], []).append((state, djobmeta))
+    # text is extracted before the job, so a resumed job has no extract span
+    extract_spans = {}
+    for state, djobmeta in files_to_proc:
+        extract_span = djobmeta.pop('extract_span', None)
+        if extract_span:
+            extract_spans[djobmeta['dest_dir']] = (djobmeta, extract_span)
+    for job_dir, job_files in job_dirs.items():
+        save_job(job_dir, job_files, job_files[0][1].get('book_label'))
+
+    # one budget for the job, the largest any book asked for
+    spool_mb = max(djobmeta.get('spool_mb', 0) for state, djobmeta in files_to_proc) if files_to_proc else 0
+    master = JobMaster(server, bad_files, notification, cpus, spool_bytes=spool_mb * 1024 * 1024)
+    for djobmeta, (start, end, words) in extract_spans.values():
+        master.trace.add(djobmeta, SPAN_EXTRACT, 'text', start, end, words=words)
+    try:
+        master.start(files_to_proc)
+        return master.run()
+    finally:
+        server.close()
+
+def remove_superseded_mp3(mp3_dir, tracks, old_entry):
+    # a track recorded again under a new track number leaves its old MP3 behind
+    if old_entry is None:
+        return
+    old_file = old_entry.get('file')
+    if old_file and old_file not in set(e.get('file') for e in tracks.values()):
+        path = os.path.join(mp3_dir, old_file)
+        if os.path.exists(path):
+            os.remove(path)
+            print('Removed superseded MP3: %s' % path)
+
+def do_chunk_wav_worker(state, djobmeta, offset, length, wav_file_name):
+    ''' Child job: speak one chunk of a track's text to a WAV
+        :state: SpineRecord.job_state() for the track
+        :offset, length: the chunk's position in the book's memory-mapped text store
+        returns (ok, message)
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.engines import get_engine, get_audio_cache
+    from calibre_plugins.tts_to_mp3_plugin.textstore import TextStore
+    from calibre_plugins.tts_to_mp3_plugin.utils import create_single_wav
+    from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+    from calibre_plugins.tts_to_mp3_plugin.chunker import count_chunk_words
+
+    try:
+        record = SpineRecord.from_job_state(state)
+        with TextStore(djobmeta['text_store']) as store:
+            booktext = store.text(offset, length)
+
+        engine = get_engine(djobmeta.get('tts_engine'))
+        engine.set_current_voice(djobmeta.get('voice_id'))
+        engine.set_current_rate(djobmeta.get('voice_rate', 0))
+        engine.temp_dir = djobmeta['dest_dir']
+
+        cache = get_audio_cache(djobmeta.get('audio_cache_mb', 0))
+        try:
+            create_single_wav(record, djobmeta, booktext, engine, print,
+                              wav_file_name=wav_file_name, words=count_chunk_words(booktext), cache=cache)
+        finally:
+            cache.close()
+        if os.path.exists(wav_file_name):
+            return True, 'WAV created'
+        return False, 'WAV not created'
+    except:
+        traceback.print_exc()
+        return False, traceback.format_exc().strip().splitlines()[-1]
+
+def do_chunk_mp3_worker(state, djobmeta, offset, length, mp3_file_name, tagged):
+    ''' Child job: speak one chunk of a track's text straight into the MP3 encoder
+        :state: SpineRecord.job_state() for the track
+        :offset, length: the chunk's position in the book's memory-mapped text store
+        :tagged: True if the chunk is the whole track, else an untagged piece to be joined
+        returns (ok, message)
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.engines import get_engine, get_audio_cache
+    from calibre_plugins.tts_to_mp3_plugin.textstore import TextStore
+    from calibre_plugins.tts_to_mp3_plugin.utils import create_chunk_mp3
+    from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+    from calibre_plugins.tts_to_mp3_plugin.chunker import count_chunk_words
+
+    try:
+        record = SpineRecord.from_job_state(state)
+        with TextStore(djobmeta['text_store']) as store:
+            booktext = store.text(offset, length)
+
+        engine = get_engine(djobmeta.get('tts_engine'))
+        engine.set_current_voice(djobmeta.get('voice_id'))
+        engine.set_current_rate(djobmeta.get('voice_rate', 0))
+        engine.temp_dir = djobmeta['dest_dir']
+
+        cache = get_audio_cache(djobmeta.get('audio_cache_mb', 0))
+        try:
+            ok = create_chunk_mp3(record, djobmeta, booktext, engine, print, mp3_file_name, tagged=tagged,
+                                  words=count_chunk_words(booktext), cache=cache)
+        finally:
+            cache.close()
+        if ok:
+            return True, 'MP3 created'
+        return False, 'MP3 not created'
+    except:
+        traceback.print_exc()
+        return False, traceback.format_exc().strip().splitlines()[-1]
+
+def do_track_mp3_worker(state, djobmeta):
+    ''' Child job: encode a track's joined WAV to MP3 in the job dir
+        The master copies it to the MP3 directory, as a separate journalled stage
+        :state: SpineRecord.job_state() for the track
+        returns (ok, message)
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.utils import create_single_mp3
+    from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+
+    try:
+        record = SpineRecord.from_job_state(state)
+        if create_single_mp3(record, djobmeta, djobmeta.get('lame_path'), print, copy_to_mp3_dir=False):
+            return True, 'MP3 created'
+        return False, 'MP3 not created'
+    except:
+        traceback.print_exc()
+        return False, traceback.format_exc().strip().splitlines()[-1]
+
+def do_segment_mp3_worker(djobmeta, wav_file_name, start, nframes, mp3_file_name, keep=None):
+    ''' Child job: encode one segment of a track WAV to an untagged MP3, see JobMaster.queue_encode()
+        :start, nframes: the segment's audio frames in the WAV, incl. its pre-roll and post-roll
+        :keep: MP3 frames to keep, the post-roll frames after them are dropped. None for all
+        returns (ok, message)
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.encoders import get_encoder
+    from calibre_plugins.tts_to_mp3_plugin.engines import iter_wav_file
+    from calibre_plugins.tts_to_mp3_plugin.utils import truncate_mp3
+
+    try:
+        encoder = get_encoder(djobmeta.get('mp3_encoder'), djobmeta.get('lame_path'))
+        params, blocks = iter_wav_file(wav_file_name, start=start, nframes=nframes)
+        if encoder.encode(params, blocks, mp3_file_name, None) and os.path.exists(mp3_file_name):
+            if keep is not None:
+                truncate_mp3(mp3_file_name, keep)
+            print('Created MP3 segment: %s' % mp3_file_name)
+            return True, 'MP3 segment created'
+        return False, 'MP3 segment not created'
+    except:
+        traceback.print_exc()
+        return False, traceback.format_exc().strip().splitlines()[-1]
+
+def get_job_details(job):
+    ''' Convert the job result into good_files, bad_files and a details message '''
+    good_files, bad_files = [], []
+    if job.result:
+        good_files, bad_files = job.result
+    det_msg = []
+    for pad_track, name, errmsg, book_label in bad_files:
+        det_msg.append('%s %s: %s' % (pad_track, name, errmsg))
+    return good_files, bad_files, '\n'.join(det_msg)
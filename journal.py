@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin.cache import plugin_cache_dir
+
+# job args, so an interrupted job can be started again
+JOB_FILENAME = 'job.json'
+# one line per finished stage of a track
+JOURNAL_FILENAME = 'journal.log'
+
+# stages of a track, in order
+STAGE_CHUNK = 'chunk'       # one chunk WAV (or MP3 when streaming) spoken, index = chunk number
+STAGE_WAV = 'wav'           # chunk WAVs joined into the track WAV, not used when streaming
+STAGE_SPLIT = 'split'       # track WAV split for parallel encoding, index = number of segments, samples = its length
+STAGE_SEGMENT = 'segment'   # one segment of a long track WAV encoded, index = segment number
+STAGE_MP3 = 'mp3'           # track encoded to MP3 in the job dir
+STAGE_COPIED = 'copied'     # MP3 copied to the MP3 directory, track finished
+
+
+def jobs_root():
+    return plugin_cache_dir('jobs')
+
+def create_job_dir():
+    ''' Working dir for one book's job (text store, WAVs, MP3s, journal)
+        Unlike a calibre temp dir it survives restarting calibre, so the job can be resumed
+    '''
+    return tempfile.mkdtemp(prefix=time.strftime('%Y%m%d-%H%M%S_'), dir=jobs_root())
+
+def save_job(job_dir, files_to_proc, book_label):
+    path = os.path.join(job_dir, JOB_FILENAME)
+    if os.path.exists(path):
+        return
+    job = {'book_label': book_label, 'created': time.time(),
+           'files_to_proc': [[list(state), djobmeta] for state, djobmeta in files_to_proc]}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(job, ensure_ascii=False).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load_job(job_dir):
+    # returns the job dict, files_to_proc as (state, djobmeta) tuples, or None
+    try:
+        with open(os.path.join(job_dir, JOB_FILENAME), 'rb') as f:
+            job = json.loads(f.read().decode('utf-8'))
+    except (EnvironmentError, ValueError):
+        return None
+    job['files_to_proc'] = [(tuple(state), djobmeta) for state, djobmeta in job['files_to_proc']]
+    return job
+
+def resumable_jobs(exclude=()):
+    ''' Jobs which were interrupted or had errors, newest first
+        :exclude: job dirs which are running now
+        returns list of (job_dir, job, tracks finished)
+    '''
+    root = jobs_root()
+    result = []
+    for entry in sorted(os.listdir(root), reverse=True):
+        job_dir = os.path.join(root, entry)
+        if job_dir in exclude or not os.path.isdir(job_dir):
+            continue
+        job = load_job(job_dir)
+        if job is None:
+            continue
+        journal = JobJournal(job_dir, readonly=True)
+        names = [state[0] for state, djobmeta in job['files_to_proc']]
+        finished = len([n for n in names if journal.is_done(n, STAGE_COPIED)])
+        result.append((job_dir, job, finished))
+    return result
+
+def discard_job(job_dir, job):
+    # delete a job which won't be resumed, incl. any MP3s it left half written in the MP3 dir
+    from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+    from calibre_plugins.tts_to_mp3_plugin.utils import part_file_name
+    for state, djobmeta in job['files_to_proc']:
+        if djobmeta.get('mp3_in_place'):
+            path = part_file_name(SpineRecord.from_job_state(state).mp3_file_name(djobmeta['mp3_dir']))
+            if os.path.exists(path):
+                os.remove(path)
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+class JobJournal(object):
+    ''' Append-only record of the finished stages of each track of a job
+        Every line is flushed to disk before the stage counts as done,
+        so after a crash the journal never claims more than was finished.
+        A half written last line is ignored
+    '''
+
+    def __init__(self, job_dir, readonly=False):
+        self.path = os.path.join(job_dir, JOURNAL_FILENAME)
+        self.done = set()
+        # (name, stage) -> its last event, e.g. the split of a track WAV into segments
+        self.last = {}
+        self.f = None
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue
+                    self.done.add((event['name'], event['stage'], event.get('index')))
+                    self.last[(event['name'], event['stage'])] = event
+        except EnvironmentError:
+            pass
+        if not readonly:
+            self.f = open(self.path, 'ab')
+
+    def is_done(self, name, stage, index=None):
+        return (name, stage, index) in self.done
+
+    def event(self, name, stage):
+        # the last event of a stage, {} if it isn't done
+        return self.last.get((name, stage), {})
+
+    def index(self, name, stage):
+        # index of the last event of a stage, None if it isn't done
+        return self.event(name, stage).get('index')
+
+    def record(self, name, stage, index=None, **info):
+        ''' :info: more about the stage, for event() '''
+        event = {'name': name, 'stage': stage, 'time': time.time()}
+        if index is not None:
+            event['index'] = index
+        event.update(info)
+        self.f.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.done.add((name, stage, index))
+        self.last[(name, stage)] = event
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,147 @@
+import json
+import os
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+from calibre_plugins.tts_to_mp3_plugin.cache import hash_key
+
+# written into each book's MP3 directory
+MANIFEST_FILENAME = 'tts_to_mp3_manifest.json'
+MANIFEST_VERSION = 1
+
+# tags which don't make a track stale: the cover is a temp file path and
+# the track number may shift without the audio changing
+UNCOMPARED_TAGS = ('ti', 'tn')
+
+
+def text_hash(text):
+    return hash_key('track-text', text)
+
+def new_manifest():
+    return {'version': MANIFEST_VERSION, 'tracks': {}}
+
+def manifest_path(mp3_dir):
+    return os.path.join(mp3_dir, MANIFEST_FILENAME)
+
+def load_manifest(mp3_dir):
+    ''' Render manifest for the MP3s in mp3_dir, or None
+        {'version': 1, 'tracks': {spine name: track entry}}
+    '''
+    if not mp3_dir:
+        return None
+    try:
+        with open(manifest_path(mp3_dir), 'rb') as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+    except EnvironmentError:
+        return None
+    except ValueError:
+        print('{0}:manifest: ignoring unreadable {1}'.format(PLUGIN_NAME, manifest_path(mp3_dir)))
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(mp3_dir, manifest):
+    # write to a temp file first, so a crash never leaves half a manifest
+    path = manifest_path(mp3_dir)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    os.replace(tmp, path)
+
+def render_settings(engine_name, voice_id, voice_rate):
+    # anything about the voice which changes the audio
+    return {'engine': engine_name, 'voice_id': voice_id, 'rate': voice_rate}
+
+def compared_tags(tags):
+    return {k: v for k, v in tags.items() if k not in UNCOMPARED_TAGS and v is not None}
+
+def track_entry(record, djobmeta, thash):
+    ''' Manifest entry for a track which has just been recorded
+        :djobmeta: the job metadata the track was recorded with
+    '''
+    entry = render_settings(djobmeta.get('tts_engine'), djobmeta.get('voice_id'), djobmeta.get('voice_rate', 0))
+    entry.update({
+        'text_hash': thash,
+        'voice_name': djobmeta.get('voice_name'),
+        'track': record.track,
+        'tags': compared_tags(record.lame_tags(djobmeta.get('book_tags', {}))),
+        'file': os.path.basename(record.mp3_file_name(djobmeta.get('mp3_dir', ''))),
+        })
+    return entry
+
+def is_stale(entry, record, settings, book_tags, mp3_dir):
+    # True if the track for record must be recorded again
+    if entry is None or entry.get('text_hash') != text_hash(record.booktext):
+        return True
+    for k, v in settings.items():
+        if entry.get(k) != v:
+            return True
+    if entry.get('tags') != compared_tags(record.lame_tags(book_tags)):
+        return True
+    return not os.path.exists(os.path.join(mp3_dir, entry.get('file', '')))
+
+def stale_names(manifest, records, settings, book_tags, mp3_dir):
+    ''' Names of spine records (with text) which have no up to date MP3 in mp3_dir
+        Returned in spine order
+    '''
+    tracks = manifest.get('tracks', {})
+    return [r.name for r in records if r.booktext and
+            is_stale(tracks.get(r.name), r, settings, book_tags, mp3_dir)]
+
+def renumber_tracks(manifest, records, mp3_dir, book_tags=None):
+    ''' Rename the up to date MP3s whose track number has shifted since they were recorded,
+        e.g. because a chapter was added before them, and rewrite their track number tag.
+        The audio is kept as it is. A file which is not one of the moved MP3s is never replaced
+        A track which can't be renamed or retagged is dropped from the manifest, so it is
+        recorded again next time
+        :records: the unchanged spine records which are not being recorded again
+        :book_tags: the book's MP3 tags, for an MP3 which has no ID3v2 tag to update
+        returns list of (old file, new file)
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.id3 import replace_text_frames
+
+    tracks = manifest.get('tracks', {})
+    moves = []
+    for record in records:
+        entry = tracks.get(record.name)
+        if entry is None:
+            continue
+        new_file = os.path.basename(record.mp3_file_name(mp3_dir))
+        if entry.get('file') != new_file:
+            moves.append((record, entry, entry['file'], new_file))
+
+    # two passes so a new name can be an old name of another track
+    renamed = []
+    for record, entry, old_file, new_file in moves:
+        tmp_file = '%s.renumber' % old_file
+        try:
+            os.replace(os.path.join(mp3_dir, old_file), os.path.join(mp3_dir, tmp_file))
+            renamed.append((record, entry, old_file, tmp_file, new_file))
+        except EnvironmentError as err:
+            print('{0}:manifest: could not rename {1}: {2}'.format(PLUGIN_NAME, old_file, err))
+    result = []
+    for record, entry, old_file, tmp_file, new_file in renamed:
+        tmp_path, new_path = os.path.join(mp3_dir, tmp_file), os.path.join(mp3_dir, new_file)
+        try:
+            if os.path.exists(new_path):
+                # e.g. the MP3 of a stale track, or of a track which couldn't be moved
+                raise EnvironmentError('%s already exists' % new_file)
+            os.replace(tmp_path, new_path)
+        except EnvironmentError as err:
+            print('{0}:manifest: could not rename {1} to {2}: {3}'.format(PLUGIN_NAME, old_file, new_file, err))
+            try:
+                os.replace(tmp_path, os.path.join(mp3_dir, old_file))
+            except EnvironmentError:
+                pass
+            tracks.pop(record.name, None)
+            continue
+        entry['file'] = new_file
+        entry['track'] = record.track
+        result.append((old_file, new_file))
+        try:
+            replace_text_frames(new_path, record.lame_tags(book_tags or {}))
+        except (EnvironmentError, ValueError) as err:
+            print('{0}:manifest: could not retag {1}: {2}'.format(PLUGIN_NAME, new_file, err))
+            tracks.pop(record.name, None)
+    return result
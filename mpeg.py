@@ -0,0 +1,351 @@
+import struct
+from array import array
+
+# Layer III only, that is all lame writes
+BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),   # MPEG1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),       # MPEG2 and 2.5
+    }
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+XING_FRAMES, XING_BYTES, XING_TOC, XING_QUALITY = 0x1, 0x2, 0x4, 0x8
+
+# samples lame encodes before the audio, decoders drop them (and their own 529) if told by the LAME tag
+ENCODER_DELAY = 576
+# encoder string of the LAME tag written by xing_frame()
+LAME_VERSION = b'LAME3.100'
+# MP3 frames encoded before a segment of a track, which only settle the encoder and are dropped
+PREROLL_FRAMES = 4
+# MP3 frames encoded after a segment, so its last kept frame isn't made from the encoder's flush
+POSTROLL_FRAMES = 2
+# furthest back the main data of a frame may start: 9 bits of main_data_begin, MPEG2 has 8
+MAX_RESERVOIR = 511
+
+
+class FrameHeader(object):
+    ''' Parsed 4 byte MPEG audio frame header '''
+
+    def __init__(self, data, pos=0):
+        b = struct.unpack('>I', data[pos:pos+4])[0]
+        if (b >> 21) != 0x7ff:
+            raise ValueError('no frame sync')
+        self.version_bits = (b >> 19) & 3
+        layer_bits = (b >> 17) & 3
+        self.protected = not (b >> 16) & 1
+        self.bitrate_index = (b >> 12) & 0xf
+        sr_index = (b >> 10) & 3
+        self.padding = (b >> 9) & 1
+        self.mono = ((b >> 6) & 3) == 3
+        if self.version_bits == 1 or layer_bits != 1 or self.bitrate_index in (0, 15) or sr_index == 3:
+            raise ValueError('not a Layer III frame header')
+        self.raw = b
+        self.mpeg1 = self.version_bits == 3
+        self.bitrate = BITRATES[1 if self.mpeg1 else 2][self.bitrate_index] * 1000
+        self.sample_rate = SAMPLE_RATES[self.version_bits][sr_index]
+        self.samples = 1152 if self.mpeg1 else 576
+        self.length = (144 if self.mpeg1 else 72) * self.bitrate // self.sample_rate + self.padding
+
+    @property
+    def side_info_size(self):
+        if self.mpeg1:
+            return 17 if self.mono else 32
+        return 9 if self.mono else 17
+
+    @property
+    def xing_offset(self):
+        # where a Xing/Info header starts in this frame, which is also where its main data area starts
+        return 4 + (2 if self.protected else 0) + self.side_info_size
+
+    @property
+    def area_size(self):
+        # bytes of main data this frame can hold, its own or that of the frames after it
+        return self.length - self.xing_offset
+
+    def without_crc(self):
+        return struct.pack('>I', self.raw | (1 << 16))
+
+    def with_bitrate_index(self, index):
+        # header bytes with another bitrate, no CRC and no padding
+        b = (self.raw & ~(0xf << 12) & ~(1 << 9)) | (index << 12) | (1 << 16)
+        return struct.pack('>I', b)
+
+
+def frame_samples(sample_rate):
+    # samples per Layer III frame: MPEG1 for 32 kHz and up, else MPEG2/2.5
+    return 1152 if sample_rate >= 32000 else 576
+
+def main_data(data, pos, header):
+    ''' Where the main data of the frame at pos is
+        returns (main_data_begin, length): its main data starts main_data_begin bytes before
+                 the frame's main data area, in the areas of the frames before it (the bit
+                 reservoir), and is length bytes long
+    '''
+    size = header.side_info_size
+    nbits = size * 8
+    pos += 4 + (2 if header.protected else 0)
+    bits = int.from_bytes(data[pos:pos+size], 'big')
+    nchannels = 1 if header.mono else 2
+    if header.mpeg1:
+        # main_data_begin, private bits and scfsi, then 2 granules of 59 bits per channel
+        begin_bits, first, ngranules, granule_bits = 9, 9 + (5 if header.mono else 3) + 4 * nchannels, 2, 59
+    else:
+        begin_bits, first, ngranules, granule_bits = 8, 8 + (1 if header.mono else 2), 1, 63
+    # each granule starts with its part2_3_length, its main data in bits
+    length = 0
+    for i in range(ngranules * nchannels):
+        length += (bits >> (nbits - first - i * granule_bits - 12)) & 0xfff
+    return bits >> (nbits - begin_bits), (length + 7) // 8
+
+def with_main_data_begin(side_info, header, begin):
+    # side info bytes with another main_data_begin
+    nbits = len(side_info) * 8
+    shift = nbits - (9 if header.mpeg1 else 8)
+    bits = int.from_bytes(side_info, 'big')
+    return ((bits & ((1 << shift) - 1)) | (begin << shift)).to_bytes(len(side_info), 'big')
+
+def overlap_ranges(ranges, sample_rate):
+    ''' Ranges of a track WAV to encode as segments which join without a gap
+        A segment is encoded from PREROLL_FRAMES before its start to POSTROLL_FRAMES after
+        its end and only the frames in between are kept. Its start is moved to the nearest
+        frame boundary of the whole track, so the kept frames are the frames the whole
+        track would have, and the segments' encoder delay and padding fall in dropped frames
+        The encoder's padding of the last segment is the padding of the track, see xing_frame()
+        :ranges: (start frame, number of frames) of each segment, see silence.segment_ranges()
+        returns list of (start frame, number of frames, MP3 frames to keep), the first segment
+                has no pre-roll and the last keeps all its frames (None). join_mp3s() drops the
+                pre-roll frames of the other segments
+    '''
+    samples = frame_samples(sample_rate)
+    total = ranges[-1][0] + ranges[-1][1]
+    # the MP3 frame of the whole track each segment starts at
+    firsts = [0]
+    for start, nframes in ranges[1:]:
+        first = (start + ENCODER_DELAY + samples // 2) // samples
+        if first >= firsts[-1] + PREROLL_FRAMES:
+            firsts.append(first)
+    result = []
+    for i, first in enumerate(firsts):
+        preroll = PREROLL_FRAMES if i else 0
+        start = (first - preroll) * samples
+        if i + 1 < len(firsts):
+            end = min(total, (firsts[i+1] + POSTROLL_FRAMES) * samples - ENCODER_DELAY)
+            keep = preroll + firsts[i+1] - first
+        else:
+            end, keep = total, None
+        result.append((start, end - start, keep))
+    return result
+
+
+class FrameJoiner(object):
+    ''' Writes the audio frames of MP3 pieces to a file as one stream
+        The main data of a frame may start in the frames before it. At the start of a piece
+        those are now the last frames of the piece before, or frames which are dropped, so
+        the main data of the first frames is moved into the free space of the frames now
+        before them. A frame whose main data doesn't fit is given a higher bitrate.
+        Once a frame's main data is back where the piece had it, the rest of the piece
+        is copied as it is
+        :out: open file, at the position of the first frame
+        :nbytes: offset of the first frame, for the frame offsets
+    '''
+
+    def __init__(self, out, nbytes=0):
+        self.out = out
+        self.nbytes = nbytes
+        self.offsets = array('L')
+        self.bitrates = set()
+        self.first = None
+        # frames not written yet, as later frames' main data may go in their areas:
+        # [header and side info, area, position of the area in the main data stream]
+        self.pending = []
+        # end of the main data areas and of the last frame's main data, in the main data stream
+        self.area_end = 0
+        self.data_end = 0
+
+    def add(self, data, start, offsets, bitrates, skip=0):
+        ''' Add the frames of one piece
+            :data, start, offsets, bitrates: the piece's frames, see scan_frames()
+            :skip: frames at the start of the piece which are only there for the frames after them
+        '''
+        if len(offsets) <= skip:
+            return
+        view = memoryview(data)
+        # the piece's main data areas, until its main data is where the piece had it
+        stream = bytearray()
+        for i, offset in enumerate(offsets):
+            pos = start + offset
+            header = FrameHeader(data, pos)
+            area_pos = len(stream)
+            stream += view[pos + header.xing_offset:pos + header.length]
+            if i < skip:
+                continue
+            if self.first is None:
+                self.first = header
+            begin, length = main_data(data, pos, header)
+            if self.place(header, view[pos:pos + header.length], begin, length, stream, area_pos):
+                self.bitrates.update(bitrates)
+                return self.copy(data, start, offsets[i+1:])
+            self.bitrates.add(header.bitrate)
+
+    def place(self, header, frame, begin, length, stream, area_pos):
+        ''' Add a frame, its main data as close to where the piece had it as there is room for
+            :begin, length: where the frame's main data is in the piece, see main_data()
+            :stream, area_pos: the piece's main data areas, and the frame's area in them
+            returns True if the frame is just as it was in the piece
+        '''
+        area_start = self.area_end
+        start = max(self.data_end, area_start - begin)
+        end = start + length
+        if start == area_start - begin:
+            # nothing to move: the frame is kept, and so is the main data of later frames
+            # after its own, before or in its area
+            head, area = bytes(frame[:header.xing_offset]), bytearray(frame[header.xing_offset:])
+            mdata = stream[area_pos - begin:area_pos]
+            end = area_start
+            same = True
+        else:
+            mdata = stream[area_pos - begin:area_pos - begin + length]
+            raw = header.without_crc()
+            for index in range(header.bitrate_index, 15):
+                if index != header.bitrate_index:
+                    raw = header.with_bitrate_index(index)
+                if area_start + FrameHeader(raw).area_size >= end:
+                    break
+            else:
+                raise ValueError('MP3 frame main data does not fit')
+            new = FrameHeader(raw)
+            side_info = frame[header.xing_offset - header.side_info_size:header.xing_offset]
+            head = raw + with_main_data_begin(side_info, header, area_start - start)
+            area = bytearray(new.area_size)
+            if end > area_start:
+                area[:end - area_start] = mdata[area_start - start:]
+            self.bitrates.add(new.bitrate)
+            same = False
+        # the start of the main data, or all of it, goes in the areas of the frames before
+        for entry in self.pending:
+            lo, hi = max(start, entry[2]), min(area_start, end, entry[2] + len(entry[1]))
+            if lo < hi:
+                entry[1][lo - entry[2]:hi - entry[2]] = mdata[lo - start:hi - start]
+        self.append(head, area, start + length)
+        return same
+
+    def append(self, head, area, data_end):
+        self.offsets.append(self.nbytes)
+        self.nbytes += len(head) + len(area)
+        self.pending.append([head, area, self.area_end])
+        self.area_end += len(area)
+        self.data_end = data_end
+        # frames too far back for any later frame's main data are written
+        while self.pending and self.pending[0][2] + len(self.pending[0][1]) <= self.area_end - MAX_RESERVOIR:
+            self.write(self.pending.pop(0))
+
+    def write(self, entry):
+        self.out.write(entry[0])
+        self.out.write(entry[1])
+
+    def copy(self, data, start, offsets):
+        # add the rest of a piece as it is, keeping the frames at its end pending for the next piece
+        tail = len(offsets)
+        area = 0
+        while tail > 0 and area < MAX_RESERVOIR:
+            tail -= 1
+            area += FrameHeader(data, start + offsets[tail]).area_size
+        if tail:
+            self.flush()
+            self.out.write(memoryview(data)[start + offsets[0]:start + offsets[tail]])
+            self.offsets.extend(self.nbytes + o - offsets[0] for o in offsets[:tail])
+            self.nbytes += offsets[tail] - offsets[0]
+        for offset in offsets[tail:]:
+            pos = start + offset
+            header = FrameHeader(data, pos)
+            begin, length = main_data(data, pos, header)
+            self.append(bytes(data[pos:pos + header.xing_offset]),
+                        bytearray(data[pos + header.xing_offset:pos + header.length]),
+                        self.area_end - begin + length)
+
+    def flush(self):
+        for entry in self.pending:
+            self.write(entry)
+        self.pending = []
+
+
+def is_xing_frame(data, pos, header):
+    tag = data[pos + header.xing_offset:pos + header.xing_offset + 4]
+    return tag in (b'Xing', b'Info')
+
+def scan_frames(data, start, end):
+    ''' Frames of data[start:end]
+        returns (first FrameHeader, frame offsets from start, frame bitrates set)
+        A Xing/Info frame at the start is not counted; bytes which aren't a frame are skipped
+    '''
+    offsets = array('L')
+    bitrates = set()
+    first = None
+    pos = start
+    while pos + 4 <= end:
+        try:
+            header = FrameHeader(data, pos)
+        except ValueError:
+            pos += 1
+            continue
+        if first is None:
+            first = header
+            if is_xing_frame(data, pos, header):
+                pos += header.length
+                continue
+        offsets.append(pos - start)
+        bitrates.add(header.bitrate)
+        pos += header.length
+    return first, offsets, bitrates
+
+def xing_frame(first, nframes, nbytes, toc, vbr, delay=None, padding=None):
+    ''' A silent frame holding a Xing (VBR) or Info (CBR) header, so players show the
+        right duration and can seek. Written before the first audio frame
+        :first: FrameHeader of the first audio frame, for version, sample rate and channels
+        :nframes, nbytes: audio frames and bytes, including this frame's bytes
+        :toc: 100 seek points, see xing_toc()
+        :delay, padding: samples before and after the audio in the frames, written to a LAME
+                         tag so gapless players drop them. None for no LAME tag
+    '''
+    flags = XING_FRAMES | XING_BYTES | XING_TOC
+    if delay is not None:
+        flags |= XING_QUALITY
+    body = (b'Xing' if vbr else b'Info') + struct.pack('>III', flags, nframes, nbytes) + bytes(bytearray(toc))
+    if delay is not None:
+        # quality, then the LAME tag: version, tag revision and VBR method (1 for CBR), lowpass,
+        # replay gain, flags, bitrate, delay and padding (12 bits each), misc, MP3 gain, preset,
+        # music length and CRC (not worked out), and the tag's CRC added below
+        body += struct.pack('>I', 0) + LAME_VERSION + struct.pack('>BB', 0 if vbr else 1, 0) + b'\x00' * 8 + \
+                struct.pack('>BB', 0, min(255, first.bitrate // 1000)) + \
+                struct.pack('>I', min(delay, 0xfff) << 12 | min(max(0, padding), 0xfff))[1:] + \
+                b'\x00' * 4 + struct.pack('>IH', nbytes, 0)
+    crc_size = 2 if delay is not None else 0
+    # the lowest bitrate whose frame is big enough for the header
+    for index in range(1, 15):
+        header = FrameHeader(first.with_bitrate_index(index))
+        if header.length >= header.xing_offset + len(body) + crc_size:
+            break
+    frame = header.with_bitrate_index(index) + b'\x00' * (header.xing_offset - 4) + body
+    if delay is not None:
+        frame += struct.pack('>H', crc16(frame))
+    return frame + b'\x00' * (header.length - len(frame))
+
+def xing_frame_length(first, lame_tag=False):
+    return len(xing_frame(first, 0, 0, [0] * 100, False, *((0, 0) if lame_tag else ())))
+
+def crc16(data, crc=0):
+    # CRC-16 (polynomial 0x8005, reflected) of the LAME tag, as lame and decoders work it out
+    for b in bytearray(data):
+        crc ^= b
+        for i in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+def xing_toc(offsets, nbytes):
+    ''' Seek table: byte position of each percent of the frames, as 0..255 of nbytes
+        :offsets: audio frame offsets from the start of the Xing frame
+    '''
+    toc = []
+    for i in range(100):
+        pos = offsets[min(len(offsets) - 1, i * len(offsets) // 100)] if offsets else 0
+        toc.append(min(255, 256 * pos // max(1, nbytes)))
+    return toc
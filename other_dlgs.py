@@ -7,57 +7,44 @@ try:
         QGroupBox, QFrame, QSplitter, QDialogButtonBox, QIcon, QTimer,
         QLabel, QTextBrowser, QPushButton, QTextEdit,
         QComboBox, QSpinBox, QRadioButton,
-        QTableWidget, QTableWidgetItem, QAbstractItemView, QVariant)
+        QTableWidget, QTableWidgetItem, QAbstractItemView, QVariant,
+        QListWidget, QListWidgetItem)
 except ImportError:
     from PyQt5.Qt import (
         QDialog, Qt, QVBoxLayout, QHBoxLayout, QGridLayout, 
         QGroupBox, QFrame, QSplitter, QDialogButtonBox, QIcon, QTimer,
         QLabel, QTextBrowser, QPushButton, QTextEdit,
         QComboBox, QSpinBox, QRadioButton,
-        QTableWidget, QTableWidgetItem, QAbstractItemView, QVariant)
+        QTableWidget, QTableWidgetItem, QAbstractItemView, QVariant,
+        QListWidget, QListWidgetItem)
 
 from calibre.devices.usbms.driver import debug_print
-from calibre_extensions.winsapi import ISpVoice
 
 #import from this plugin
 from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME    
 from calibre_plugins.tts_to_mp3_plugin.common_utils import find_icon
 from calibre_plugins.tts_to_mp3_plugin.utils import get_voiceid_from_desc, get_sorted_voicedescs
-
-class SpeakFlags():
-    SVSFDefault                   =0          # from enum SpeechVoiceSpeakFlags
-    SVSFIsFilename                =4          # from enum SpeechVoiceSpeakFlags
-    SVSFIsNotXML                  =16         # from enum SpeechVoiceSpeakFlags
-    SVSFIsXML                     =8          # from enum SpeechVoiceSpeakFlags
-    SVSFNLPMask                   =64         # from enum SpeechVoiceSpeakFlags
-    SVSFNLPSpeakPunc              =64         # from enum SpeechVoiceSpeakFlags
-    SVSFParseAutodetect           =0          # from enum SpeechVoiceSpeakFlags
-    SVSFParseMask                 =384        # from enum SpeechVoiceSpeakFlags
-    SVSFParseSapi                 =128        # from enum SpeechVoiceSpeakFlags
-    SVSFParseSsml                 =256        # from enum SpeechVoiceSpeakFlags
-    SVSFPersistXML                =32         # from enum SpeechVoiceSpeakFlags
-    SVSFPurgeBeforeSpeak          =2          # from enum SpeechVoiceSpeakFlags
-    SVSFUnusedFlags               =-512       # from enum SpeechVoiceSpeakFlags
-    SVSFVoiceMask                 =511        # from enum SpeechVoiceSpeakFlags
-    SVSFlagsAsync                 =1          # from enum SpeechVoiceSpeakFlags
+from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog
 
 
 class SelNamesDlg(QDialog):
     ''' select ebook spine files to be recorded to WAV/MP3 '''
     
-    def __init__(self, select_spines, spine_dict, name_text_map, vname, vrate, parent=None):
+    def __init__(self, select_spines, spine_records, vname, vrate, parent=None, engine_name=None):
         QDialog.__init__(self, parent=parent)
         
         self.select_spines = select_spines
-        self.all_spines = [d['name'] for d in spine_dict]
-        self.name_text_map = name_text_map
+        self.all_spines = [r.name for r in spine_records]
+        self.name_record_map = {r.name: r for r in spine_records}
         
         # init test voice to same as in main dialog
         self.vname = vname
         self.vrate = vrate
         self.vid = None
         
-        self.testVoice = ISpVoice()
+        self.engine_name = engine_name
+        self.catalog = voice_catalog(engine_name)
+        self.testVoice = self.catalog.acquire()
         self.isPlaying = False
         
         self.buttonBox = QDialogButtonBox(QDialogButtonBox.StandardButton.Save | QDialogButtonBox.StandardButton.Cancel)
@@ -156,11 +143,20 @@ class SelNamesDlg(QDialog):
         self.testvoiceCombo.setCurrentText(vname)
         self.testrateSpin.setValue(vrate)
         
-        self.selnameTable.populate_table([d for d in spine_dict])
+        self.selnameTable.populate_table(spine_records)
         # restore previous selection
         for name in self.select_spines:
             self.selnameTable.set_as_selected(name)
 
+    def name_loaded(self, name, data):
+        # text for a spine file has arrived from the main dialog's background loader
+        self.selnameTable.update_table_row(name, data)
+        sel_names = self.selnameTable.get_selected_spine()
+        if sel_names and not self.browser.toPlainText():
+            name0 = [n for n in self.all_spines if n in sel_names][0]
+            if name0 == name:
+                self.browser.setPlainText(data.get('booktext', ''))
+
     def testvoiceCombo_textChanged(self, text):
         self.vname = text
         self.vid = get_voiceid_from_desc(self.testVoice, text)
@@ -178,7 +174,7 @@ class SelNamesDlg(QDialog):
         if sel_names:
             # populate the text box to allow voice testing
             name0 = [name for name in self.all_spines if name in sel_names][0]
-            booktext = self.name_text_map[name0].get('booktext', '')
+            booktext = self.name_record_map[name0].booktext
             self.browser.setPlainText(booktext)
             
     def accept(self):
@@ -189,6 +185,10 @@ class SelNamesDlg(QDialog):
     def reject(self):
         self.stop()
         QDialog.reject(self)
+
+    def done(self, r):
+        self.catalog.release(self.testVoice)
+        QDialog.done(self, r)
             
     def toggle_player_settings(self, bool):
         self.testvoiceCombo.setEnabled(bool)
@@ -212,13 +212,12 @@ class SelNamesDlg(QDialog):
             self.play(saytext)
         
     def play(self, text):
-        # initialise Voice
-        self.testVoice = ISpVoice()
+        # the same Voice is reused for every preview
         self.testVoice.set_current_voice(self.vid)
         self.testVoice.set_current_rate(self.vrate)
         
         self.toggle_player_settings(False)
-        self.testVoice.speak(text, SpeakFlags.SVSFlagsAsync)
+        self.testVoice.speak(text)
         self.check_speaking_done()
             
     def stop_speech(self):
@@ -226,7 +225,7 @@ class SelNamesDlg(QDialog):
         self.toggle_player_settings(True)
             
     def stop(self):
-        self.testVoice.pause()
+        self.testVoice.stop()
 
     def check_speaking_done(self):
        if self.testVoice.wait_until_done(10):
@@ -247,7 +246,7 @@ class SelNamesTableWidget(QTableWidget):
             self.setColumnWidth(col, minimum)
 
     def populate_table(self, lines):
-        # lines = {rownum: 'toc'=?, 'name'=?, 'sample'=?, 'wordcount'=?} 
+        # lines = list of SpineRecord, one per row
         self.clear()
         self.setAlternatingRowColors(True)
         self.setRowCount(len(lines))
@@ -270,13 +269,13 @@ class SelNamesTableWidget(QTableWidget):
         self.setSortingEnabled(False)
 
     def populate_table_row(self, row, line):
-        # lines = {rownum: 'toc'=?, 'name'=?, 'wordcount'=?}
-        toc = line['toc']
-        name = line['name']
-        words = line['wordcount']
+        # line = SpineRecord
+        toc = line.short_toctitle
+        name = line.name
+        words = line.wordcount
 
         name_cell = ReadOnlyTableWidgetItem(name)
-        name_cell.setToolTip(line['sample'])
+        name_cell.setToolTip(line.sample)
         name_cell.setData(Qt.ItemDataRole.UserRole, QVariant(name_cell))
         self.setItem(row, 0, name_cell)
         
@@ -290,8 +289,17 @@ class SelNamesTableWidget(QTableWidget):
         toc_cell.setData(Qt.ItemDataRole.UserRole, QVariant(toc_cell))
         self.setItem(row, 2, toc_cell)
         
+    def update_table_row(self, name, data):
+        # refresh word count and sample for a row once its text has been loaded
+        for row in [r for r in self.lines if self.lines[r].name == name]:
+            words_str = str(data.get('wordcount', 0))
+            words_cell = self.item(row, 1)
+            words_cell.setText(words_str)
+            words_cell.setData(Qt.ItemDataRole.UserRole, QVariant(words_str))
+            self.item(row, 0).setToolTip(data.get('sample', ''))
+
     def set_as_selected(self, name):
-        for row in [r for r in self.lines if self.lines[r]['name'] == name]:
+        for row in [r for r in self.lines if self.lines[r].name == name]:
             for col in range(self.columnCount()):
                 self.item(row, col).setSelected(True)
             
@@ -353,3 +361,61 @@ class EbookSelectFormat(QDialog):
     @property
     def result(self):
         return [k for k in self.formats if self.dradio[k].isChecked()]
+
+class ResumeJobsDlg(QDialog):
+    # select interrupted jobs to resume or discard
+
+    def __init__(self, jobs, parent=None):
+        ''' :jobs: list of (job_dir, job, tracks finished) from journal.resumable_jobs() '''
+        QDialog.__init__(self, parent=parent)
+        
+        self.jobs = jobs
+        self.action = None
+        
+        label = QLabel('These jobs were interrupted or had errors.\n'
+                       'Resumed jobs continue from the last finished step of each MP3.')
+        
+        self.jobList = QListWidget()
+        self.jobList.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.jobList.setMinimumWidth(500)
+        for row, (job_dir, job, finished) in enumerate(jobs):
+            text = '{0}  [{1} / {2} MP3s done]  {3}'.format(job.get('book_label', ''), finished,
+                        len(job['files_to_proc']), os.path.basename(job_dir).split('_')[0])
+            item = QListWidgetItem(text)
+            item.setData(Qt.ItemDataRole.UserRole, row)
+            item.setToolTip(job_dir)
+            self.jobList.addItem(item)
+        if jobs:
+            self.jobList.item(0).setSelected(True)
+        
+        buttonBox = QDialogButtonBox(QDialogButtonBox.StandardButton.Cancel)
+        resumeButton = buttonBox.addButton('&Resume', QDialogButtonBox.ButtonRole.AcceptRole)
+        discardButton = buttonBox.addButton('&Discard', QDialogButtonBox.ButtonRole.DestructiveRole)
+        
+        lay = QVBoxLayout()
+        lay.addWidget(label)
+        lay.addWidget(self.jobList)
+        lay.addWidget(buttonBox)
+        self.setLayout(lay)
+        
+        resumeButton.clicked.connect(self.resumeButton_clicked)
+        discardButton.clicked.connect(self.discardButton_clicked)
+        buttonBox.rejected.connect(self.reject)
+        
+        self.setWindowTitle('{0}: Resume jobs'.format(PLUGIN_NAME))
+        icon = find_icon('images/plugin_icon.png')
+        self.setWindowIcon(icon)
+        
+    def resumeButton_clicked(self):
+        self.action = 'resume'
+        QDialog.accept(self)
+        
+    def discardButton_clicked(self):
+        self.action = 'discard'
+        QDialog.accept(self)
+        
+    @property
+    def result(self):
+        # the selected (job_dir, job, tracks finished)
+        rows = sorted(item.data(Qt.ItemDataRole.UserRole) for item in self.jobList.selectedItems())
+        return [self.jobs[row] for row in rows]
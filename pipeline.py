@@ -0,0 +1,130 @@
+import traceback
+from collections import deque
+from queue import Queue
+from threading import Condition, Thread
+
+
+class Stage(object):
+    # work waiting for one stage, and how much of it is running
+    def __init__(self, name, backlog_limit=None, admit=None):
+        self.name = name
+        self.queue = deque()
+        self.running = 0
+        self.backlog_limit = backlog_limit
+        self.admit = admit
+
+    @property
+    def backlog(self):
+        return len(self.queue) + self.running
+
+
+class StageScheduler(object):
+    ''' Decides which piece of work to run next on a pool of slots (the worker processes)
+        Stages are added upstream first, e.g. synthesize then encode.
+        Later stages are always served first, so finished audio doesn't wait behind
+        the rest of the book, and an earlier stage only starts new work while the
+        backlog of the stage after it is under its backlog_limit (a bounded queue),
+        so throughput is set by the slowest stage and intermediate files don't pile up
+        A stage's admit(work) callback can also hold back its next piece of work,
+        e.g. until there is disk space for its output
+    '''
+
+    def __init__(self, slots):
+        self.slots = max(1, slots or 1)
+        self.stages = []
+        self.by_name = {}
+
+    def add_stage(self, name, backlog_limit=None, admit=None):
+        stage = Stage(name, backlog_limit, admit)
+        self.stages.append(stage)
+        self.by_name[name] = stage
+
+    def push(self, name, work):
+        self.by_name[name].queue.append(work)
+
+    def finished(self, name):
+        self.by_name[name].running -= 1
+
+    @property
+    def running(self):
+        return sum(s.running for s in self.stages)
+
+    @property
+    def idle(self):
+        return not any(s.backlog for s in self.stages)
+
+    def next_work(self):
+        ''' returns (stage name, work) to start now, or None '''
+        if self.running >= self.slots:
+            return None
+        for i in reversed(range(len(self.stages))):
+            stage = self.stages[i]
+            if not stage.queue:
+                continue
+            if i + 1 < len(self.stages):
+                after = self.stages[i + 1]
+                if after.backlog_limit is not None and after.backlog >= after.backlog_limit:
+                    continue
+            if stage.admit is not None and not stage.admit(stage.queue[0]):
+                continue
+            stage.running += 1
+            return stage.name, stage.queue.popleft()
+        return None
+
+
+class ThreadStage(Thread):
+    ''' A pipeline stage run in a thread of the master process, for I/O work
+        Work is fed through a bounded queue: put() blocks while it is full,
+        which holds back the stages feeding it
+        With max_bytes set, put() also blocks while the work queued or running adds up
+        to more than max_bytes, as measured by size(work). A single item bigger than
+        max_bytes is let through on its own
+        Each result is put on the shared results queue as (stage name, work, ok, result)
+    '''
+
+    def __init__(self, name, func, results, maxsize=4, max_bytes=None, size=None):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.func = func
+        self.results = results
+        self.inq = Queue(maxsize)
+        self.outstanding = 0
+        self.max_bytes = max_bytes
+        self.size = size
+        self.budget = Condition()
+        self.queued_bytes = 0
+
+    def put(self, work):
+        self.outstanding += 1
+        nbytes = 0
+        if self.max_bytes is not None:
+            nbytes = self.size(work)
+            with self.budget:
+                while self.queued_bytes and self.queued_bytes + nbytes > self.max_bytes:
+                    self.budget.wait()
+                self.queued_bytes += nbytes
+        self.inq.put((work, nbytes))
+
+    def done(self):
+        # called by the master when it has taken a result of this stage
+        self.outstanding -= 1
+
+    def run(self):
+        while True:
+            item = self.inq.get()
+            if item is None:
+                break
+            work, nbytes = item
+            try:
+                self.results.put((self.name, work, True, self.func(work)))
+            except:
+                traceback.print_exc()
+                self.results.put((self.name, work, False, traceback.format_exc().strip().splitlines()[-1]))
+            if nbytes:
+                with self.budget:
+                    self.queued_bytes -= nbytes
+                    self.budget.notify_all()
+
+    def close(self):
+        self.inq.put(None)
+        self.join()
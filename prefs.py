@@ -0,0 +1,32 @@
+# This is where all preferences for this plugin will be stored
+# Remember that this plugin name is also
+# in a global namespace, so make it as unique as possible.
+# You should always prefix your config file name with plugins/,
+# so as to ensure you dont accidentally clobber a calibre config file
+# Set defaults
+
+from calibre.utils.config import JSONConfig
+
+prefs = JSONConfig('plugins/ebook2audiobook')
+
+# None is SAPI on Windows, else espeak-ng if installed, else the synthetic stub
+prefs.defaults['tts_engine'] = None
+prefs.defaults['voice_name'] = None
+prefs.defaults['voice_rate'] = 0
+prefs.defaults['img_alt_show'] = False
+prefs.defaults['img_alt_prefix'] = 'Image'
+prefs.defaults['embed_cover_thumbnail'] = True
+prefs.defaults['parallel_extract'] = True
+prefs.defaults['text_cache_mb'] = 200
+prefs.defaults['chunk_words'] = 1500
+prefs.defaults['audio_cache_mb'] = 2000
+prefs.defaults['stream_audio'] = True
+prefs.defaults['parallel_encode'] = True
+# 'auto' is the in-process LAME library if lameenc is installed, else lame.exe
+prefs.defaults['mp3_encoder'] = 'auto'
+# disk space for WAVs and MP3s being worked on, shared by all running jobs
+prefs.defaults['spool_mb'] = 4000
+# save the time taken by each stage of a job in the MP3 dir
+prefs.defaults['write_trace'] = False
+# last MP3 directory of each book, to find its render manifest
+prefs.defaults['book_mp3_dirs'] = {}
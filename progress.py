@@ -0,0 +1,108 @@
+import os
+import time
+import wave
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin.encoders import BITRATE
+
+# how often the job reports its progress while tracks are being spoken
+NOTIFY_SECONDS = 2.0
+
+# track stages reported to the job log
+TRACK_SPEAKING = 'speaking'
+TRACK_SPOKEN = 'spoken'
+TRACK_ENCODING = 'encoding'
+TRACK_ENCODED = 'encoded'
+TRACK_DONE = 'done'
+TRACK_FAILED = 'failed'
+
+
+class RenderProgress(object):
+    ''' Live progress of a job, measured by the master as chunks are spoken
+        Only words spoken by this run count towards the rates, so a resumed job
+        isn't reported faster than it is. The ETA is for the words still to be spoken
+        :words: wordcount of every track in the job
+        :tracks: number of tracks in the job
+    '''
+
+    def __init__(self, words, tracks):
+        self.words = words
+        self.tracks = tracks
+        self.start_time = time.time()
+        self.words_spoken = 0
+        # words this run won't speak: done by an earlier run, or in a chunk which failed
+        self.words_skipped = 0
+        self.audio_seconds = 0.0
+        self.tracks_done = 0
+        self.last_notify = 0
+
+    def skipped(self, words):
+        self.words_skipped += words
+
+    def spoken(self, words, audio_seconds):
+        self.words_spoken += words
+        self.audio_seconds += audio_seconds
+
+    def track_done(self):
+        self.tracks_done += 1
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def wpm(self):
+        elapsed = self.elapsed()
+        return 60.0 * self.words_spoken / elapsed if elapsed else 0.0
+
+    def rtf(self):
+        # real-time factor: seconds taken per second of audio, under 1 is faster than real time
+        return self.elapsed() / self.audio_seconds if self.audio_seconds else 0.0
+
+    def eta(self):
+        # seconds until every word is spoken at the rate so far, None until there is a rate
+        if not self.words_spoken:
+            return None
+        remaining = max(0, self.words - self.words_spoken - self.words_skipped)
+        return remaining * self.elapsed() / self.words_spoken
+
+    def fraction(self):
+        # half for the words spoken, half for the tracks encoded and copied
+        words = float(self.words_spoken + self.words_skipped) / self.words if self.words else 1.0
+        tracks = float(self.tracks_done) / self.tracks if self.tracks else 1.0
+        return max(0.01, min(1.0, (words + tracks) / 2))
+
+    def message(self):
+        msg = 'Created %d of %d MP3s' % (self.tracks_done, self.tracks)
+        if self.words_spoken:
+            msg += ', {0:.0f} wpm, RTF {1:.2f}'.format(self.wpm(), self.rtf())
+            eta = self.eta()
+            if eta:
+                msg += ', ETA %s' % format_seconds(eta)
+        return msg
+
+    def notify(self, notification, force=False):
+        # send the progress to the job manager, at most every NOTIFY_SECONDS unless forced
+        now = time.time()
+        if force or now - self.last_notify >= NOTIFY_SECONDS:
+            self.last_notify = now
+            notification(self.fraction(), self.message())
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+def audio_seconds(path, stream):
+    ''' Length of a spoken chunk, read from its WAV header
+        A streamed chunk is an MP3 at BITRATE, its length is worked out from its size
+        returns 0.0 if the file can't be read
+    '''
+    try:
+        if stream:
+            return os.path.getsize(path) * 8.0 / (BITRATE * 1000)
+        with wave.open(path, 'rb') as w:
+            return w.getnframes() / float(w.getframerate())
+    except (EnvironmentError, wave.Error, EOFError):
+        return 0.0
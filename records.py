@@ -0,0 +1,97 @@
+import os
+
+TOC_TITLE_MAX = 50
+
+
+class SpineRecord(object):
+    ''' Everything the plugin knows about one spine file, in a single compact object
+        Shared by the main dialog, the file selection table, the job payload and the job itself.
+        Track derived strings (pad_track, safe_filename, tn, tt, ...) are computed when asked for.
+        :toc_display: ToC title including level indentation, or the sanitised file name
+                      if the file is not in the ToC
+        :in_toc: True if toc_display came from the ToC
+        :safe_title: filesystem safe title used to build the MP3 file name
+        :padding: number of digits in track numbers for this book
+    '''
+    __slots__ = ('name', 'toc_display', 'in_toc', 'safe_title', 'padding', 'track',
+                 'booktext', 'sample', 'wordcount', 'text_offset', 'text_length')
+
+    def __init__(self, name, toc_display, in_toc, safe_title, padding):
+        self.name = name
+        self.toc_display = toc_display
+        self.in_toc = in_toc
+        self.safe_title = safe_title
+        self.padding = padding
+        # 0 until text has been found in this file
+        self.track = 0
+        self.booktext = ''
+        self.sample = ''
+        self.wordcount = 0
+        # position in the job's text store, once written
+        self.text_offset = None
+        self.text_length = None
+
+    def job_state(self):
+        ''' Plain tuple to send in calibre job args
+            Worker processes unpickle their args before the plugin loader is set up,
+            so calibre_plugins classes can't be sent as they are.
+            Once the text is in the text store, it isn't sent at all
+        '''
+        if self.text_offset is not None:
+            return tuple('' if k in ('booktext', 'sample') else getattr(self, k) for k in self.__slots__)
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    @classmethod
+    def from_job_state(cls, state):
+        record = cls.__new__(cls)
+        for k, v in zip(cls.__slots__, state):
+            setattr(record, k, v)
+        return record
+
+    def __repr__(self):
+        return 'SpineRecord(%r, track=%d, wordcount=%d)' % (self.name, self.track, self.wordcount)
+
+    def set_text_data(self, data):
+        # data is a dict from extract.get_name_text_data() or the text cache
+        self.sample = data.get('sample', '')
+        self.booktext = data.get('booktext', '')
+        self.wordcount = data.get('wordcount', 0)
+
+    @property
+    def short_toctitle(self):
+        if self.in_toc and len(self.toc_display) > TOC_TITLE_MAX:
+            return self.toc_display[:TOC_TITLE_MAX] + '...'
+        return self.toc_display
+
+    @property
+    def tt(self):
+        # MP3 title tag
+        return self.toc_display.strip()
+
+    @property
+    def tn(self):
+        # MP3 track number tag
+        return str(self.track)
+
+    @property
+    def pad_track(self):
+        return str(self.track).zfill(self.padding)
+
+    @property
+    def safe_filename(self):
+        if not self.track:
+            return ''
+        return '%s_%s' % (self.pad_track, self.safe_title)
+
+    def wav_file_name(self, dest_dir):
+        return os.path.join(dest_dir, self.safe_filename + '.wav')
+
+    def mp3_file_name(self, dest_dir):
+        return os.path.join(dest_dir, self.safe_filename + '.mp3')
+
+    def lame_tags(self, book_tags):
+        # book level tags (ta, tl, ty, tg, tc, ti) plus this track's title and number
+        tags = dict(book_tags)
+        tags['tt'] = self.tt
+        tags['tn'] = self.tn
+        return tags
@@ -0,0 +1,56 @@
+import wave
+from array import array
+
+# tracks shorter than this are encoded in one piece
+SEGMENT_MIN_SECONDS = 300
+# how far either side of an even split point to look for a pause
+SEARCH_SECONDS = 5.0
+WINDOW_MS = 20
+
+
+def window_energy(pcm, sampwidth):
+    # sum of absolute sample values of a block of PCM
+    if sampwidth == 2:
+        samples = array('h')
+        samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+        return sum(map(abs, samples))
+    if sampwidth == 1:
+        return sum(abs(b - 128) for b in bytearray(pcm))
+    raise ValueError('%d bit PCM is not supported' % (sampwidth * 8))
+
+def quietest_frame(w, centre, search_frames, window_frames):
+    # start of the quietest window near centre, i.e. the middle of a pause between words
+    sampwidth = w.getsampwidth()
+    start = max(0, centre - search_frames)
+    end = min(w.getnframes() - window_frames, centre + search_frames)
+    if end <= start:
+        return centre
+    w.setpos(start)
+    pcm = w.readframes(end + window_frames - start)
+    frame_size = w.getnchannels() * sampwidth
+    best, best_energy = centre, None
+    for pos in range(0, end - start, window_frames):
+        energy = window_energy(pcm[pos * frame_size:(pos + window_frames) * frame_size], sampwidth)
+        # prefer the window nearest the even split point if there is a tie
+        if best_energy is None or energy < best_energy or \
+                (energy == best_energy and abs(start + pos - centre) < abs(best - centre)):
+            best, best_energy = start + pos + window_frames // 2, energy
+    return best
+
+def segment_ranges(wav_path, max_segments, min_seconds=SEGMENT_MIN_SECONDS):
+    ''' Split a track WAV into segments which can be encoded at the same time
+        Cuts are near even split points, moved to the quietest place within SEARCH_SECONDS,
+        so any difference in how the segments are encoded either side of a join is in a pause
+        Only reads the audio around the split points
+        returns list of (start frame, number of frames), one item if the track is too short to split
+    '''
+    with wave.open(wav_path, 'rb') as w:
+        nframes, rate = w.getnframes(), w.getframerate()
+        nsegments = min(max_segments, int(nframes / float(rate) / min_seconds))
+        if nsegments < 2:
+            return [(0, nframes)]
+        window_frames = max(1, rate * WINDOW_MS // 1000)
+        cuts = [quietest_frame(w, nframes * i // nsegments, int(SEARCH_SECONDS * rate), window_frames)
+                for i in range(1, nsegments)]
+    bounds = [0] + cuts + [nframes]
+    return [(bounds[i], bounds[i+1] - bounds[i]) for i in range(nsegments) if bounds[i+1] > bounds[i]]
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import time
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+from calibre_plugins.tts_to_mp3_plugin.journal import jobs_root
+
+SPOOL_DB = 'spool.db'
+# entries of a job which hasn't touched the spool for this long are from a job that was killed
+STALE_SECONDS = 120
+# how often a job marks its entries as alive
+TOUCH_SECONDS = 10
+
+
+class Spool(object):
+    ''' Disk budget for the intermediate files (WAVs, MP3 pieces) of every running job
+        The files stay in each job's own dir, the spool only accounts for them.
+        The ledger is kept in SQLite so the jobs of several books share the one budget
+        Each file is reserved before it is written with the number of steps which will
+        read it (refs). When the last of them calls consume() the file is deleted and
+        its bytes are free for the next producer
+        A job with nothing in the spool may always reserve, so jobs can't wait on each
+        other forever. The budget can be overrun by one file per job
+        :job_key: identifies this job's entries in the ledger
+        :max_bytes: budget for all jobs. 0 for no limit; files are still refcounted
+    '''
+
+    def __init__(self, job_key, max_bytes):
+        self.job_key = job_key
+        self.max_bytes = max_bytes
+        self.refs = {}
+        self.sizes = {}
+        self.used = 0
+        self.peak = 0
+        self.peak_all = 0
+        self.last_touch = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(os.path.join(jobs_root(), SPOOL_DB),
+                        timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(path TEXT PRIMARY KEY, job TEXT NOT NULL, size INTEGER NOT NULL, seen REAL NOT NULL)')
+            self._conn = conn
+        return self._conn
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def total(self):
+        # bytes reserved by all live jobs
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries WHERE seen > ?',
+                                 (time.time() - STALE_SECONDS,)).fetchone()[0]
+
+    def try_reserve(self, path, nbytes, refs=1):
+        ''' Reserve nbytes for a file which will be read by refs steps
+            returns False, without waiting, if that would go over the budget
+        '''
+        if self.enabled:
+            conn = self.conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                total = self.total()
+                if self.used and total + nbytes > self.max_bytes:
+                    conn.execute('ROLLBACK')
+                    return False
+                conn.execute('INSERT OR REPLACE INTO entries (path, job, size, seen) VALUES (?, ?, ?, ?)',
+                             (path, self.job_key, nbytes, time.time()))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            self.peak_all = max(self.peak_all, total + nbytes)
+        self.add(path, nbytes, refs)
+        return True
+
+    def force(self, path, nbytes=None, refs=1):
+        ''' Account for a file which is written whatever the budget, e.g. the track WAV
+            joined from chunk WAVs which are consumed at the same time
+            :nbytes: default the size of the file
+        '''
+        if nbytes is None:
+            nbytes = file_size(path)
+        if self.enabled:
+            self.conn.execute('INSERT OR REPLACE INTO entries (path, job, size, seen) VALUES (?, ?, ?, ?)',
+                              (path, self.job_key, nbytes, time.time()))
+            self.peak_all = max(self.peak_all, self.total())
+        self.add(path, nbytes, refs)
+
+    def add(self, path, nbytes, refs):
+        self.used += nbytes - self.sizes.get(path, 0)
+        self.sizes[path] = nbytes
+        self.refs[path] = refs
+        self.peak = max(self.peak, self.used)
+
+    def resize(self, path):
+        # the file is written: account for its real size instead of the estimate
+        if path in self.refs:
+            self.force(path, file_size(path), self.refs[path])
+
+    def add_refs(self, path, refs):
+        # more steps will read the file
+        if path in self.refs:
+            self.refs[path] += refs
+
+    def consume(self, path):
+        # a step has finished with the file, delete it after the last one
+        refs = self.refs.get(path, 1) - 1
+        if refs > 0:
+            self.refs[path] = refs
+            return
+        self.refs.pop(path, None)
+        self.used -= self.sizes.pop(path, 0)
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            pass
+        if self.enabled:
+            self.conn.execute('DELETE FROM entries WHERE path=?', (path,))
+
+    def touch(self):
+        # keep this job's entries counted, see STALE_SECONDS
+        now = time.time()
+        if self.enabled and now - self.last_touch > TOUCH_SECONDS:
+            self.conn.execute('UPDATE entries SET seen=? WHERE job=?', (now, self.job_key))
+            self.conn.execute('DELETE FROM entries WHERE seen <= ?', (now - STALE_SECONDS,))
+            self.last_touch = now
+
+    def report(self):
+        msg = 'Spool peak: {0:.1f} MB'.format(self.peak / 1e6)
+        if self.enabled:
+            msg += ' (all jobs {0:.1f} MB, budget {1:.0f} MB)'.format(self.peak_all / 1e6, self.max_bytes / 1e6)
+        return msg
+
+    def close(self):
+        # drop this job's entries, files left unconsumed belong to a job which can be resumed
+        if self._conn is not None:
+            try:
+                self._conn.execute('DELETE FROM entries WHERE job=?', (self.job_key,))
+            except sqlite3.Error as err:
+                print('{0}:Spool: {1}'.format(PLUGIN_NAME, err))
+            self._conn.close()
+            self._conn = None
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except EnvironmentError:
+        return 0
@@ -0,0 +1,41 @@
+'''
+Tests for the plugin's modules which don't need the calibre GUI
+Run with the plugin installed in calibre, so calibre's modules can be imported:
+
+    calibre-debug -c "import sys, pytest; sys.exit(pytest.main(['tests']))"
+
+or with plain pytest (pytest tests), which skips the tests of modules that import calibre
+'''
+import ast
+import os
+import sys
+import types
+
+PLUGIN_PACKAGE = 'calibre_plugins.tts_to_mp3_plugin'
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def plugin_name():
+    # PLUGIN_NAME from __init__.py, which can't be imported without calibre's plugin classes
+    with open(os.path.join(PLUGIN_DIR, '__init__.py'), 'rb') as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and [t.id for t in node.targets if isinstance(t, ast.Name)] == ['PLUGIN_NAME']:
+            return ast.literal_eval(node.value)
+
+def add_plugin_package():
+    # the plugin's modules as calibre's plugin loader names them, loaded from this dir
+    try:
+        __import__(PLUGIN_PACKAGE)
+        return
+    except ImportError:
+        pass
+    parent = sys.modules.setdefault('calibre_plugins', types.ModuleType('calibre_plugins'))
+    parent.__path__ = getattr(parent, '__path__', [])
+    package = types.ModuleType(PLUGIN_PACKAGE)
+    package.__path__ = [PLUGIN_DIR]
+    package.PLUGIN_NAME = plugin_name()
+    sys.modules[PLUGIN_PACKAGE] = package
+    parent.tts_to_mp3_plugin = package
+
+add_plugin_package()
@@ -0,0 +1,59 @@
+import random
+
+from calibre_plugins.tts_to_mp3_plugin.chunker import split_text, chunk_byte_ranges, count_chunk_words
+
+WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'a', 'lazy', 'dog', 'café', 'naïve', '“quoted”')
+
+
+def make_text(seed, paragraphs=40):
+    rng = random.Random(seed)
+    paras = []
+    for p in range(paragraphs):
+        sentences = []
+        for s in range(rng.randint(1, 12)):
+            words = [rng.choice(WORDS) for w in range(rng.randint(1, 30))]
+            sentences.append(' '.join(words) + rng.choice('.!?'))
+        paras.append(' '.join(sentences))
+    return '\n\n'.join(paras) + '\n'
+
+
+def test_short_text_is_one_piece():
+    assert split_text('Just a few words.', 10) == ['Just a few words.']
+    assert split_text('', 10) == []
+
+def test_round_trip_and_max_words():
+    for seed in range(20):
+        text = make_text(seed)
+        for max_words in (5, 37, 200):
+            pieces = split_text(text, max_words)
+            assert ''.join(pieces) == text
+            assert all(count_chunk_words(p) <= max_words for p in pieces)
+            assert all(p for p in pieces)
+
+def test_run_on_sentence_is_split_between_words():
+    text = '  ' + ' '.join('word%d' % i for i in range(95))
+    pieces = split_text(text, 10)
+    assert ''.join(pieces) == text
+    assert max(count_chunk_words(p) for p in pieces) == 10
+
+def test_paragraphs_are_kept_whole_when_they_fit():
+    paras = ['one two three.', 'four five six.', 'seven eight nine.']
+    pieces = split_text('\n\n'.join(paras), 3)
+    assert [p.strip() for p in pieces] == paras
+
+def test_later_chunks_survive_an_early_edit():
+    text = make_text(1, paragraphs=80)
+    edited = 'An extra opening sentence.\n\n' + text
+    before, after = split_text(text, 100), split_text(edited, 100)
+    # content-defined boundaries resynchronise, so most chunks are unchanged
+    assert len(set(before) & set(after)) >= len(before) // 2
+
+def test_byte_ranges_map_onto_utf8_store():
+    text = make_text(3)
+    data = text.encode('utf-8')
+    ranges = chunk_byte_ranges(text, 1000, 50)
+    assert ranges[0][0] == 1000
+    for (offset, length), (next_offset, x) in zip(ranges, ranges[1:]):
+        assert offset + length == next_offset
+    assert b''.join(data[o - 1000:o - 1000 + n] for o, n in ranges) == data
+    assert [data[o - 1000:o - 1000 + n].decode('utf-8') for o, n in ranges] == split_text(text, 50)
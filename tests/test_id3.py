@@ -0,0 +1,80 @@
+from calibre_plugins.tts_to_mp3_plugin.id3 import (id3v2_tag, read_frames, replace_text_frames, audio_span,
+        text_frame, syncsafe, unsyncsafe)
+
+AUDIO = b'\xff\xfb\x90\xc0' + b'\x55' * 413
+
+
+def id3v1_tag(title, track):
+    return b'TAG' + title.ljust(30, b'\x00') + b'\x00' * 30 * 2 + b'2020' + b'\x00' * 28 + bytes([0, track, 12])
+
+def frames_of(path):
+    with open(path, 'rb') as f:
+        major, frames = read_frames(f)
+        return major, dict(frames), f.read()
+
+def text_of(raw):
+    # text of a UTF-16 text frame written by text_frame()
+    return raw[11:].decode('utf-16').rstrip('\x00')
+
+
+def test_syncsafe():
+    for n in (0, 1, 127, 128, 0x0fffffff):
+        assert unsyncsafe(syncsafe(n)) == n
+
+def test_replace_text_frames_keeps_other_frames(tmp_path):
+    path = str(tmp_path / 'a.mp3')
+    tags = {'ta': 'Author', 'tl': 'Book', 'tt': 'Chapter 1', 'tn': '1', 'tc': 'A comment'}
+    with open(path, 'wb') as f:
+        f.write(id3v2_tag(tags) + AUDIO)
+    major, before, audio = frames_of(path)
+    replace_text_frames(path, dict(tags, tt='Chapter 2', tn='2'))
+    major, after, audio = frames_of(path)
+    assert audio == AUDIO
+    assert sorted(after) == sorted(before)
+    for frame_id in ('TPE1', 'TALB', 'COMM'):
+        assert after[frame_id] == before[frame_id]
+    assert text_of(after['TIT2']) == 'Chapter 2'
+    assert text_of(after['TRCK']) == '2'
+
+def test_replace_text_frames_v24(tmp_path):
+    path = str(tmp_path / 'a.mp3')
+    raw = text_frame('TPE1', 'Author')
+    raw = raw[:4] + syncsafe(len(raw) - 10) + raw[8:]
+    with open(path, 'wb') as f:
+        f.write(b'ID3\x04\x00\x00' + syncsafe(len(raw)) + raw + AUDIO)
+    replace_text_frames(path, {'ta': 'Someone else', 'tt': 'Title', 'tn': '3'})
+    major, frames, audio = frames_of(path)
+    assert major == 4 and audio == AUDIO
+    assert frames['TPE1'] == raw
+    assert unsyncsafe(frames['TRCK'][4:8]) == len(frames['TRCK']) - 10
+
+def test_file_with_no_tag_gets_every_tag(tmp_path):
+    path = str(tmp_path / 'a.mp3')
+    with open(path, 'wb') as f:
+        f.write(AUDIO)
+    tags = {'ta': 'Author', 'tl': 'Book', 'tt': 'Chapter 1', 'tn': '1'}
+    replace_text_frames(path, tags)
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data == id3v2_tag(tags) + AUDIO
+
+def test_id3v1_tag_is_updated(tmp_path):
+    path = str(tmp_path / 'a.mp3')
+    tags = {'ta': 'Author', 'tt': 'Old', 'tn': '1'}
+    with open(path, 'wb') as f:
+        f.write(id3v2_tag(tags) + AUDIO + id3v1_tag(b'Old', 1))
+    replace_text_frames(path, dict(tags, tt='New title', tn='7'))
+    with open(path, 'rb') as f:
+        data = f.read()
+    start, end = audio_span(data)
+    assert data[start:end] == AUDIO
+    v1 = data[-128:]
+    assert v1[3:33] == b'New title'.ljust(30, b'\x00')
+    assert (v1[125], v1[126]) == (0, 7)
+    assert v1[93:97] == b'2020'
+
+def test_audio_span():
+    tag = id3v2_tag({'tt': 'x'})
+    data = tag + AUDIO + id3v1_tag(b'x', 1)
+    assert audio_span(data) == (len(tag), len(tag) + len(AUDIO))
+    assert audio_span(AUDIO) == (0, len(AUDIO))
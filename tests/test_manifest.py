@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+pytest.importorskip('calibre')
+
+from calibre_plugins.tts_to_mp3_plugin.id3 import id3v2_tag, read_frames
+from calibre_plugins.tts_to_mp3_plugin.manifest import new_manifest, renumber_tracks
+from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+
+AUDIO = b'\xff\xfb\x90\xc0' + b'\x55' * 413
+BOOK_TAGS = {'ta': 'Author', 'tl': 'Book'}
+
+
+def record(name, title, track):
+    rec = SpineRecord(name, title, True, title, 2)
+    rec.track = track
+    return rec
+
+def write_mp3(mp3_dir, rec, audio=AUDIO):
+    path = rec.mp3_file_name(mp3_dir)
+    with open(path, 'wb') as f:
+        f.write(id3v2_tag(rec.lame_tags(BOOK_TAGS)) + audio)
+    return os.path.basename(path)
+
+def track_tag(path):
+    with open(path, 'rb') as f:
+        major, frames = read_frames(f)
+        return dict(frames)['TRCK'][11:].decode('utf-16').rstrip('\x00'), f.read()
+
+
+def test_renumber_swap_cycle(tmp_path):
+    mp3_dir = str(tmp_path)
+    a, b = record('a.html', 'A', 1), record('b.html', 'B', 2)
+    manifest = new_manifest()
+    for rec, audio in ((a, AUDIO), (b, AUDIO[:4] + b'\xaa' * 413)):
+        manifest['tracks'][rec.name] = {'file': write_mp3(mp3_dir, rec, audio), 'track': rec.track}
+    # the chapters have changed places
+    a.track, b.track = 2, 1
+    moves = renumber_tracks(manifest, [a, b], mp3_dir, BOOK_TAGS)
+    assert sorted(moves) == [('01_A.mp3', '02_A.mp3'), ('02_B.mp3', '01_B.mp3')]
+    assert sorted(os.listdir(mp3_dir)) == ['01_B.mp3', '02_A.mp3']
+    tracks = manifest['tracks']
+    assert tracks['a.html'] == {'file': '02_A.mp3', 'track': 2}
+    assert tracks['b.html'] == {'file': '01_B.mp3', 'track': 1}
+    assert track_tag(os.path.join(mp3_dir, '02_A.mp3')) == ('2', AUDIO)
+    assert track_tag(os.path.join(mp3_dir, '01_B.mp3'))[0] == '1'
+
+def test_renumber_keeps_a_file_in_the_way(tmp_path):
+    mp3_dir = str(tmp_path)
+    a = record('a.html', 'A', 1)
+    manifest = new_manifest()
+    manifest['tracks'][a.name] = {'file': write_mp3(mp3_dir, a), 'track': 1}
+    # not a track of the manifest, e.g. a stale MP3
+    with open(os.path.join(mp3_dir, '02_A.mp3'), 'wb') as f:
+        f.write(b'other')
+    a.track = 2
+    assert renumber_tracks(manifest, [a], mp3_dir, BOOK_TAGS) == []
+    # the track is recorded again next time, both files are left as they were
+    assert 'a.html' not in manifest['tracks']
+    assert sorted(os.listdir(mp3_dir)) == ['01_A.mp3', '02_A.mp3']
+    with open(os.path.join(mp3_dir, '02_A.mp3'), 'rb') as f:
+        assert f.read() == b'other'
+
+def test_renumber_unmoved_tracks_are_left_alone(tmp_path):
+    mp3_dir = str(tmp_path)
+    a = record('a.html', 'A', 1)
+    manifest = new_manifest()
+    manifest['tracks'][a.name] = {'file': write_mp3(mp3_dir, a), 'track': 1}
+    assert renumber_tracks(manifest, [a, record('new.html', 'New', 2)], mp3_dir, BOOK_TAGS) == []
+    assert manifest['tracks'] == {'a.html': {'file': '01_A.mp3', 'track': 1}}
@@ -0,0 +1,163 @@
+import io
+import os
+import struct
+
+import pytest
+
+from calibre_plugins.tts_to_mp3_plugin.mpeg import (FrameHeader, FrameJoiner, scan_frames, main_data,
+        with_main_data_begin, overlap_ranges, frame_samples, xing_frame, xing_frame_length, xing_toc,
+        crc16, ENCODER_DELAY, PREROLL_FRAMES, MAX_RESERVOIR)
+
+# MPEG1 Layer III, no CRC, 128 kbps, 44.1 kHz, mono: 417 byte frames with 396 bytes of main data area
+HEADER = struct.pack('>I', 0xfffb90c0)
+
+
+def side_info(begin, length):
+    # mono MPEG1 side info: main_data_begin, then the first granule holds all the main data
+    bits = (begin << 127) | ((length * 8) << (136 - 18 - 12))
+    return bits.to_bytes(17, 'big')
+
+def make_piece(lengths, reservoir=True):
+    ''' Frames whose main data are lengths bytes of their frame number, each starting as
+        early as the bit reservoir allows
+    '''
+    header = FrameHeader(HEADER)
+    areas, heads, data_end = bytearray(), [], 0
+    for i, length in enumerate(lengths):
+        area_start = len(areas)
+        start = max(data_end, area_start - MAX_RESERVOIR) if reservoir else area_start
+        assert start + length <= area_start + header.area_size
+        heads.append(HEADER + side_info(area_start - start, length))
+        areas += b'\x00' * header.area_size
+        areas[start:start + length] = bytes([i % 256]) * length
+        data_end = start + length
+    return b''.join(head + areas[i * header.area_size:(i + 1) * header.area_size] for i, head in enumerate(heads))
+
+def frame_data(data):
+    # main data of each frame, checking it is where a decoder can find it
+    header, offsets, bitrates = scan_frames(data, 0, len(data))
+    stream, result, data_end = bytearray(), [], 0
+    for offset in offsets:
+        header = FrameHeader(data, offset)
+        area_start = len(stream)
+        stream += data[offset + header.xing_offset:offset + header.length]
+        begin, length = main_data(data, offset, header)
+        assert data_end <= area_start - begin
+        assert area_start - begin + length <= len(stream)
+        result.append(bytes(stream[area_start - begin:area_start - begin + length]))
+        data_end = area_start - begin + length
+    return result
+
+def join(pieces, skip=0):
+    out = io.BytesIO()
+    joiner = FrameJoiner(out)
+    for i, piece in enumerate(pieces):
+        header, offsets, bitrates = scan_frames(piece, 0, len(piece))
+        joiner.add(piece, 0, offsets, bitrates, skip=skip if i else 0)
+    joiner.flush()
+    return joiner, out.getvalue()
+
+
+def test_main_data_round_trip():
+    header = FrameHeader(HEADER)
+    data = HEADER + side_info(300, 250)
+    assert main_data(data, 0, header) == (300, 250)
+    side = with_main_data_begin(data[4:], header, 17)
+    assert main_data(HEADER + side, 0, header) == (17, 250)
+
+def test_piece_frames_are_copied_as_they_are():
+    piece = make_piece([380, 396, 100, 396, 390])
+    joiner, data = join([piece])
+    assert data == piece
+    assert list(joiner.offsets) == [i * 417 for i in range(5)]
+
+def test_join_moves_main_data_into_the_frames_before():
+    first = make_piece([100, 200, 50])
+    # the first frames of the second piece use the reservoir of frames which are dropped
+    second = make_piece([10, 10, 390, 396, 396, 300, 396])
+    joiner, data = join([first, second], skip=2)
+    frames = frame_data(data)
+    assert len(frames) == len(joiner.offsets) == 3 + 5
+    expected = [bytes([i]) * n for i, n in enumerate([100, 200, 50])] + \
+               [bytes([i]) * n for i, n in enumerate([10, 10, 390, 396, 396, 300, 396])][2:]
+    assert frames == expected
+    assert joiner.bitrates == {128000}
+
+def test_main_data_with_no_room_gets_a_higher_bitrate():
+    # the reservoir is full at the end of the first piece, and the second piece's first
+    # kept frame has more main data than its own area
+    first = make_piece([396] * 3, reservoir=False)
+    second = make_piece([10, 396, 396 + 100 - 10, 396], reservoir=True)
+    joiner, data = join([first, second], skip=2)
+    frames = frame_data(data)
+    assert frames[3:] == [bytes([2]) * 486, bytes([3]) * 396]
+    assert len(joiner.bitrates) > 1
+    assert FrameHeader(data, joiner.offsets[3]).bitrate > 128000
+
+def test_xing_frame_lame_tag():
+    first = FrameHeader(HEADER)
+    offsets = [i * 417 for i in range(1000)]
+    frame = xing_frame(first, 1000, 417000, xing_toc(offsets, 417000), False, ENCODER_DELAY, 1234)
+    assert len(frame) == xing_frame_length(first, lame_tag=True)
+    header = FrameHeader(frame)
+    info = header.xing_offset
+    assert frame[info:info + 4] == b'Info'
+    flags, nframes, nbytes = struct.unpack('>III', frame[info + 4:info + 16])
+    assert (nframes, nbytes) == (1000, 417000)
+    lame = info + 120
+    assert frame[lame:lame + 4] == b'LAME'
+    delay_padding = int.from_bytes(frame[lame + 21:lame + 24], 'big')
+    assert (delay_padding >> 12, delay_padding & 0xfff) == (ENCODER_DELAY, 1234)
+    assert struct.unpack('>H', frame[lame + 34:lame + 36])[0] == crc16(frame[:lame + 34])
+
+def test_crc16():
+    assert crc16(b'123456789') == 0xbb3d
+
+@pytest.mark.parametrize('sample_rate', [16000, 22050, 44100])
+def test_overlap_ranges_are_on_the_frame_grid(sample_rate):
+    samples = frame_samples(sample_rate)
+    total = sample_rate * 1000 + 123
+    ranges = [(0, 333333), (333333, 400000), (733333, total - 733333)]
+    segments = overlap_ranges(ranges, sample_rate)
+    assert len(segments) == 3
+    assert segments[0][0] == 0
+    assert segments[-1][0] + segments[-1][1] == total and segments[-1][2] is None
+    firsts = [0]
+    for i, (start, nframes, keep) in enumerate(segments):
+        assert start % samples == 0
+        if i:
+            firsts.append(start // samples + PREROLL_FRAMES)
+            # the cut moved to the nearest frame boundary of the whole track
+            assert abs(firsts[-1] * samples - ENCODER_DELAY - ranges[i][0]) <= samples // 2
+    for i, (start, nframes, keep) in enumerate(segments[:-1]):
+        # kept frames run up to the next segment's first frame, with audio after them to encode
+        assert keep == (PREROLL_FRAMES if i else 0) + firsts[i + 1] - firsts[i]
+        assert start + nframes >= (firsts[i + 1] * samples) - ENCODER_DELAY
+
+def test_overlap_ranges_drops_cuts_too_close_together():
+    segments = overlap_ranges([(0, 100000), (100000, 500), (100500, 100000)], 44100)
+    assert len(segments) == 2
+
+def test_join_mp3s_frame_and_info_counts(tmp_path):
+    pytest.importorskip('calibre')
+    from calibre_plugins.tts_to_mp3_plugin.utils import join_mp3s
+    paths = []
+    for i, lengths in enumerate(([300] * 10, [50, 50] + [396] * 7, [200] * 5)):
+        path = str(tmp_path / ('seg%d.mp3' % i))
+        with open(path, 'wb') as f:
+            f.write(make_piece(lengths))
+        paths.append(path)
+    out_path = str(tmp_path / 'track.mp3')
+    join_mp3s(paths, out_path, b'ID3\x03\x00\x00\x00\x00\x00\x00', preroll=2, nsamples=20 * 1152 - 1000)
+    with open(out_path, 'rb') as f:
+        data = f.read()[10:]
+    info = FrameHeader(data)
+    xing = data[info.xing_offset:info.xing_offset + 16]
+    assert xing[:4] == b'Info'
+    nframes, nbytes = struct.unpack('>II', xing[8:16])
+    assert (nframes, nbytes) == (10 + 7 + 3, len(data))
+    assert len(frame_data(data[info.length:])) == nframes
+    lame = info.xing_offset + 120
+    delay_padding = int.from_bytes(data[lame + 21:lame + 24], 'big')
+    assert (delay_padding >> 12, delay_padding & 0xfff) == (ENCODER_DELAY, 1000 - ENCODER_DELAY)
+    assert not any(os.path.exists(path) for path in paths)
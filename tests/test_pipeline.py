@@ -0,0 +1,87 @@
+import threading
+from queue import Queue
+
+from calibre_plugins.tts_to_mp3_plugin.pipeline import StageScheduler, ThreadStage
+
+
+def scheduler(slots, **encode):
+    s = StageScheduler(slots)
+    s.add_stage('synth')
+    s.add_stage('encode', **encode)
+    return s
+
+
+def test_later_stage_first_and_slots():
+    s = scheduler(2)
+    s.push('synth', 's1')
+    s.push('synth', 's2')
+    s.push('encode', 'e1')
+    assert s.next_work() == ('encode', 'e1')
+    assert s.next_work() == ('synth', 's1')
+    # both slots busy
+    assert s.next_work() is None
+    s.finished('encode')
+    assert s.next_work() == ('synth', 's2')
+    assert s.running == 2 and not s.idle
+
+def test_backlog_limit_holds_back_earlier_stage():
+    s = scheduler(4, backlog_limit=1)
+    s.push('synth', 's1')
+    s.push('encode', 'e1')
+    s.push('encode', 'e2')
+    assert s.next_work() == ('encode', 'e1')
+    assert s.next_work() == ('encode', 'e2')
+    # the encode backlog is at its limit, so no more synthesis
+    assert s.next_work() is None
+    s.finished('encode')
+    s.finished('encode')
+    assert s.next_work() == ('synth', 's1')
+    s.finished('synth')
+    assert s.idle
+
+def test_admit_holds_back_work():
+    allowed = set()
+    s = StageScheduler(1)
+    s.add_stage('synth', admit=lambda work: work in allowed)
+    s.push('synth', 'a')
+    assert s.next_work() is None
+    allowed.add('a')
+    assert s.next_work() == ('synth', 'a')
+
+def test_zero_slots_is_one():
+    assert StageScheduler(0).slots == 1
+
+def test_thread_stage_results():
+    results = Queue()
+    def func(work):
+        if work == 'bad':
+            raise ValueError('bad work')
+        return work.upper()
+    stage = ThreadStage('copy', func, results)
+    stage.start()
+    for work in ('a', 'bad', 'b'):
+        stage.put(work)
+    got = [results.get(timeout=10) for i in range(3)]
+    stage.close()
+    assert got[0] == ('copy', 'a', True, 'A')
+    assert got[1][:3] == ('copy', 'bad', False) and 'bad work' in got[1][3]
+    assert got[2] == ('copy', 'b', True, 'B')
+
+def test_thread_stage_byte_budget():
+    results = Queue()
+    release = threading.Event()
+    stage = ThreadStage('copy', lambda work: release.wait(10), results, max_bytes=10, size=len)
+    stage.start()
+    stage.put('123456')
+    # a second item would go over the budget, so put() waits until the first is done
+    second = threading.Thread(target=stage.put, args=('7890123',))
+    second.start()
+    second.join(0.2)
+    assert second.is_alive()
+    release.set()
+    second.join(10)
+    assert not second.is_alive()
+    results.get(timeout=10)
+    results.get(timeout=10)
+    stage.close()
+    assert stage.queued_bytes == 0
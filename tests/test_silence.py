@@ -0,0 +1,53 @@
+import math
+import struct
+import wave
+
+from calibre_plugins.tts_to_mp3_plugin.silence import window_energy, segment_ranges
+
+RATE = 8000
+
+
+def write_wav(path, seconds, pauses=(), sampwidth=2):
+    ''' A tone with silent pauses, given as (start, end) seconds '''
+    frames = bytearray()
+    for i in range(int(seconds * RATE)):
+        t = float(i) / RATE
+        quiet = any(start <= t < end for start, end in pauses)
+        value = 0 if quiet else int(8000 * math.sin(2 * math.pi * 440 * t))
+        frames += struct.pack('<h', value) if sampwidth == 2 else bytes([128 + value // 256])
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(sampwidth)
+        w.setframerate(RATE)
+        w.writeframes(bytes(frames))
+
+
+def test_window_energy():
+    assert window_energy(struct.pack('<4h', 0, 0, 0, 0), 2) == 0
+    assert window_energy(struct.pack('<4h', 1, -2, 3, -4), 2) == 10
+    assert window_energy(bytes([128, 130, 126]), 1) == 4
+
+def test_short_track_is_one_segment(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, 3)
+    assert segment_ranges(path, 4, min_seconds=2) == [(0, 3 * RATE)]
+
+def test_segments_cover_the_track_and_cut_in_pauses(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    # pauses a little way from the even split points at 10 and 20 seconds
+    pauses = ((11.0, 11.3), (17.5, 17.8))
+    write_wav(path, 30, pauses)
+    ranges = segment_ranges(path, 3, min_seconds=5)
+    assert len(ranges) == 3
+    assert ranges[0][0] == 0
+    assert sum(n for start, n in ranges) == 30 * RATE
+    for (start, n), (next_start, x) in zip(ranges, ranges[1:]):
+        assert start + n == next_start
+    for (start, n), (pause_start, pause_end) in zip(ranges[1:], pauses):
+        assert pause_start * RATE <= start <= pause_end * RATE
+
+def test_8_bit_wav(tmp_path):
+    path = str(tmp_path / 'a.wav')
+    write_wav(path, 12, ((5.5, 5.8),), sampwidth=1)
+    ranges = segment_ranges(path, 2, min_seconds=5)
+    assert 5.5 * RATE <= ranges[1][0] <= 5.8 * RATE
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+pytest.importorskip('calibre')
+
+from calibre_plugins.tts_to_mp3_plugin import spool as spool_module
+from calibre_plugins.tts_to_mp3_plugin.spool import Spool
+
+
+@pytest.fixture
+def jobs_dir(tmp_path, monkeypatch):
+    # keep the shared ledger out of the real cache dir
+    monkeypatch.setattr(spool_module, 'jobs_root', lambda: str(tmp_path))
+    return tmp_path
+
+def write(path, nbytes):
+    with open(path, 'wb') as f:
+        f.write(b'\x00' * nbytes)
+    return path
+
+
+def test_consume_deletes_after_last_ref(jobs_dir):
+    spool = Spool('job', 0)
+    path = write(str(jobs_dir / 'a.wav'), 100)
+    spool.force(path, refs=2)
+    assert spool.used == 100
+    spool.consume(path)
+    assert os.path.exists(path) and spool.used == 100
+    spool.consume(path)
+    assert not os.path.exists(path) and spool.used == 0
+    assert spool.peak == 100
+    spool.close()
+
+def test_add_refs(jobs_dir):
+    spool = Spool('job', 0)
+    path = write(str(jobs_dir / 'a.wav'), 10)
+    spool.force(path)
+    spool.add_refs(path, 1)
+    spool.consume(path)
+    assert os.path.exists(path)
+    spool.consume(path)
+    assert not os.path.exists(path)
+    spool.close()
+
+def test_budget(jobs_dir):
+    spool = Spool('job', 1000)
+    first, second = str(jobs_dir / 'a.wav'), str(jobs_dir / 'b.wav')
+    # the first file is always allowed, even over the budget
+    assert spool.try_reserve(first, 1500)
+    assert not spool.try_reserve(second, 10)
+    spool.consume(write(first, 1500))
+    assert spool.total() == 0
+    assert spool.try_reserve(second, 600)
+    assert not spool.try_reserve(first, 600)
+    spool.close()
+
+def test_budget_is_shared_between_jobs(jobs_dir):
+    one, two = Spool('one', 1000), Spool('two', 1000)
+    assert one.try_reserve(str(jobs_dir / 'a.wav'), 800)
+    assert two.try_reserve(str(jobs_dir / 'b.wav'), 800)
+    assert not two.try_reserve(str(jobs_dir / 'c.wav'), 100)
+    one.close()
+    # a closed job's entries no longer count
+    assert two.try_reserve(str(jobs_dir / 'c.wav'), 100)
+    two.close()
+
+def test_resize(jobs_dir):
+    spool = Spool('job', 1000)
+    path = str(jobs_dir / 'a.wav')
+    assert spool.try_reserve(path, 900, refs=2)
+    write(path, 300)
+    spool.resize(path)
+    assert spool.used == 300 and spool.total() == 300
+    assert spool.refs[path] == 2
+    spool.close()
@@ -0,0 +1,47 @@
+import pytest
+
+from calibre_plugins.tts_to_mp3_plugin.textstore import TextStoreWriter, TextStore
+
+TEXTS = {
+    'text/ch1.xhtml': 'Chapter one.\n\nIt was a dark night.',
+    'text/ch2.xhtml': 'Ünïcödé — “quoted” 日本語',
+    'text/empty.xhtml': '',
+    }
+
+
+def write_store(path):
+    refs = {}
+    with TextStoreWriter(path) as writer:
+        for name, text in sorted(TEXTS.items()):
+            refs[name] = writer.add(name, text)
+    return refs
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'book.store')
+    refs = write_store(path)
+    with TextStore(path) as store:
+        assert store.index == refs
+        for name, text in TEXTS.items():
+            assert store.text(*refs[name]) == text
+            assert store.text_for_name(name) == text
+
+def test_offsets_are_utf8_bytes(tmp_path):
+    path = str(tmp_path / 'book.store')
+    refs = write_store(path)
+    offset, length = refs['text/ch2.xhtml']
+    assert length == len(TEXTS['text/ch2.xhtml'].encode('utf-8'))
+    with TextStore(path) as store:
+        view = store.slice(offset, length)
+        try:
+            assert bytes(view) == TEXTS['text/ch2.xhtml'].encode('utf-8')
+        finally:
+            view.release()
+        # part of a text, as a chunk of a track is read
+        assert store.text(offset, len('Ünïcödé'.encode('utf-8'))) == 'Ünïcödé'
+
+def test_not_a_store(tmp_path):
+    path = tmp_path / 'other.txt'
+    path.write_bytes(b'just some text')
+    with pytest.raises(ValueError):
+        TextStore(str(path))
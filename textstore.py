@@ -0,0 +1,97 @@
+import json
+import mmap
+import struct
+
+# file layout: [utf-8 texts][json index][index offset: 8 bytes LE][MAGIC]
+MAGIC = b'E2ATXT01'
+FOOTER = struct.Struct('<Q')
+
+
+class TextStoreWriter(object):
+    ''' Write the extracted text of a book once, to a single file
+        add() returns the (offset, length) which is all a job payload needs to carry
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.offset = 0
+        self.index = {}
+
+    def add(self, name, text):
+        data = text.encode('utf-8')
+        self.f.write(data)
+        ref = (self.offset, len(data))
+        self.index[name] = ref
+        self.offset += len(data)
+        return ref
+
+    def close(self):
+        if self.f is None:
+            return
+        index = json.dumps(self.index, ensure_ascii=False).encode('utf-8')
+        self.f.write(index)
+        self.f.write(FOOTER.pack(self.offset))
+        self.f.write(MAGIC)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TextStore(object):
+    ''' Read-only, memory-mapped view of a file written by TextStoreWriter
+        Slices are taken straight from the mapping, without reading the whole file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError('Not a text store: %s' % path)
+        self._index = None
+
+    @property
+    def index(self):
+        # name: (offset, length), only decoded when needed
+        if self._index is None:
+            end = len(self.mm) - len(MAGIC) - FOOTER.size
+            index_offset = FOOTER.unpack(self.mm[end:end + FOOTER.size])[0]
+            self._index = {k: tuple(v) for k, v in json.loads(self.mm[index_offset:end].decode('utf-8')).items()}
+        return self._index
+
+    def slice(self, offset, length):
+        # zero-copy view of the raw utf-8 bytes
+        return memoryview(self.mm)[offset:offset + length]
+
+    def text(self, offset, length):
+        view = self.slice(offset, length)
+        try:
+            return str(view, 'utf-8')
+        finally:
+            view.release()
+
+    def text_for_name(self, name):
+        offset, length = self.index[name]
+        return self.text(offset, length)
+
+    def close(self):
+        # the mapping must be closed before the file can be deleted on Windows
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
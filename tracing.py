@@ -0,0 +1,90 @@
+import json
+import os
+from threading import Lock
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+
+TRACE_FILENAME = 'tts_to_mp3_trace.json'
+
+# pipeline stages, each is a category of spans in the trace
+SPAN_EXTRACT = 'extract'
+SPAN_SYNTH = 'synth'
+SPAN_JOIN = 'join'
+SPAN_ENCODE = 'encode'
+SPAN_COPY = 'copy'
+SPAN_TRACK = 'track'
+SPAN_STAGES = (SPAN_TRACK, SPAN_EXTRACT, SPAN_SYNTH, SPAN_JOIN, SPAN_ENCODE, SPAN_COPY)
+
+
+class JobTrace(object):
+    ''' Timed spans of a job's pipeline stages, for books whose djobmeta['write_trace'] is set
+        Saved in each MP3 dir as a Chrome trace, which can be opened in chrome://tracing
+        or https://ui.perfetto.dev. Each stage gets as many rows as it had spans
+        running at once, e.g. one row per busy worker while tracks are spoken
+        Spans may be added from the copier thread
+    '''
+
+    def __init__(self):
+        # mp3_dir -> (book_label, list of spans)
+        self.books = {}
+        self.lock = Lock()
+
+    def add(self, djobmeta, stage, name, start, end, **args):
+        ''' :start, end: time.time() values
+            :args: shown with the span, e.g. track, bytes
+        '''
+        if not djobmeta.get('write_trace'):
+            return
+        with self.lock:
+            label, spans = self.books.setdefault(djobmeta['mp3_dir'], (djobmeta.get('book_label'), []))
+            spans.append((stage, name, start, max(start, end), args))
+
+    def save(self):
+        # write a trace file in each MP3 dir, replacing the trace of an earlier run
+        with self.lock:
+            books = list(self.books.items())
+        for mp3_dir, (label, spans) in books:
+            path = os.path.join(mp3_dir, TRACE_FILENAME)
+            try:
+                with open(path, 'w') as f:
+                    json.dump({'traceEvents': trace_events(label, spans), 'displayTimeUnit': 'ms'}, f)
+                print('Trace saved: %s' % path)
+            except EnvironmentError as err:
+                print('{0}: Trace not saved: {1}: {2}'.format(PLUGIN_NAME, path, err))
+
+
+def assign_rows(spans):
+    # the first row free at each span's start, so spans on one row don't overlap
+    row_ends, rows = [], []
+    for start, end in spans:
+        for row, row_end in enumerate(row_ends):
+            if row_end <= start:
+                break
+        else:
+            row = len(row_ends)
+            row_ends.append(end)
+        row_ends[row] = end
+        rows.append(row)
+    return rows
+
+def trace_events(label, spans):
+    ''' Chrome trace events, complete ('X') events in microseconds from the first span
+        Rows are numbered by stage then row, and named e.g. "synth 2"
+    '''
+    if not spans:
+        return []
+    base = min(span[2] for span in spans)
+    events = [{'ph': 'M', 'pid': 1, 'name': 'process_name', 'args': {'name': label or PLUGIN_NAME}}]
+    for i, stage in enumerate(SPAN_STAGES):
+        stage_spans = sorted((span for span in spans if span[0] == stage), key=lambda span: span[2])
+        rows = assign_rows([(start, end) for x, x, start, end, x in stage_spans])
+        for row in sorted(set(rows)):
+            events.append({'ph': 'M', 'pid': 1, 'tid': i * 100 + row, 'name': 'thread_name',
+                           'args': {'name': '%s %d' % (stage, row + 1)}})
+            events.append({'ph': 'M', 'pid': 1, 'tid': i * 100 + row, 'name': 'thread_sort_index',
+                           'args': {'sort_index': i * 100 + row}})
+        for (stage, name, start, end, args), row in zip(stage_spans, rows):
+            events.append({'ph': 'X', 'pid': 1, 'tid': i * 100 + row, 'cat': stage, 'name': name,
+                           'ts': int((start - base) * 1e6), 'dur': int((end - start) * 1e6), 'args': args})
+    return events
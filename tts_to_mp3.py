@@ -1,31 +1,28 @@
-import os, shutil, re
+import os, shutil
+import time
 import traceback
+from threading import Thread
 
 from polyglot.builtins import as_unicode
 
 try:
     from qt.core import (
-        Qt, QDialog, QProgressDialog, QTimer, QIcon,
+        Qt, QObject, QDialog, QProgressDialog, QIcon, pyqtSignal,
         QVBoxLayout, QHBoxLayout, QGridLayout, QGroupBox, QDialogButtonBox, 
         QLabel, QPushButton, QComboBox, QSpinBox, QPixmap, QMessageBox)
 except ImportError:
     from PyQt5.Qt import (
-        Qt, QDialog, QProgressDialog, QTimer, QIcon,
+        Qt, QObject, QDialog, QProgressDialog, QIcon, pyqtSignal,
         QVBoxLayout, QHBoxLayout, QGridLayout, QGroupBox, QDialogButtonBox, 
         QLabel, QPushButton, QComboBox, QSpinBox, QPixmap, QMessageBox)
 
-from calibre import sanitize_file_name_unicode
 from calibre.devices.usbms.driver import debug_print
-from calibre.ebooks.oeb.polish.check.parsing import make_filename_safe
-from calibre.ebooks.oeb.polish.container import get_container
-from calibre.ebooks.oeb.polish.pretty import pretty_all
 from calibre.gui2 import choose_dir
 from calibre.gui2 import error_dialog, info_dialog, warning_dialog
 from calibre.ptempfile import PersistentTemporaryDirectory
-from calibre.spell.break_iterator import count_words
 from calibre.utils.date import now
+from calibre.constants import iswindows
 from calibre.utils.img import save_cover_data_to
-from calibre_extensions.winsapi import ISpVoice
 
 
 #import from this plugin
@@ -33,12 +30,77 @@ from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME, PLUGIN_CAPTION
 from calibre_plugins.tts_to_mp3_plugin.config import prefs
 from calibre_plugins.tts_to_mp3_plugin.other_dlgs import SelNamesDlg
 from calibre_plugins.tts_to_mp3_plugin.utils import (
-    extract_book_meta, get_page_text, 
-    get_sorted_voicedescs, get_voiceid_from_desc)
-from calibre_plugins.tts_to_mp3_plugin.common_utils import (
-    find_icon, extract_executable, get_toc_dict_list)
+    extract_book_meta, get_sorted_voicedescs, get_voiceid_from_desc, same_device, place_file,
+    create_spine_record, album_dir_name, default_mp3_tags, voice_comment)
+from calibre_plugins.tts_to_mp3_plugin.extract import get_text_cache, load_spine_text
+from calibre_plugins.tts_to_mp3_plugin.zipcontainer import get_spine_container
+from calibre_plugins.tts_to_mp3_plugin.textstore import TextStoreWriter
+from calibre_plugins.tts_to_mp3_plugin.journal import create_job_dir
+from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog, default_engine_name
+from calibre_plugins.tts_to_mp3_plugin.encoders import get_encoder, ENCODER_LAME
+from calibre_plugins.tts_to_mp3_plugin.manifest import (
+    load_manifest, save_manifest, render_settings, is_stale, stale_names, renumber_tracks)
+from calibre_plugins.tts_to_mp3_plugin.common_utils import find_icon, get_toc_dict_list
+from calibre_plugins.tts_to_mp3_plugin.batch import (
+    PROG_FILENAME, TEXT_STORE_FILENAME, OK_FORMATS, BatchError, find_lame, book_format_path,
+    prepare_book, interleave_files, remove_temp_dirs)
  
-PROG_FILENAME = 'lame.exe'
+
+
+class SpineTextLoader(QObject):
+    ''' Extract text, word counts and samples for each spine file in a background thread
+        Results are delivered to the GUI thread one name at a time, in spine sequence
+        If parallel is True, large books are extracted by a pool of worker processes
+        If a text cache is given, a book that has been loaded before is read from the cache
+        If the text can't all be loaded load_failed is sent with the error, unless aborted
+    '''
+    name_loaded = pyqtSignal(object, object)
+    load_finished = pyqtSignal()
+    load_failed = pyqtSignal(str)
+
+    def __init__(self, container, spine_list, language, img_alt_show, img_alt_prefix, 
+                parallel=False, cpus=None, cache=None, parent=None):
+        QObject.__init__(self, parent)
+        self.container = container
+        self.spine_list = list(spine_list)
+        self.language = language
+        self.img_alt_show = img_alt_show
+        self.img_alt_prefix = img_alt_prefix
+        self.parallel = parallel
+        self.cpus = cpus
+        self.cache = cache
+        self.aborted = False
+        self.load_thread = None
+        # (start, end) time.time() of a finished load
+        self.span = None
+
+    def start(self):
+        self.load_thread = Thread(target=self.run, name='TTSMP3SpineLoader')
+        self.load_thread.daemon = True
+        self.load_thread.start()
+
+    def abort(self):
+        self.aborted = True
+
+    def run(self):
+        start = time.time()
+        try:
+            finished = load_spine_text(self.container, self.spine_list, self.language,
+                            self.img_alt_show, self.img_alt_prefix, self.name_loaded.emit,
+                            parallel=self.parallel, cpus=self.cpus, cache=self.cache,
+                            abort=lambda: self.aborted)
+        except Exception as err:
+            traceback.print_exc()
+            if not self.aborted:
+                self.load_failed.emit('{0}: {1}'.format(err.__class__.__name__, err))
+            return
+        if finished:
+            self.span = (start, time.time())
+            self.load_finished.emit()
+        else:
+            if not self.aborted:
+                self.load_failed.emit('Text extraction stopped before every file was loaded')
+            self.aborted = True
 
 
 class EbookTTStoMP3(QDialog):
@@ -60,23 +122,37 @@ class EbookTTStoMP3(QDialog):
         
         self.container = None
         self.dest_dir = PersistentTemporaryDirectory('_ttsmp3')
+        self.in_job_dir = False
         self.mp3_dir = None
+        self.mp3_in_place = False
+        self.cover_file = None
         self.selected_names = []
         self.tempdir = None
         self.lame_path = None
         self.book_meta = {}
-        self.spVoice = ISpVoice()
-        self.all_voices = self.spVoice.get_all_voices()
+        self.engine_name = default_engine_name(prefs['tts_engine'])
+        self.catalog = voice_catalog(self.engine_name)
+        self.spVoice = self.catalog.acquire()
+        self.all_voices = self.catalog.voices
         self.vid = None
         self.voice_name = None
         self.voice_rate = 0
-        self.spinelistdict = []
+        self.spine_records = []
         self.spine_list = []
         self.toc_name_title_map = {}
         self.book_data_map = {}
-        self.name_data_map = {}
+        self.name_record_map = {}
+        self.book_tags = {}
         self.payload = []
+        self.text_store_path = None
         self.book_label = ''
+        self.spine_loader = None
+        self.loaded_count = 0
+        # set if the loader failed, the files loaded before it failed can still be recorded
+        self.load_error = None
+        # (start, end, words) of the text extraction, for the job's timing trace
+        self.extract_span = None
+        self.next_track = 1
 
         self.setWindowTitle(PLUGIN_CAPTION)
         icon = find_icon('images/plugin_icon.png')
@@ -172,13 +248,21 @@ class EbookTTStoMP3(QDialog):
         selspineButton.setToolTip("Useful for excluding front/backmatter")
         allfilesButton = QPushButton("&All")
         allfilesButton.setToolTip("All files which actually contain text")
+        self.changedfilesButton = QPushButton("C&hanged")
+        self.changedfilesButton.setToolTip("Files changed since the MP3s were last recorded")
+        self.changedfilesButton.setEnabled(False)
         self.totfilesLabel = QLabel('')
         self.avgwordsLabel = QLabel('')
+        self.manifestLabel = QLabel('')
+        self.loadingLabel = QLabel('')
         
         layfiles.addWidget(selspineButton, 0, 0)
         layfiles.addWidget(allfilesButton, 1, 0)
+        layfiles.addWidget(self.changedfilesButton, 2, 0)
         layfiles.addWidget(self.totfilesLabel, 0, 1)
         layfiles.addWidget(self.avgwordsLabel, 1, 1)
+        layfiles.addWidget(self.manifestLabel, 2, 1)
+        layfiles.addWidget(self.loadingLabel, 3, 0, 1, 2)
         
         grid = QGridLayout()
         grid.addWidget(self.bookLabel, 0, 0, 1, 2)
@@ -201,10 +285,12 @@ class EbookTTStoMP3(QDialog):
         self.voiceCombo.currentTextChanged.connect(self.voiceCombo_textChanged)
         self.rateSpin.valueChanged.connect(self.rateSpin_valueChanged)
         selspineButton.clicked.connect(self.selspineButton_clicked)
+        self.changedfilesButton.clicked.connect(self.preselect_stale_names)
         allfilesButton.clicked.connect(self.allfilesButton_clicked)
 
         try:
-            self.container = get_container(self.pathtoebook)
+            # EPUB/KEPUB: only the files needed for text extraction are unpacked
+            self.container = get_spine_container(self.pathtoebook)
             book_type = self.container.book_type
         except:
             book_type = None
@@ -217,27 +303,22 @@ class EbookTTStoMP3(QDialog):
         else:    
             self.initialise_data()
             if not self.all_voices:
-                errmsg = '\n*** The plugin cannot detect any voices to use for TTS on this PC'
+                errmsg = '\n*** The plugin cannot detect any voices to use for TTS on this PC [%s]' % self.spVoice.description
                 warning_dialog(self.gui, PLUGIN_NAME,
                     errmsg, show=True, show_copy_button=True)
-            elif not self.lame_path:
+            elif not self.lame_path and get_encoder(prefs['mp3_encoder']).name == ENCODER_LAME:
                 errmsg = '\n*** Could not find %s' % PROG_FILENAME
                 error_dialog(self.gui, PLUGIN_NAME,
                     errmsg, show=True, show_copy_button=True)
         
     def initialise_data(self):
-        # Tidy up the HTML code to avoid problems with too few line breaks
-        # and convert any HTML entities to unicode
-        
-        pretty_all(self.container)
-        
         # need a temp dir to store lame.exe
         self.tempdir = os.path.dirname(self.container.root)
         
         # extract lame.exe from plugin.zip and save in temp dir
-        self.lame_path = extract_executable(self.tempdir, PROG_FILENAME, plugin=PLUGIN_NAME)
+        self.lame_path = find_lame(self.tempdir)
         
-        # search Windows for descriptions of all available Voices
+        # search the TTS engine for descriptions of all available Voices
         all_descs = get_sorted_voicedescs(self.spVoice)
         self.voiceCombo.addItems(all_descs)
         
@@ -260,6 +341,7 @@ class EbookTTStoMP3(QDialog):
         self.book_meta = extract_book_meta(self.container, self.db, self.book_id)
         
         # build MP3 tag options from book meta
+        default_tags = default_mp3_tags(self.book_meta)
         artist_opts = set()
         for meta in ('authors', 'author_sort'):
             listmeta = [x for x in self.book_meta.get(meta)]
@@ -267,21 +349,21 @@ class EbookTTStoMP3(QDialog):
             artist_opts.add(' & '.join(self.book_meta.get(meta, [])[:3]))
             
         self.mp3tags['ta'].addItems(sorted(artist_opts))
-        self.mp3tags['ta'].setCurrentText(self.book_meta.get('author0'))
+        self.mp3tags['ta'].setCurrentText(default_tags['ta'])
         
         album_opts = set([self.book_meta.get(meta) for meta in ('title', 'title_sort', 'series_title') if self.book_meta.get(meta, None)])
         self.mp3tags['tl'].addItems(sorted(album_opts))
-        self.mp3tags['tl'].setCurrentText(self.book_meta.get('series_title', self.book_meta.get('title')))
+        self.mp3tags['tl'].setCurrentText(default_tags['tl'])
         
         thisyr = now().strftime("%Y")
-        year = self.book_meta.get('pubyear', thisyr)
+        year = default_tags['ty']
         year_opts = set([year, thisyr])
         self.mp3tags['ty'].addItems(sorted(year_opts))
         self.mp3tags['ty'].setCurrentText(year)
         
         genre_opts = set(['Speech'] + self.book_meta.get('tags', []))
         self.mp3tags['tg'].addItems(sorted(genre_opts))
-        self.mp3tags['tg'].setCurrentText('Speech')
+        self.mp3tags['tg'].setCurrentText(default_tags['tg'])
             
         self.display_book_meta()
         
@@ -312,27 +394,83 @@ class EbookTTStoMP3(QDialog):
 
         language = self.book_meta.get('language')
 
-        # build metadata dict per spine text file
-        track = 1
-        for name in self.spine_list:
-            self.name_data_map[name] = self.populate_name_data_map(name, track, padding, language, prefs['img_alt_show'], prefs['img_alt_prefix'])
-            if self.name_data_map[name].get('booktext'):
-                track += 1
-            
-        self.refresh_filecount()
-        
-        # build the row table to be used with the QDialog for selecting which files to convert to MP3
-        self.spinelistdict = [
-            {'name': name, 
-            'toc': self.name_data_map[name]['short_toctitle'], 
-            'sample': self.name_data_map[name]['sample'],
-            'wordcount': self.name_data_map[name]['wordcount']
-            } for name in self.spine_list]
+        # build one record per spine text file, also used as the rows for the QDialog 
+        # for selecting which files to convert to MP3
+        # text, word counts and samples are filled in later by the background loader
+        self.spine_records = [self.create_spine_record(name, padding) for name in self.spine_list]
+        self.name_record_map = {r.name: r for r in self.spine_records}
         
         self.book_label = self.book_meta.get('path_to_ebook')
         if self.book_id:
             self.book_label = '%s - %s (%s)' % (self.book_meta.get('author0'), self.book_meta.get('title'), self.book_id)
         self.bookLabel.setText(self.book_label)
+        
+        cpus = None
+        if self.gui is not None:
+            cpus = self.gui.job_manager.server.pool_size
+        self.spine_loader = SpineTextLoader(self.container, self.spine_list, language, 
+                                prefs['img_alt_show'], prefs['img_alt_prefix'], 
+                                parallel=prefs['parallel_extract'], cpus=cpus, 
+                                cache=get_text_cache(prefs['text_cache_mb']), parent=self)
+        self.spine_loader.name_loaded.connect(self.spine_loader_name_loaded)
+        self.spine_loader.load_finished.connect(self.spine_loader_load_finished)
+        self.spine_loader.load_failed.connect(self.spine_loader_load_failed)
+        self.refresh_filecount()
+        self.spine_loader.start()
+        
+    @property
+    def is_loading(self):
+        return self.spine_loader is not None and self.load_error is None and \
+                self.loaded_count < len(self.spine_list)
+        
+    def spine_loader_name_loaded(self, name, data):
+        # text for one spine file has arrived from the background loader
+        # names arrive in spine sequence so track numbers are assigned in order
+        record = self.name_record_map[name]
+        record.set_text_data(data)
+        if record.booktext:
+            record.track = self.next_track
+            self.next_track += 1
+                
+        self.loaded_count += 1
+        self.refresh_filecount()
+        
+    def spine_loader_load_failed(self, errmsg):
+        # stop waiting for the rest of the text
+        self.load_error = errmsg
+        self.refresh_filecount()
+        error_dialog(self, PLUGIN_CAPTION,
+                'The text of {0} of {1} files could not be loaded.'.format(
+                    len(self.spine_list) - self.loaded_count, len(self.spine_list)),
+                det_msg=errmsg, show=True)
+
+    def spine_loader_load_finished(self):
+        self.extract_span = self.spine_loader.span + (sum(r.wordcount for r in self.name_record_map.values()),)
+        self.preselect_stale_names()
+        self.refresh_filecount()
+        
+    @property
+    def book_key(self):
+        # identifies this book in prefs['book_mp3_dirs']
+        if self.book_id:
+            return '%s:%s' % (getattr(self.db, 'library_id', ''), self.book_id)
+        return self.pathtoebook
+        
+    def preselect_stale_names(self):
+        # if this book has been recorded before, select only the files whose
+        # text, voice or tags have changed since then
+        mp3_dir = prefs['book_mp3_dirs'].get(self.book_key)
+        manifest = load_manifest(mp3_dir)
+        if manifest is None:
+            return
+        self.refresh_mp3tags()
+        settings = render_settings(self.engine_name, self.vid, self.voice_rate)
+        self.selected_names = stale_names(manifest, self.spine_records, settings, self.create_book_tags(), mp3_dir)
+        self.changedfilesButton.setEnabled(True)
+        total = len([r for r in self.spine_records if r.booktext])
+        self.manifestLabel.setText('Changed since last recording: {0} / {1}'.format(len(self.selected_names), total))
+        self.manifestLabel.setToolTip(mp3_dir)
+        self.refresh_filecount()
             
     def voiceCombo_textChanged(self, text):
         self.voice_name = text
@@ -346,12 +484,20 @@ class EbookTTStoMP3(QDialog):
         self.refresh_mp3_comment()
                 
     def allfilesButton_clicked(self):
-        self.selected_names = [name for name in self.spine_list if self.name_data_map[name].get('booktext', '')]
+        self.selected_names = [r.name for r in self.spine_records if r.booktext]
         self.refresh_filecount()
         
     def selspineButton_clicked(self):
-        dialog = SelNamesDlg(self.selected_names, self.spinelistdict, self.name_data_map, self.voice_name, self.voice_rate, self)
-        if dialog.exec_():
+        dialog = SelNamesDlg(self.selected_names, self.spine_records, self.voice_name, self.voice_rate, self,
+                             engine_name=self.engine_name)
+        listening = self.is_loading
+        if listening:
+            # keep the table up to date while the remaining text loads
+            self.spine_loader.name_loaded.connect(dialog.name_loaded)
+        result = dialog.exec_()
+        if listening:
+            self.spine_loader.name_loaded.disconnect(dialog.name_loaded)
+        if result:
             # force selected names into spine sequence
             self.selected_names = [name for name in self.spine_list if name in dialog.select_spines]
             self.refresh_filecount()
@@ -374,80 +520,107 @@ class EbookTTStoMP3(QDialog):
         #self.dest_dir = PersistentTemporaryDirectory('_ttsmp3')
         album = self.book_data_map.get('tl', '').strip()
         if album:
-            clean_album = sanitize_file_name_unicode(album).strip('_')
-            clean_album = make_filename_safe(clean_album)
-            clean_album = re.sub(r'[_]{2,}', '_', clean_album)
-            clean_album = clean_album.replace('_', ' ').strip()
-            self.mp3_dir = os.path.join(self.mp3_dir, clean_album)
+            self.mp3_dir = os.path.join(self.mp3_dir, album_dir_name(album))
             if not os.path.exists(self.mp3_dir):
                 os.mkdir(self.mp3_dir)
+        book_mp3_dirs = prefs['book_mp3_dirs']
+        book_mp3_dirs[self.book_key] = self.mp3_dir
+        prefs['book_mp3_dirs'] = book_mp3_dirs
+        
+        self.move_to_job_dir()
+        # MP3s are encoded straight into the MP3 dir if they then only need renaming
+        self.mp3_in_place = same_device(self.dest_dir, self.mp3_dir)
         
-        # process cover thumbnail
+        # process cover thumbnail: moved now if that is a rename, else copied by the job
+        self.cover_file = None
         thumb_path = os.path.join(self.dest_dir, 'cover.jpg')
         if os.path.exists(thumb_path):
-            shutil.copy2(thumb_path, self.mp3_dir)
+            if self.mp3_in_place:
+                place_file(thumb_path, os.path.join(self.mp3_dir, 'cover.jpg'), move=True)
+            else:
+                self.cover_file = thumb_path
             
-        #build the 'to-do' list of names/metadata in prep for using a QProgressDialog
+        #build the 'to-do' list of names/metadata to queue as a job
         self.create_payload()
         if not self.payload:
             errmsg = '\n*** Nothing to record to MP3. None of the selected files contain text.'
             info_dialog(self.gui, PLUGIN_NAME,
                 errmsg, show=True, show_copy_button=True)
             return False
+        self.renumber_unchanged_tracks()
         return True
         
+    def move_to_job_dir(self):
+        # the job works in a dir which survives restarting calibre, so it can be resumed
+        # bring the cover thumbnail and lame.exe with it
+        if self.in_job_dir:
+            return
+        job_dir = create_job_dir()
+        for fname in os.listdir(self.dest_dir):
+            shutil.move(os.path.join(self.dest_dir, fname), job_dir)
+        thumb_path = self.book_data_map.get('ti')
+        if thumb_path is not None:
+            self.book_data_map['ti'] = os.path.join(job_dir, os.path.basename(thumb_path))
+        if iswindows and self.lame_path:
+            self.lame_path = shutil.copy2(self.lame_path, job_dir)
+        self.dest_dir = job_dir
+        self.in_job_dir = True
+        
+    def renumber_unchanged_tracks(self):
+        # MP3s which are up to date keep their audio, but are renamed if their track number has moved
+        manifest = load_manifest(self.mp3_dir)
+        if manifest is None:
+            return
+        settings = render_settings(self.engine_name, self.vid, self.voice_rate)
+        tracks = manifest['tracks']
+        unchanged = [r for r in self.spine_records if r.booktext and r.name not in self.selected_names
+                     and not is_stale(tracks.get(r.name), r, settings, self.book_tags, self.mp3_dir)]
+        ntracks = len(tracks)
+        moved = renumber_tracks(manifest, unchanged, self.mp3_dir, self.book_tags)
+        for old_file, new_file in moved:
+            debug_print('{0}: renumbered {1} -> {2}'.format(PLUGIN_NAME, old_file, new_file))
+        # tracks which couldn't be renumbered are dropped from the manifest
+        if moved or len(tracks) != ntracks:
+            save_manifest(self.mp3_dir, manifest)
+        
+    def create_book_tags(self):
+        # tags which are the same for every track
+        book_tags = {lameopt: self.book_data_map.get(lameopt) for lameopt in ('ta', 'tl', 'ty', 'tg', 'tc')}
+        if prefs['embed_cover_thumbnail']:
+            thumb_path = self.book_data_map.get('ti')
+            if thumb_path is not None:
+                book_tags['ti'] = thumb_path
+        return book_tags
+        
     def create_payload(self):
-        #build the 'to-do' list of names/metadata in prep for using a QProgressDialog
+        #build the 'to-do' list of records to queue as a job
+        # the text itself is written once to a memory-mapped store in dest_dir,
+        # each record only carries the offset and length of its text
+        # tags which are the same for every track go in book_tags, once
         self.payload = []
-        for name in self.selected_names:
-            booktext = self.name_data_map[name].get('booktext', '')
-            if booktext:
-                safe_filename = self.name_data_map[name].get('safe_filename')
-                wav_file_name = os.path.join(self.dest_dir, safe_filename + '.wav')
-                mp3_file_name = os.path.join(self.dest_dir, safe_filename + '.mp3')
-                
-                dmp3meta = {
-                        'name':name
-                        , 'book_id':self.book_id
-                        , 'booktext': booktext
-                        , 'safe_filename': safe_filename
-                        , 'wav_file_name': wav_file_name
-                        , 'mp3_file_name': mp3_file_name
-                        , 'pad_track': self.name_data_map[name].get('pad_track')
-                        , 'wordcount': self.name_data_map[name].get('wordcount')
-                        , 'mp3_dir': self.mp3_dir
-                        }
-                
-                for lameopt in ('ta', 'tl', 'ty', 'tg', 'tc'):
-                    dmp3meta[lameopt] = self.book_data_map.get(lameopt)
-                    
-                if prefs['embed_cover_thumbnail']:
-                    thumb_path = self.book_data_map.get('ti')
-                    if thumb_path is not None:
-                        dmp3meta['ti'] = thumb_path
-                    
-                for lameopt in ('tt', 'tn'):
-                    dmp3meta[lameopt] = self.name_data_map[name].get(lameopt)
+        self.book_tags = self.create_book_tags()
+        for k,v in sorted(self.book_tags.items()):
+            debug_print('{0}: {1}'.format(k, v))
             
-                for k,v in sorted(dmp3meta.items()):
-                    if k != 'booktext':
-                        debug_print('{0}: {1}'.format(k, v))
-                    
-                self.payload.append(dmp3meta)
+        self.text_store_path = os.path.join(self.dest_dir, TEXT_STORE_FILENAME)
+        with TextStoreWriter(self.text_store_path) as store:
+            for name in self.selected_names:
+                record = self.name_record_map[name]
+                if record.booktext:
+                    record.text_offset, record.text_length = store.add(name, record.booktext)
+                    debug_print('{0}: {1} [{2} words]'.format(record.pad_track, record.safe_filename, record.wordcount))
+                    self.payload.append(record)
         
     def refresh_mp3_comment(self):
-        shortnames = [dv['name'] for dv in self.all_voices if dv['id'] == self.vid]
-        shortname = shortnames[0] if shortnames else 'Unknown'
-        comment = 'calibre: %s (%d)' % (shortname, self.voice_rate)
-        self.mp3tags['tc'].setText(comment.strip())
+        self.mp3tags['tc'].setText(voice_comment(self.catalog.voice_name(self.vid), self.voice_rate))
         self.refresh_mp3tags()
         
     def refresh_filecount(self):
         self.buttonBox.button(QDialogButtonBox.StandardButton.Save).setEnabled(False)
-        if self.selected_names:
+        if self.selected_names and not self.is_loading:
             self.buttonBox.button(QDialogButtonBox.StandardButton.Save).setEnabled(True)
             
-        words = [self.name_data_map[name].get('wordcount', 0) for name in self.selected_names]
+        words = [self.name_record_map[name].wordcount for name in self.selected_names]
         files_with_words = len(words) - words.count(0)
         total_words = sum(words)
         avg_words = float(total_words) / files_with_words if files_with_words else 0
@@ -455,6 +628,11 @@ class EbookTTStoMP3(QDialog):
         self.totfilesLabel.setText('Selected: {0} / {1}'.format(len(self.selected_names), len(self.spine_list)))
         self.avgwordsLabel.setText('Avg. words/file: {0:.0f}'.format(avg_words))
         
+        if self.is_loading:
+            self.loadingLabel.setText('Loading text: {0} / {1}'.format(self.loaded_count, len(self.spine_list)))
+        else:
+            self.loadingLabel.setText('')
+        
     def refresh_mp3tags(self):
         # extract book data for mp3 tags
         for lameopt in ('ta', 'tl', 'ty', 'tg', 'tc'):
@@ -471,48 +649,8 @@ class EbookTTStoMP3(QDialog):
         self.metas['pubdate'].setText(self.book_meta.get('pubyear', ''))
         self.metas['tags'].setText(', '.join(self.book_meta.get('tags', [])))
             
-    def populate_name_data_map(self, name, track, padding, language, img_alt_show, img_alt_prefix):
-        dict = {}
-        d, fx = os.path.split(name)
-        f, x = os.path.splitext(fx)
-        sanfname = sanitize_file_name_unicode(f)
-
-        toctitle = self.toc_name_title_map.get(name, '')
-        if not toctitle:
-            # this text file is missing from the TOC
-            toctitle = sanfname
-            dict['tt'] = sanfname
-        else:
-            dict['tt'] = toctitle.strip()
-            sanfname = sanitize_file_name_unicode(toctitle.strip())
-            if len(toctitle) > 50:
-                toctitle = toctitle[:50] + '...'
-            
-        dict['short_toctitle'] = toctitle
-        
-        safe_fname = make_filename_safe(sanfname)
-        safe_fname1 = re.sub(r'[_]{2,}', '_', safe_fname)[:50]
-        safe_fname2 = safe_fname1.replace('_', ' ').strip()
-        
-        raw_data = self.container.raw_data(name)
-        dict['sample'] = raw_data[:1000] + '...'
-            
-        booktext = get_page_text(self.container, name, img_alt=img_alt_show, alt_prefix=img_alt_prefix)
-        
-        dict['booktext'] = booktext
-        
-        wordcount = count_words(booktext.replace('.', '. '), language)
-        dict['wordcount'] = wordcount
-        
-        dict['tn'] = '0'
-        dict['pad_track'] = '0'.zfill(padding)
-        dict['safe_filename'] = ''
-        if booktext:
-            dict['tn'] = str(track)
-            dict['pad_track'] = str(track).zfill(padding)
-            dict['safe_filename'] = '%s_%s' % (dict['pad_track'], safe_fname2)
-
-        return dict
+    def create_spine_record(self, name, padding):
+        return create_spine_record(name, padding, self.toc_name_title_map)
     
     def aboutButton_clicked(self):
         # Get the about text from a file inside the plugin zip file
@@ -536,64 +674,147 @@ class EbookTTStoMP3(QDialog):
         QMessageBox.about(self, 'About %s' % ver, text)
 
     def accept(self):
+        if self.is_loading:
+            return
         ok_to_proceed = self.prep_to_create_mp3s()
         if ok_to_proceed:
             QDialog.accept(self)
-        
-class QueueProgressDialog(QProgressDialog):
-    # MP3 creation run in background via calibre jobs system        
-    def __init__(self, gui, payload, queue, djobmeta):
-        self.total_files = len(payload)
-        QProgressDialog.__init__(self, '', '', 0, self.total_files, gui)
-        
+            
+    def done(self, r):
+        # stop the background loader if the dialog is closed before it finishes
+        if self.spine_loader is not None:
+            self.spine_loader.abort()
+        if self.in_job_dir and r != QDialog.DialogCode.Accepted:
+            # no job was queued for this job dir
+            shutil.rmtree(self.dest_dir, ignore_errors=True)
+        self.catalog.release(self.spVoice)
+        QDialog.done(self, r)
+        
+class BatchPreparer(QObject):
+    ''' Prepare each book of a batch in turn in a background thread, see batch.prepare_book()
+        Results are delivered to the GUI thread one book at a time
+    '''
+    book_prepared = pyqtSignal(object, object)
+    book_failed = pyqtSignal(object, object)
+    batch_finished = pyqtSignal()
+
+    def __init__(self, db, book_ids, mp3_root, settings, lame_path, cpus=None, parent=None):
+        QObject.__init__(self, parent)
+        self.db = db
+        self.book_ids = list(book_ids)
+        self.mp3_root = mp3_root
+        self.settings = settings
+        self.lame_path = lame_path
+        self.cpus = cpus
+        self.aborted = False
+        self.prep_thread = None
+        # container and job dirs of the prepared books, see remove_temp_dirs()
+        self.temp_dirs = []
+
+    def start(self):
+        self.prep_thread = Thread(target=self.run, name='TTSMP3BatchPreparer')
+        self.prep_thread.daemon = True
+        self.prep_thread.start()
+
+    def abort(self):
+        self.aborted = True
+
+    def remove_temp_dirs(self):
+        # the batch was not queued: no job will clean up after the prepared books
+        remove_temp_dirs(self.temp_dirs)
+        self.temp_dirs = []
+
+    def run(self):
+        for book_id in self.book_ids:
+            if self.aborted:
+                break
+            book_dirs = []
+            try:
+                path_to_ebook = book_format_path(self.db, book_id)
+                if not path_to_ebook:
+                    raise BatchError('No %s available for this book' % ', '.join(OK_FORMATS))
+                book = prepare_book(path_to_ebook, self.mp3_root, self.settings, db=self.db,
+                            book_id=book_id, lame_path=self.lame_path, cpus=self.cpus,
+                            abort=lambda: self.aborted, temp_dirs=book_dirs)
+            except BatchError as err:
+                remove_temp_dirs(book_dirs)
+                self.book_failed.emit(book_id, str(err))
+            except:
+                traceback.print_exc()
+                remove_temp_dirs(book_dirs)
+                self.book_failed.emit(book_id, 'tts_to_mp3:Unknown error')
+            else:
+                self.temp_dirs.extend(book_dirs)
+                self.book_prepared.emit(book_id, book)
+        self.batch_finished.emit()
+
+
+class BatchQueueDialog(QProgressDialog):
+    ''' Batch mode: record every selected book with the saved settings
+        Each book is prepared as if its main dialog was accepted with the "All" button,
+        then the tracks of all books are queued as one job, taken from each book in turn
+        :job_meta: builds the djobmeta of a prepared book
+        :queue: queues the job, see TTSMP3UiAction._queue_job()
+    '''
+
+    def __init__(self, gui, book_ids, mp3_root, settings, lame_path, job_meta, queue):
+        QProgressDialog.__init__(self, '', _('Cancel'), 0, len(book_ids), gui)
         self.gui = gui
-        self.payload = payload
-        self.djobmeta = djobmeta
+        self.db = gui.current_db.new_api
+        self.job_meta = job_meta
         self.queue = queue
-        
-        self.files_to_proc, self.bad_files = [], []
-        
-        self.setWindowTitle('Queueing files for {0}'.format(PLUGIN_NAME))
+        self.books, self.errors = [], []
+
+        self.setWindowTitle('Preparing books for {0}'.format(PLUGIN_NAME))
         self.setMinimumWidth(500)
-        
-        self.i = 0
-        QTimer.singleShot(0, self.do_file_action)
-        self.exec_()
+        self.setAutoClose(False)
+        self.setAutoReset(False)
+        self.setWindowModality(Qt.WindowModality.WindowModal)
+        self.setLabelText('Preparing {0} books'.format(len(book_ids)))
 
-    def do_file_action(self):
-        if self.i >= self.total_files:
-            return self.do_queue()
-            
-        # get data for current file
-        dmp3meta = self.payload[self.i]
-        pad_track = dmp3meta.get('pad_track')
-        name = dmp3meta.get('name')
-        book_label = self.djobmeta.get('book_label')
+        self.preparer = BatchPreparer(self.db, book_ids, mp3_root, settings, lame_path,
+                            cpus=gui.job_manager.server.pool_size, parent=self)
+        self.preparer.book_prepared.connect(self.book_prepared)
+        self.preparer.book_failed.connect(self.book_failed)
+        self.preparer.batch_finished.connect(self.batch_finished)
+        self.canceled.connect(self.preparer.abort)
+        self.show()
+        self.preparer.start()
+
+    def book_prepared(self, book_id, book):
+        self.books.append(book)
+        # remember where this book's MP3s are, as the main dialog does
+        book_mp3_dirs = prefs['book_mp3_dirs']
+        book_mp3_dirs['%s:%s' % (getattr(self.db, 'library_id', ''), book_id)] = book.mp3_dir
+        prefs['book_mp3_dirs'] = book_mp3_dirs
+        self.setLabelText('Prepared ' + book.book_label)
+        self.setValue(self.value() + 1)
+
+    def book_failed(self, book_id, errmsg):
         try:
-            self.setLabelText(_('Queueing ') + pad_track + name)
-            self.files_to_proc.append((dmp3meta, self.djobmeta))
-            self.setValue(self.i)
+            title = self.db.field_for('title', book_id)
         except:
-            traceback.print_exc()
-            self.bad_files.append((pad_track, name, 'tts_to_mp3:Unknown error', book_label))
-
-        self.i += 1
-        QTimer.singleShot(0, self.do_file_action)
+            title = str(book_id)
+        self.errors.append('{0}: {1}'.format(title, errmsg))
+        self.setValue(self.value() + 1)
 
-    def do_queue(self):
-        if self.gui is None:
-            # There is a nasty QT bug with the timers/logic above which can
-            # result in the do_queue method being called twice
-            return
+    def batch_finished(self):
         self.hide()
-        if not self.files_to_proc:
-            warning_dialog(self.gui, 'Scan failed',
-                'No files found which match chosen criteria.',
-                show_copy_button=False, show=True)
-        self.gui = None
-        if self.files_to_proc:
-            # Queue a job to process these books
-            self.queue(self.files_to_proc, self.bad_files)
+        if self.preparer.aborted:
+            # no job was queued for these books
+            self.preparer.remove_temp_dirs()
+            return
+        if self.errors:
+            warning_dialog(self.gui, PLUGIN_NAME,
+                '{0} of {1} books can not be recorded'.format(len(self.errors), self.maximum()),
+                det_msg='\n'.join(self.errors), show_copy_button=True, show=True)
+        if self.books:
+            book_files = []
+            for book in self.books:
+                djobmeta = self.job_meta(book)
+                book_files.append([(record.job_state(), djobmeta) for record in book.payload])
+            files_to_proc = interleave_files(book_files)
+            self.queue(files_to_proc, [], book_label='{0} books'.format(len(self.books)))
 
 if __name__ == "__main__":
     import sys, re
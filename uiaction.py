@@ -16,30 +16,29 @@ from polyglot.builtins import unicode_type, iteritems
 
 try:
     from qt.core import (
-        QMenu, QToolButton, QIcon,
+        QMenu, QToolButton, QIcon, QTimer,
         QDialog, QLabel, QDialogButtonBox,
         QVBoxLayout, QHBoxLayout, QGroupBox, QRadioButton)
 except ImportError:
     from PyQt5.Qt import (
-        QMenu, QToolButton, QIcon,
+        QMenu, QToolButton, QIcon, QTimer,
         QDialog, QLabel, QDialogButtonBox,
         QVBoxLayout, QHBoxLayout, QGroupBox, QRadioButton)
     
 # The class that all interface action plugins must inherit from
 from calibre.gui2.actions import InterfaceAction
-from calibre.gui2 import error_dialog, open_local_file
+from calibre.gui2 import error_dialog, info_dialog, open_local_file
 from calibre.gui2.proceed import Icon
 from calibre.gui2.dialogs.message_box import ErrorNotification
 #from calibre.utils.date import now
 
 from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME, PLUGIN_CAPTION, PLUGIN_DESCRIPTION
-#from calibre_plugins.tts_to_mp3_plugin.config import prefs
-from calibre_plugins.tts_to_mp3_plugin.tts_to_mp3 import EbookTTStoMP3, QueueProgressDialog
-from calibre_plugins.tts_to_mp3_plugin.jobs import get_job_details
-from calibre_plugins.tts_to_mp3_plugin.other_dlgs import EbookSelectFormat
 from calibre_plugins.tts_to_mp3_plugin.common_utils import set_plugin_globals, find_icon
+# The dialogs, jobs and config modules import the polish container, TTS engines etc.
+# They are imported when the action is first used, not while calibre starts
 
-OK_FORMATS = ('EPUB', 'AZW3', 'KEPUB')
+# how often the status bar shows the progress of running jobs
+PROGRESS_MS = 2000
 
 class TTSMP3UiAction(InterfaceAction):
     name = PLUGIN_NAME
@@ -65,6 +64,13 @@ class TTSMP3UiAction(InterfaceAction):
         
         self.is_library_selected = True
         self.menu = QMenu(self.gui)
+        # job dirs of jobs running now, these can't be resumed
+        self.running_job_dirs = set()
+        # jobs whose progress is shown in the status bar while they run
+        self.running_jobs = []
+        self.progress_timer = QTimer(self.gui)
+        self.progress_timer.setInterval(PROGRESS_MS)
+        self.progress_timer.timeout.connect(self._show_job_progress)
         
         # Set the icon for this interface action
         # The get_icons function is a builtin function defined for all your
@@ -114,6 +120,12 @@ class TTSMP3UiAction(InterfaceAction):
         ac1.triggered.connect(self.show_dialog)
         m.addAction(ac1)
         
+        ac3 = self.create_action(
+                spec=('Resume interrupted jobs...', None, None, None),
+                attr='Resume interrupted jobs...')
+        ac3.triggered.connect(self.show_resume_dialog)
+        m.addAction(ac3)
+        
         m.addSeparator()
         ac2 = self.create_action(
                 spec=('Customize plugin...', 'config.png', None, None),
@@ -125,6 +137,9 @@ class TTSMP3UiAction(InterfaceAction):
         self.interface_action_base_plugin.do_user_config(self.gui)
                                 
     def show_dialog(self):
+        from calibre_plugins.tts_to_mp3_plugin.tts_to_mp3 import EbookTTStoMP3
+        from calibre_plugins.tts_to_mp3_plugin.other_dlgs import EbookSelectFormat
+        from calibre_plugins.tts_to_mp3_plugin.batch import OK_FORMATS
         
         class SelectedBookError(Exception): pass
         
@@ -139,8 +154,7 @@ class TTSMP3UiAction(InterfaceAction):
                 raise SelectedBookError(errmsg)
                 
             if len(book_ids) > 1:
-                errmsg = 'More than one book selected'
-                raise SelectedBookError(errmsg)
+                return self.show_batch_dialog(book_ids)
                 
             #if self.is_library_selected:
             book_id = book_ids[0]
@@ -179,24 +193,61 @@ class TTSMP3UiAction(InterfaceAction):
         
         if dlg.exec_():
             self.book_label = dlg.book_label
-            
-            djobmeta = {'lame_path': dlg.lame_path
-                        , 'voice_name': dlg.voice_name
-                        , 'voice_rate': dlg.voice_rate
-                        , 'voice_id': dlg.vid
-                        , 'book_label': dlg.book_label
-                        , 'container_root': dlg.container.root
-                        , 'dest_dir': dlg.dest_dir
-                        }
+            djobmeta = self.create_djobmeta(dlg)
+
+            # all selected files are queued at once as one job, see jobs.do_book_action_worker
+            self._queue_job([(record.job_state(), djobmeta) for record in dlg.payload], [])
+
+    def create_djobmeta(self, dlg):
+        # job settings of a book from its accepted main dialog, or a batch BookJob
+        from calibre_plugins.tts_to_mp3_plugin.config import prefs
+        from calibre_plugins.tts_to_mp3_plugin.batch import create_djobmeta
+        return create_djobmeta(dlg, prefs)
 
-            # loop around selected files to record to MP3. Use calibre jobs system
-            QueueProgressDialog(self.gui, dlg.payload, self._queue_job, djobmeta)
+    def show_batch_dialog(self, book_ids):
+        # record several books with the saved settings, as one job
+        from calibre.gui2 import choose_dir
+        from calibre.ptempfile import PersistentTemporaryDirectory
+        from calibre_plugins.tts_to_mp3_plugin.config import prefs
+        from calibre_plugins.tts_to_mp3_plugin.batch import BATCH_PREFS, PROG_FILENAME, find_lame
+        from calibre_plugins.tts_to_mp3_plugin.encoders import get_encoder, ENCODER_LAME
+        from calibre_plugins.tts_to_mp3_plugin.tts_to_mp3 import BatchQueueDialog
 
+        lame_path = find_lame(PersistentTemporaryDirectory('_ttsmp3'))
+        if not lame_path and get_encoder(prefs['mp3_encoder']).name == ENCODER_LAME:
+            return error_dialog(self.gui, PLUGIN_NAME,
+                        '\n*** Could not find %s' % PROG_FILENAME, show=True, show_copy_button=True)
+        mp3_root = choose_dir(self.gui, name='tts_to_mp3_plugin',
+                        title='Destination directory for MP3s of {0} books'.format(len(book_ids)))
+        if not mp3_root:
+            return
+        settings = {key: prefs[key] for key in BATCH_PREFS}
+        # kept so the dialog lives until its books are prepared
+        self.batch_dialog = BatchQueueDialog(self.gui, book_ids, mp3_root, settings, lame_path,
+                                self.create_djobmeta, self._queue_job)
+        
+    def show_resume_dialog(self):
+        from calibre_plugins.tts_to_mp3_plugin.journal import resumable_jobs, discard_job
+        from calibre_plugins.tts_to_mp3_plugin.other_dlgs import ResumeJobsDlg
         
-    def _queue_job(self, files_to_proc, bad_files):
+        jobs = resumable_jobs(exclude=self.running_job_dirs)
+        if not jobs:
+            return info_dialog(self.gui, PLUGIN_CAPTION,
+                        'There are no interrupted jobs to resume.', show=True)
+        dlg = ResumeJobsDlg(jobs, self.gui)
+        if not dlg.exec_():
+            return
+        for job_dir, job, finished in dlg.result:
+            if dlg.action == 'discard':
+                discard_job(job_dir, job)
+            else:
+                self._queue_job(job['files_to_proc'], [], book_label=job.get('book_label'))
+        
+    def _queue_job(self, files_to_proc, bad_files, book_label=None):
         #For use when running as a background job with workers
         bad_files = []
         cpus = self.gui.job_manager.server.pool_size
+        book_label = book_label or self.book_label
         
         job = self.gui.job_manager.run_job(
                 self.Dispatcher(self._jobs_complete),
@@ -204,11 +255,29 @@ class TTSMP3UiAction(InterfaceAction):
                 args=('calibre_plugins.tts_to_mp3_plugin.jobs',
                     'do_book_action_worker', 
                     (files_to_proc, bad_files, cpus)), 
-                description= '%s:%s' % (PLUGIN_NAME, self.book_label))
+                description= '%s:%s' % (PLUGIN_NAME, book_label))
+        job._job_dirs = set(djobmeta['dest_dir'] for state, djobmeta in files_to_proc)
+        self.running_job_dirs.update(job._job_dirs)
+        self.running_jobs.append(job)
+        if not self.progress_timer.isActive():
+            self.progress_timer.start()
                 
         self.gui.status_bar.show_message('{0} for {1} file(s)'.format(PLUGIN_CAPTION, len(files_to_proc)))
 
+    def _show_job_progress(self):
+        # the job's last notification: MP3s created, wpm, real-time factor and ETA, see progress.RenderProgress
+        self.running_jobs = [job for job in self.running_jobs if not job.is_finished]
+        if not self.running_jobs:
+            return self.progress_timer.stop()
+        msgs = ['{0}: {1:.0f}% {2}'.format(job.description, job.percent, job.status_text)
+                for job in self.running_jobs if job.start_time is not None]
+        if msgs:
+            self.gui.status_bar.show_message(' | '.join(msgs), 2 * PROGRESS_MS)
+
     def _jobs_complete(self, job):
+        from calibre_plugins.tts_to_mp3_plugin.jobs import get_job_details
+        # if the job failed or some MP3s were not created, the job dir is kept for resuming
+        self.running_job_dirs.difference_update(getattr(job, '_job_dirs', ()))
         if job.failed:
             self.gui.job_exception(job, dialog_title='Failed to run %s'%PLUGIN_NAME)
             return
@@ -221,6 +290,7 @@ class TTSMP3UiAction(InterfaceAction):
             msg = '<div>%s</div>' % book_label
             msg += '<p>%d MP3(s) could not be created.</p>' % len(bad_files)
             msg += '<p>Click "Show details" to see problem files.</p>'
+            msg += '<p>To try them again use "Resume interrupted jobs..." in the plugin menu.</p>'
             p = ErrorNotification(
                 job.html_details, 
                 job.description,
@@ -242,9 +312,9 @@ class TTSMP3UiAction(InterfaceAction):
             footer = 'Recorded: {0} words @ {1:.0f} wpm'.format(total_words, wpm)
             msg += '\n<div>%s</div>' % footer
             
-            #clean up calibre temp for this job
-            shutil.rmtree(container_root, ignore_errors=True)
-            shutil.rmtree(dest_dir, ignore_errors=True)
+            #clean up calibre temp for this job, a batch job has a container and job dir per book
+            for temp_dir in set(d for good_file in good_files for d in good_file[6:8]):
+                shutil.rmtree(temp_dir, ignore_errors=True)
 
             self.gui.proceed_question(
                 self._dummy_check_proceed, # callback, called with payload if user asks to proceed
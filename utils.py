@@ -10,73 +10,299 @@ from calibre.utils.filenames import ascii_text
 from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME    
 from calibre_plugins.tts_to_mp3_plugin.common_utils import get_tag_attrib
 
-def create_single_wav(dmp3meta, spVoice, reporter):
-    ''' Create one WAV using selected Windows Sapi5 Voice at selected speech rate
-        :dmp3meta:  dict of metadata related to this file
-        :spVoice: calibre ISpVoice() instance. Voice to use to 'speak' the WAV
+# tag keys which are passed to lame.exe as --<key> <value> ID3 tag options
+LAME_TAG_OPTS = ('ta', 'tl', 'ty', 'tg', 'tc', 'ti', 'tt', 'tn')
+
+def create_single_wav(record, djobmeta, booktext, engine, reporter, wav_file_name=None, words=None, cache=None):
+    ''' Create one WAV using the selected TTS engine Voice at selected speech rate
+        :record:  SpineRecord for this file
+        :djobmeta:  dict of metadata shared by all files of the book
+        :booktext:  text to be spoken, read from the job's text store
+        :engine: engines.TTSEngine instance, with voice and rate set. Used to 'speak' the WAV
         :reporter: method to store session log 
+        :wav_file_name: WAV to create, default is the track's WAV. Set for one chunk of a track
+        :words: word count for the log, default is the track's word count
+        :cache: DiskCache of spoken WAVs, see engines.get_audio_cache(). Checked before speaking
     '''
-    # extract required dmp3meta fields
-    name = dmp3meta.get('name')
-    safe_filename = dmp3meta.get('safe_filename')
-    wav_file_name = dmp3meta.get('wav_file_name')
-    booktext = dmp3meta.get('booktext')
-    words = dmp3meta.get('wordcount')
+    name = record.name
+    safe_filename = record.safe_filename
+    if wav_file_name is None:
+        wav_file_name = record.wav_file_name(djobmeta['dest_dir'])
+    if words is None:
+        words = record.wordcount
     
     ts = now()
     reporter('    [%s] Processing [ispy3:%s] ... %s [%d words]' % (ts.strftime("%H:%M:%S"), ispy3, safe_filename, words))
     debug_print('{0}:do_single:Processing... {1} [{2}]'.format(
         PLUGIN_NAME, ascii_text(safe_filename), name))
     
+    cache_key = None
+    if cache is not None and cache.enabled:
+        from calibre_plugins.tts_to_mp3_plugin.engines import audio_cache_key
+        cache_key = audio_cache_key(engine, booktext)
+        cached_path = cache.get_path(cache_key)
+        if cached_path is not None:
+            shutil.copyfile(cached_path, wav_file_name)
+            ts = now()
+            reporter('    [%s] WAV from audio cache: %s' % (ts.strftime("%H:%M:%S"), wav_file_name))
+            return
+    
     #create WAV file
-    spVoice.create_recording_wav(wav_file_name, booktext)
+    engine.create_recording_wav(wav_file_name, booktext)
     ts = now()
     reporter('    [%s] Created WAV: %s' % (ts.strftime("%H:%M:%S"), wav_file_name))
+    if cache_key is not None and os.path.exists(wav_file_name):
+        cache.put_copy(cache_key, wav_file_name)
 
-        
-def create_single_mp3(dmp3meta, lame_path, reporter, parent=None):
-    ''' Create one MP3 from a WAV using Windows lame.exe
+
+def join_wavs(wav_paths, out_path, remove=True):
+    ''' Join the chunk WAVs of one track, in order, into a single WAV
+        All chunks come from the same voice so share the same PCM format
+        :remove: delete the chunk WAVs once joined
+    '''
+    import wave
+    with wave.open(out_path, 'wb') as out:
+        for i, path in enumerate(wav_paths):
+            with wave.open(path, 'rb') as piece:
+                if i == 0:
+                    out.setparams(piece.getparams())
+                while True:
+                    frames = piece.readframes(1 << 16)
+                    if not frames:
+                        break
+                    out.writeframes(frames)
+    if remove:
+        for path in wav_paths:
+            try:
+                os.remove(path)
+            except:
+                pass
+
+def create_single_mp3(record, djobmeta, lame_path, reporter, parent=None, copy_to_mp3_dir=True):
+    ''' Create one MP3 from a WAV using the selected encoder, see encoders.get_encoder()
         Tag MP3s using metadata from calibre library or book OPF 
-        :dmp3meta:  dict of metadata related to this file
-        :lame_path: path to unpacked temp copy of lame.exe 
+        :record:  SpineRecord for this file
+        :djobmeta:  dict of metadata shared by all files of the book, incl. book_tags
+        :lame_path: path to unpacked temp copy of lame.exe, if the lame.exe encoder is used
         :reporter:  method to store session log 
+        :copy_to_mp3_dir: False to leave the MP3 where it was encoded, see move_mp3_to_dir()
+        returns True if the MP3 was created
     '''
-    # extract required dmp3meta fields
-    name = dmp3meta.get('name')
-    wav_file_name = dmp3meta.get('wav_file_name')
-    mp3_file_name = dmp3meta.get('mp3_file_name')
-    mp3_dir = dmp3meta.get('mp3_dir')
+    from calibre_plugins.tts_to_mp3_plugin.encoders import get_encoder
+    from calibre_plugins.tts_to_mp3_plugin.engines import iter_wav_file
+    
+    name = record.name
+    wav_file_name = record.wav_file_name(djobmeta['dest_dir'])
+    mp3_file_name = mp3_work_file_name(record, djobmeta)
     
     if os.path.exists(wav_file_name):
-        lame_args = {k:v for (k,v) in iteritems(dmp3meta) if k.startswith('t')}
-        lame_args_py3 = [lame_path]
-        for tagopt, val in iteritems(lame_args):
-            lame_args_py3.append('--%s' % tagopt)
-            lame_args_py3.append(val)
-        lame_args_py3.append(wav_file_name)
-        lame_args_py3.append(mp3_file_name)
-        
-        # run LAME using subprocess in py3
-        retcode = run_prog_py3(lame_args_py3)
-        if retcode==0 and os.path.exists(mp3_file_name):
+        encoder = get_encoder(djobmeta.get('mp3_encoder'), lame_path)
+        params, blocks = iter_wav_file(wav_file_name)
+        if encoder.encode(params, blocks, mp3_file_name, encode_tags(record, djobmeta)) and \
+                os.path.exists(mp3_file_name):
             ts = now()
             reporter('    [%s] Created MP3: %s' % (ts.strftime("%H:%M:%S"), mp3_file_name))
             
-            #copy MP3 from calibre temp to user-selected dir
-            shutil.copy2(mp3_file_name, mp3_dir)
+            if copy_to_mp3_dir:
+                move_mp3_to_dir(record, djobmeta, reporter)
             try:
                 #WAVs are large, clean up calibre temp as we go
                 os.remove(wav_file_name)
             except:
                 pass
+            return True
         else:
             reporter('*** MP3 not created: %s' % name)
     else:
-        reporter('*** WAV not created: %s' % name)    
+        reporter('*** WAV not created: %s' % name)
+    return False
         
+def encode_tags(record, djobmeta):
+    # ID3 tags of a track, as lame tag options
+    tags = record.lame_tags(djobmeta.get('book_tags', {}))
+    return {k:v for (k,v) in iteritems(tags) if k in LAME_TAG_OPTS and v is not None}
+
+def create_chunk_mp3(record, djobmeta, booktext, engine, reporter, mp3_file_name, tagged=True, words=None, cache=None):
+    ''' Speak text straight into the MP3 encoder, no WAV is written
+        The engine's PCM blocks are encoded as they are produced, see encoders.py
+        :record:  SpineRecord for this file
+        :djobmeta:  dict of metadata shared by all files of the book, incl. lame_path and book_tags
+        :booktext:  text to be spoken, read from the job's text store
+        :engine: engines.TTSEngine instance, with voice and rate set
+        :reporter: method to store session log 
+        :mp3_file_name: MP3 to create, the track's MP3 or one piece of it
+        :tagged: False for a piece of a track: no ID3 tags and no Info frame, see join_mp3s()
+        :words: word count for the log, default is the track's word count
+        :cache: DiskCache of spoken WAVs, see engines.get_audio_cache(). A hit is streamed
+                from the cache, a miss is also written to the cache as it is spoken
+        returns True if the MP3 was created
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.engines import audio_cache_key, iter_wav_file
+    from calibre_plugins.tts_to_mp3_plugin.encoders import get_encoder
+    
+    safe_filename = record.safe_filename
+    if words is None:
+        words = record.wordcount
+    
+    ts = now()
+    reporter('    [%s] Processing [stream] ... %s [%d words]' % (ts.strftime("%H:%M:%S"), safe_filename, words))
+    debug_print('{0}:do_single:Streaming... {1} [{2}]'.format(
+        PLUGIN_NAME, ascii_text(safe_filename), record.name))
+    
+    source = 'TTS'
+    cache_key = None
+    if cache is not None and cache.enabled:
+        cache_key = audio_cache_key(engine, booktext)
+        cached_path = cache.get_path(cache_key)
+        if cached_path is not None:
+            params, blocks = iter_wav_file(cached_path)
+            source = 'audio cache'
+            cache_key = None
+    if source == 'TTS':
+        params, blocks = engine.stream(booktext)
+        if cache_key is not None:
+            blocks = tee_to_cache(blocks, params, cache, cache_key)
+    
+    encoder = get_encoder(djobmeta.get('mp3_encoder'), djobmeta.get('lame_path'))
+    tags = encode_tags(record, djobmeta) if tagged else None
+    if encoder.encode(params, blocks, mp3_file_name, tags) and os.path.exists(mp3_file_name):
+        ts = now()
+        reporter('    [%s] Created MP3 from %s: %s' % (ts.strftime("%H:%M:%S"), source, mp3_file_name))
+        return True
+    reporter('*** MP3 not created: %s' % record.name)
+    return False
+
+def tee_to_cache(blocks, params, cache, key):
+    ''' Pass PCM blocks through, writing them to a WAV in the audio cache on the way
+        The WAV is only added to the cache if every block was read
+    '''
+    import wave
+    path = cache.path_for(key)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    out = wave.open(tmp, 'wb')
+    out.setnchannels(params[0])
+    out.setsampwidth(params[1])
+    out.setframerate(params[2])
+    complete = False
+    try:
+        for block in blocks:
+            out.writeframes(block)
+            yield block
+        complete = True
+    finally:
+        out.close()
+        if complete:
+            cache.put_file(key, tmp)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def join_mp3s(mp3_paths, out_path, tag=b'', remove=True, preroll=0, nsamples=None):
+    ''' Join the MP3 pieces of one track, in order, into a single MP3
+        The pieces' frames are concatenated, with the main data of the first frames of each
+        piece moved to fit the frames now before them, see mpeg.FrameJoiner. Any ID3 tags or
+        Xing/Info frames of the pieces are left out and a Xing/Info frame for the whole track
+        is written, so players show its duration
+        :tag: ID3v2 tag for the track, see id3.id3v2_tag()
+        :remove: delete the pieces once joined
+        :preroll: frames at the start of each piece after the first which are dropped,
+                  see mpeg.overlap_ranges()
+        :nsamples: audio samples of the track, if the pieces are segments of it encoded by
+                   overlap_ranges(). Its encoder delay and padding are written to a LAME tag
+    '''
+    from calibre_plugins.tts_to_mp3_plugin.id3 import audio_span
+    from calibre_plugins.tts_to_mp3_plugin.mpeg import (scan_frames, xing_frame, xing_frame_length, xing_toc,
+                                                        FrameJoiner, ENCODER_DELAY)
+    
+    joiner = None
+    with open(out_path, 'wb') as out:
+        out.write(tag)
+        for i, path in enumerate(mp3_paths):
+            with open(path, 'rb') as f:
+                data = f.read()
+            start, end = audio_span(data)
+            header, piece_offsets, piece_bitrates = scan_frames(data, start, end)
+            if not piece_offsets:
+                continue
+            if joiner is None:
+                # room for the Xing frame, written when the frames are counted
+                nbytes = xing_frame_length(header, lame_tag=nsamples is not None)
+                out.write(b'\x00' * nbytes)
+                joiner = FrameJoiner(out, nbytes)
+            joiner.add(data, start, piece_offsets, piece_bitrates, skip=preroll if i else 0)
+        if joiner is not None:
+            joiner.flush()
+            first, offsets, nbytes = joiner.first, joiner.offsets, joiner.nbytes
+            delay = padding = None
+            if nsamples is not None:
+                delay = ENCODER_DELAY
+                padding = len(offsets) * first.samples - delay - nsamples
+            out.seek(len(tag))
+            out.write(xing_frame(first, len(offsets), nbytes, xing_toc(offsets, nbytes), len(joiner.bitrates) > 1,
+                                 delay, padding))
+    if remove:
+        for path in mp3_paths:
+            try:
+                os.remove(path)
+            except:
+                pass
+
+def truncate_mp3(path, nframes):
+    # keep the first nframes audio frames of an MP3 with no ID3v1 tag
+    from calibre_plugins.tts_to_mp3_plugin.id3 import audio_span
+    from calibre_plugins.tts_to_mp3_plugin.mpeg import scan_frames
+    with open(path, 'r+b') as f:
+        data = f.read()
+        start, end = audio_span(data)
+        header, offsets, bitrates = scan_frames(data, start, end)
+        if len(offsets) > nframes:
+            f.truncate(start + offsets[nframes])
+
+def same_device(path1, path2):
+    # True if a file can be renamed from one dir to the other
+    try:
+        return os.stat(path1).st_dev == os.stat(path2).st_dev
+    except EnvironmentError:
+        return False
+
+def part_file_name(path):
+    # temp name for a file while it is being written in its final dir
+    return path + '.part'
+
+def mp3_work_file_name(record, djobmeta):
+    ''' Where a track's MP3 is encoded
+        If the MP3 dir is on the same device as the job dir (djobmeta['mp3_in_place'])
+        it is encoded to a temp name in the MP3 dir and only has to be renamed,
+        else it is encoded in the job dir and copied, so encoding never waits on
+        a slow (network) MP3 dir
+    '''
+    if djobmeta.get('mp3_in_place'):
+        return part_file_name(record.mp3_file_name(djobmeta['mp3_dir']))
+    return record.mp3_file_name(djobmeta['dest_dir'])
+
+def place_file(src, dst, move=False):
+    ''' Put src at dst, so dst is never a partly written file
+        :move: rename src, which must be on the same device as dst. Else src is
+               copied to a temp name next to dst, which is then renamed
+    '''
+    if not move:
+        tmp = part_file_name(dst)
+        shutil.copy2(src, tmp)
+        src = tmp
+    os.replace(src, dst)
+
+def move_mp3_to_dir(record, djobmeta, reporter):
+    #rename or copy the finished MP3 to user-selected dir
+    in_place = bool(djobmeta.get('mp3_in_place'))
+    place_file(mp3_work_file_name(record, djobmeta), record.mp3_file_name(djobmeta['mp3_dir']), move=in_place)
+    ts = now()
+    reporter('    [%s] %s MP3 to: %s' % (ts.strftime("%H:%M:%S"), 'Moved' if in_place else 'Copied', djobmeta.get('mp3_dir')))
+
 def run_prog_py3(list_args):
-    # Run Windows executable in py3. Unicode args allowed
+    # Run executable in py3. Unicode args allowed
     import subprocess
+    from calibre.constants import iswindows
 
     '''startupinfo = subprocess.STARTUPINFO()
     startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
@@ -85,10 +311,35 @@ def run_prog_py3(list_args):
             list_args
             #, startupinfo=startupinfo
             , capture_output=False
-            , creationflags=subprocess.CREATE_NO_WINDOW
+            , creationflags=subprocess.CREATE_NO_WINDOW if iswindows else 0
             )
     return cp.returncode
 
+def run_prog_stdin(list_args, blocks):
+    # Run executable in py3, writing blocks of bytes to its stdin
+    import subprocess
+    from calibre.constants import iswindows
+
+    proc = subprocess.Popen(
+            list_args
+            , stdin=subprocess.PIPE
+            , creationflags=subprocess.CREATE_NO_WINDOW if iswindows else 0
+            )
+    try:
+        for block in blocks:
+            proc.stdin.write(block)
+    except (BrokenPipeError, OSError):
+        # the program has exited, its return code says why
+        pass
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+        try:
+            proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+    return proc.wait()
+
 def extract_book_meta(container, db, book_id):
     # gather all required metadata for this book
     from calibre.ebooks.oeb.polish.cover import find_cover_image
@@ -161,8 +412,48 @@ def extract_book_meta(container, db, book_id):
         
     return meta
 
+def default_mp3_tags(book_meta):
+    # MP3 tags the main dialog starts with, batch mode uses them as they are
+    return {'ta': book_meta.get('author0'),
+            'tl': book_meta.get('series_title', book_meta.get('title')),
+            'ty': book_meta.get('pubyear', now().strftime('%Y')),
+            'tg': 'Speech'}
+
+def voice_comment(voice_name, voice_rate):
+    # MP3 comment tag naming the voice and rate used
+    return ('calibre: %s (%d)' % (voice_name or 'Unknown', voice_rate)).strip()
+
+def safe_file_title(name, max_len=None):
+    # sanitised name made safe for the file system, runs of underscores shown as one space
+    from calibre.ebooks.oeb.polish.check.parsing import make_filename_safe
+    safe = re.sub(r'[_]{2,}', '_', make_filename_safe(name))[:max_len]
+    return safe.replace('_', ' ').strip()
+
+def album_dir_name(album):
+    # name of the subdir of the chosen MP3 dir which holds a book's MP3s
+    from calibre import sanitize_file_name_unicode
+    return safe_file_title(sanitize_file_name_unicode(album).strip('_'))
+
+def create_spine_record(name, padding, toc_name_title_map):
+    # SpineRecord for a spine file, titled from the ToC or else its file name
+    from calibre import sanitize_file_name_unicode
+    from calibre_plugins.tts_to_mp3_plugin.records import SpineRecord
+    d, fx = os.path.split(name)
+    f, x = os.path.splitext(fx)
+    toctitle = toc_name_title_map.get(name, '')
+    in_toc = bool(toctitle)
+    if not in_toc:
+        # this text file is missing from the TOC
+        toctitle = sanitize_file_name_unicode(f)
+        sanfname = toctitle
+    else:
+        sanfname = sanitize_file_name_unicode(toctitle.strip())
+    return SpineRecord(name, toctitle, in_toc, safe_file_title(sanfname, 50), padding)
+
 def get_page_text(container, name, img_alt=False, alt_prefix=''):
     ''' return text-only unicode string for selected page 
+        NB: the plugin now uses extract.SpokenTextExtractor. This older XPath
+        based version (which needs pretty_all first) is kept as the bench.py baseline
         :img_alt: bool, force-add <img alt="xyz" .../> text to extracted text
         :alt_prefix: text to be used to announce that img alt text follows
     '''
@@ -195,13 +486,11 @@ def get_page_text(container, name, img_alt=False, alt_prefix=''):
         text = re.sub(r'[\s\xa0]+\n', '\n\n', text)
     return text.strip() if text else ''
 
-def get_voiceid_from_desc(sapi, desc=None):
+def get_voiceid_from_desc(engine, desc=None):
     # get the Voice id from Voice description
-    ids = []
-    all_voices = sapi.get_all_voices()
-    if desc is not None:
-        ids = [dv['id'] for dv in all_voices if desc in dv['description']]
-    return ids[0] if ids else sapi.get_current_voice()
+    from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog
+    vid = voice_catalog(engine.name).voice_id(desc) if desc is not None else None
+    return vid if vid is not None else engine.get_current_voice()
 
 '''
 def get_voicedesc_from_id(sapi, id=None):
@@ -213,8 +502,7 @@ def get_voicedesc_from_id(sapi, id=None):
     return descs[0] if descs else default_voice_id.split(os.sep)[-1]
 '''
 
-def get_sorted_voicedescs(sapi):
+def get_sorted_voicedescs(engine):
     # get list of installed Voice descriptions sorted by Language/Gender
-    all_voices = sapi.get_all_voices()
-    vlist = [(dv['language'], dv['gender'], dv['description']) for dv in all_voices]
-    return [desc for (lang, gen, desc) in sorted(vlist)]
+    from calibre_plugins.tts_to_mp3_plugin.engines import voice_catalog
+    return list(voice_catalog(engine.name).sorted_descs)
@@ -0,0 +1,159 @@
+import os
+import posixpath
+import shutil
+import traceback
+from urllib.parse import unquote
+
+from calibre.ebooks.oeb.polish.container import Container, get_container
+from calibre.ptempfile import PersistentTemporaryDirectory
+from calibre.utils.logging import default_log
+from calibre.utils.xml_parse import safe_xml_fromstring
+from calibre.utils.zipfile import ZipFile
+
+#import from this plugin
+from calibre_plugins.tts_to_mp3_plugin import PLUGIN_NAME
+
+NCX_TYPE = 'application/x-dtbncx+xml'
+# font obfuscation is harmless to us as fonts are never unpacked
+# any other encryption means DRM, which the full container reports properly
+FONT_OBFUSCATION = frozenset(['http://www.idpf.org/2008/embedding', 'http://ns.adobe.com/pdf/enc#RC'])
+ZIP_FORMATS = ('.epub', '.kepub')
+
+
+def local_name(elem):
+    tag = elem.tag
+    if not isinstance(tag, str):
+        return None
+    return tag.rpartition('}')[2]
+
+def iter_local(root, name):
+    for elem in root.iter():
+        if local_name(elem) == name:
+            yield elem
+
+
+class NotSpineReadable(Exception):
+    pass
+
+
+class SpineZipContainer(Container):
+    ''' A polish Container for an EPUB/KEPUB which unpacks only the members this plugin reads:
+        the OPF, the NCX and/or nav document, the spine (X)HTML files and the cover image.
+        Fonts, images, CSS etc. are left in the zip archive.
+        Files are still parsed lazily by the Container, when first needed
+    '''
+    book_type = 'epub'
+
+    def __init__(self, pathtoepub, log, tdir):
+        self.pathtoepub = pathtoepub
+        if pathtoepub.lower().endswith('.kepub'):
+            self.book_type = 'kepub'
+        with ZipFile(pathtoepub, 'r') as zf:
+            opf_member = self.unpack_members(zf, tdir)
+        opf_path = os.path.join(tdir, *opf_member.split('/'))
+        Container.__init__(self, tdir, opf_path, log)
+
+    @property
+    def path_to_ebook(self):
+        return self.pathtoepub
+
+    def unpack_members(self, zf, tdir):
+        # return the zip member name of the OPF after unpacking the needed members
+        members = {m: m for m in zf.namelist()}
+        # some books have differently cased paths in manifest and zip
+        lower_members = {m.lower(): m for m in members}
+
+        def find_member(name):
+            return members.get(name) or lower_members.get(name.lower())
+
+        enc = find_member('META-INF/encryption.xml')
+        if enc is not None:
+            root = safe_xml_fromstring(zf.read(enc))
+            algorithms = set(em.get('Algorithm') for em in iter_local(root, 'EncryptionMethod'))
+            if algorithms - FONT_OBFUSCATION:
+                raise NotSpineReadable('encrypted content')
+
+        cxml = find_member('META-INF/container.xml')
+        if cxml is None:
+            raise NotSpineReadable('no META-INF/container.xml')
+        root = safe_xml_fromstring(zf.read(cxml))
+        opf_member = None
+        for rootfile in iter_local(root, 'rootfile'):
+            if rootfile.get('media-type') == 'application/oebps-package+xml':
+                opf_member = find_member(rootfile.get('full-path', ''))
+                if opf_member is not None:
+                    break
+        if opf_member is None:
+            raise NotSpineReadable('no OPF')
+
+        opf_data = zf.read(opf_member)
+        opf = safe_xml_fromstring(opf_data)
+        opf_dir = posixpath.dirname(opf_member)
+
+        def href_to_member(href):
+            href = unquote(href.partition('#')[0])
+            return find_member(posixpath.normpath(posixpath.join(opf_dir, href)))
+
+        manifest = {}
+        for item in iter_local(opf, 'item'):
+            if item.get('id') and item.get('href'):
+                manifest[item.get('id')] = item
+
+        wanted_ids = set()
+        for spine in iter_local(opf, 'spine'):
+            if spine.get('toc'):
+                wanted_ids.add(spine.get('toc'))
+            for itemref in iter_local(spine, 'itemref'):
+                wanted_ids.add(itemref.get('idref'))
+        for meta in iter_local(opf, 'meta'):
+            if meta.get('name') == 'cover' and meta.get('content'):
+                wanted_ids.add(meta.get('content'))
+        for id, item in manifest.items():
+            props = (item.get('properties') or '').split()
+            if item.get('media-type') == NCX_TYPE or 'nav' in props or 'cover-image' in props:
+                wanted_ids.add(id)
+
+        wanted = set([opf_member])
+        for id in wanted_ids:
+            item = manifest.get(id)
+            if item is not None:
+                member = href_to_member(item.get('href'))
+                if member is not None:
+                    wanted.add(member)
+        for ref in iter_local(opf, 'reference'):
+            # epub2 guide cover/title pages, used to find the cover image
+            if ref.get('type') in ('cover', 'titlepage') and ref.get('href'):
+                member = href_to_member(ref.get('href'))
+                if member is not None:
+                    wanted.add(member)
+
+        for member in wanted:
+            parts = [p for p in member.split('/') if p]
+            if '..' in parts:
+                continue
+            dest = os.path.join(tdir, *parts)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            data = opf_data if member == opf_member else zf.read(member)
+            with open(dest, 'wb') as f:
+                f.write(data)
+        return opf_member
+
+
+def get_spine_container(path, log=None):
+    ''' Open a book for text extraction
+        EPUB/KEPUB: unpack just the OPF, ToC, spine files and cover from the zip
+        Anything else (e.g. AZW3), or an EPUB the light path can't handle: full get_container()
+    '''
+    if log is None:
+        log = default_log
+    if path.lower().endswith(ZIP_FORMATS) and not os.path.isdir(path):
+        tdir = PersistentTemporaryDirectory('_container')
+        try:
+            return SpineZipContainer(path, log, tdir)
+        except NotSpineReadable as err:
+            print('{0}:get_spine_container: full unpack of {1}: {2}'.format(PLUGIN_NAME, path, err))
+        except:
+            traceback.print_exc()
+        shutil.rmtree(tdir, ignore_errors=True)
+    return get_container(path, log=log)